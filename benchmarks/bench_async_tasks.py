@@ -0,0 +1,51 @@
+"""
+提交任务+轮询模式: 一个工作线程同时挂起多个生成任务, 由共享的轮询器统一查询结果
+替身服务的任务在task_delay秒后完成
+
+python -m benchmarks.bench_async_tasks --tasks 20 --task-delay 3
+"""
+
+import argparse
+import asyncio
+import os
+import time
+
+from benchmarks.fakes import FakeVolcengine, use_fakes
+from utils.aio import run_sync
+from utils.volcengine import Params, cv_process_task, get_poller
+
+
+async def run_tasks(count: int) -> tuple[float, int]:
+    params = [
+        Params(
+            access_key=os.getenv("SEEDREAM_ACCESS_KEY"),
+            secret_key=os.getenv("SEEDREAM_SECRET_KEY"),
+            body={"req_key": "high_aes_general_v30l_zt2i", "prompt": f"prompt {i}"},
+        )
+        for i in range(count)
+    ]
+    start = time.perf_counter()
+    results = await asyncio.gather(*(cv_process_task(p) for p in params))
+    assert all(result["data"]["status"] == "done" for result in results)
+    return time.perf_counter() - start, get_poller().polls
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tasks", type=int, default=20)
+    parser.add_argument("--task-delay", type=float, default=3)
+    args = parser.parse_args()
+
+    with FakeVolcengine([b"\x89PNG\r\n\x1a\n"], task_delay=args.task_delay) as volcengine:
+        use_fakes(volcengine=volcengine)
+        elapsed, polls = run_sync(run_tasks(args.tasks))
+        # 任务并发挂起, 总耗时应接近单个任务而不是逐个累加
+        assert elapsed < args.task_delay * 2 + 5, elapsed
+        print(
+            f"tasks={args.tasks} task_delay={args.task_delay}s elapsed={elapsed:.2f}s "
+            f"polls={polls} ({polls / args.tasks:.1f}/task) requests={dict(volcengine.requests)}"
+        )
+
+
+if __name__ == "__main__":
+    main()
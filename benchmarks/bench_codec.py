@@ -0,0 +1,94 @@
+"""
+base64解码和哈希对事件循环延迟的影响, 在插件运行时同样的gevent补丁下测量
+inline: 在协程中直接执行; greenlet: 打补丁后的标准线程池(旧实现, 线程即协程); native: 工作池的gevent原生线程池
+事件循环上每5ms唤醒一次的探针记录最大延迟
+
+python -m benchmarks.bench_codec --size 48
+"""
+
+# 与插件运行时一致, 导入时执行gevent.monkey.patch_all
+import dify_plugin  # noqa: F401, I001
+
+import argparse
+import asyncio
+import base64
+import binascii
+import hashlib
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.aio import run_sync
+from utils.executor import get_pool
+
+
+async def probe(stop: asyncio.Event, lags: list[float]) -> None:
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.005)
+        lags.append(time.perf_counter() - start - 0.005)
+
+
+async def measure(run, func, data) -> tuple[float, float, object]:
+    """返回耗时、探针最大延迟和结果"""
+    stop, lags = asyncio.Event(), []
+    probe_task = asyncio.ensure_future(probe(stop, lags))
+    await asyncio.sleep(0.05)
+    start = time.perf_counter()
+    result = await run(func, data)
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await probe_task
+    return elapsed, max(lags), result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=48, help="图片内容大小(MB)")
+    args = parser.parse_args()
+
+    raw = os.urandom(args.size * 1024 * 1024)
+    encoded = base64.b64encode(raw)
+    greenlets = ThreadPoolExecutor(4)
+
+    async def inline(func, data):
+        return func(data)
+
+    async def greenlet(func, data):
+        return await asyncio.get_running_loop().run_in_executor(greenlets, func, data)
+
+    async def native(func, data):
+        return await get_pool("thread").run(func, data)
+
+    def sha256(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    cases = [
+        ("sha256", sha256, raw, hashlib.sha256(raw).hexdigest()),
+        ("a2b_base64", binascii.a2b_base64, memoryview(encoded), raw),
+    ]
+
+    async def run():
+        # 预先启动线程
+        await native(sha256, b"")
+        await greenlet(sha256, b"")
+        results = {}
+        for name, func, data, expected in cases:
+            for mode, runner in (("inline", inline), ("greenlet", greenlet), ("native", native)):
+                elapsed, lag, result = await measure(runner, func, data)
+                assert result == expected, (name, mode)
+                results[name, mode] = lag
+                print(f"{name:<14} {mode:<8} {args.size}MB elapsed={elapsed * 1000:.0f}ms max_loop_lag={lag * 1000:.1f}ms")
+        return results
+
+    lags = run_sync(run())
+    # 打补丁后标准线程池与直接执行一样阻塞事件循环, 原生线程池中释放GIL的哈希不阻塞;
+    # a2b_base64不释放GIL, 在哪里执行都阻塞事件循环解码所需的时间
+    assert lags["sha256", "greenlet"] > lags["sha256", "inline"] / 2
+    assert lags["sha256", "native"] < lags["sha256", "inline"] / 4, lags
+    assert lags["a2b_base64", "native"] > lags["a2b_base64", "inline"] / 2, lags
+    greenlets.shutdown()
+
+
+if __name__ == "__main__":
+    main()
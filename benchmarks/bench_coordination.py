@@ -0,0 +1,229 @@
+"""
+多副本协调: 启动若干个副本子进程共用一个本地Redis替身(fakeredis)和智能视觉服务替身, 同时调用文生图,
+检查替身收到的并发请求数、任意1秒内的请求数和本月图片用量不超过全局配置; 对比未启用协调时各副本各自限流的结果.
+另在进程内检查副本异常退出后并发名额在租约到期后释放
+
+python -m benchmarks.bench_coordination --replicas 3 --calls 8
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import fakeredis
+from dify_plugin.entities.tool import ToolRuntime
+
+from benchmarks.fakes import FakeOss, FakeVolcengine, use_fakes
+from tools.prompt_to_image import Create_imageTool
+from utils.aio import run_sync
+from utils.config import CoordinationConfig
+from utils.coordination import (
+    QUOTA_COMMIT,
+    QUOTA_RESERVE,
+    SEMAPHORE_ACQUIRE,
+    SEMAPHORE_RENEW,
+    SLIDING_WINDOW,
+    Coordinator,
+    get_coordinator,
+)
+from utils.credentials import get_tenant, use_tenant
+
+PROJECT_DIR = Path(__file__).parent.parent
+
+
+def replica(index: int, calls: int, threads: int) -> None:
+    """副本子进程: 以租户index的身份并发调用文生图, 最后一行输出统计JSON"""
+    credentials = {"oss_domain": f"tenant{index}.bench.local"}
+    runtime = ToolRuntime(credentials=credentials, user_id=None, session_id=None)
+    outcomes: list[str] = []
+
+    def call(i: int) -> None:
+        try:
+            messages = list(Create_imageTool(runtime=runtime, session=None)._invoke({"prompt": f"replica {index} #{i}"}))
+            outcomes.append("ok" if messages else "empty")
+        except Exception as e:
+            outcomes.append(type(e).__name__)
+
+    with ThreadPoolExecutor(threads) as executor:
+        list(executor.map(call, range(calls)))
+    result = {"outcomes": {name: outcomes.count(name) for name in set(outcomes)}}
+    coordinator = get_coordinator()
+    if coordinator is not None:
+        with use_tenant(get_tenant(credentials)):
+            result["usage"] = run_sync(coordinator.usage())
+        result["metrics"] = coordinator.metrics()
+    print(json.dumps(result))
+
+
+def run_replicas(args, redis_port: int, enabled: bool) -> list[dict]:
+    env = {
+        **os.environ,
+        "REDIS__HOST": "127.0.0.1",
+        "REDIS__PORT": str(redis_port),
+        "COORDINATION__ENABLED": str(enabled).lower(),
+        "COORDINATION__CONCURRENCY": json.dumps({"volcengine": args.concurrency}),
+        "COORDINATION__MONTHLY_QUOTA": str(args.quota),
+        "COORDINATION__TENANT_MONTHLY_QUOTA": str(args.tenant_quota),
+        "RATELIMIT__VOLCENGINE__RATE_LIMIT": str(args.rate_limit),
+        "CACHE__BACKEND": "none",
+    }
+    command = [sys.executable, "-m", "benchmarks.bench_coordination", "--calls", str(args.calls)]
+    processes = [
+        subprocess.Popen(
+            [*command, "--replica", str(index), "--threads", str(args.threads)],
+            cwd=PROJECT_DIR,
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        )
+        for index in range(args.replicas)
+    ]
+    results = []
+    for process in processes:
+        stdout, _ = process.communicate(timeout=300)
+        assert process.returncode == 0, stdout
+        results.append(json.loads(stdout.strip().splitlines()[-1]))
+    return results
+
+
+def start_redis() -> fakeredis.TcpFakeServer:
+    """在后台线程中运行的Redis替身, 副本子进程通过TCP连接"""
+    redis = fakeredis.TcpFakeServer(("127.0.0.1", 0), server_type="redis")
+    redis.daemon_threads = True
+    # 替身收到错误回复(如EVALSHA未找到脚本)后会关闭连接, 预先载入脚本, 避免副本首次调用时断开
+    client = fakeredis.FakeRedis(server=redis.fake_server)
+    for script in (SEMAPHORE_ACQUIRE, SEMAPHORE_RENEW, SLIDING_WINDOW, QUOTA_RESERVE, QUOTA_COMMIT):
+        client.script_load(script)
+    threading.Thread(target=redis.serve_forever, daemon=True).start()
+    return redis
+
+
+def check_lease() -> None:
+    """持有名额的副本未释放就退出, 名额在租约到期后才能被其它副本取得"""
+
+    async def main() -> float:
+        server = fakeredis.FakeServer()
+        config = CoordinationConfig(enabled=True, concurrency={"volcengine": 1}, lease=0.5, acquire_timeout=5)
+        crashed = Coordinator(config, fakeredis.FakeAsyncRedis(server=server))
+        other = Coordinator(config, fakeredis.FakeAsyncRedis(server=server))
+        slot = crashed.slot("volcengine")
+        await slot.__aenter__()
+        # 模拟进程退出: 不释放名额, 也不再续约
+        for task in asyncio.all_tasks():
+            if task is not asyncio.current_task():
+                task.cancel()
+        start = time.monotonic()
+        async with other.slot("volcengine"):
+            waited = time.monotonic() - start
+        try:
+            async with other.slot("volcengine"):
+                pass
+        except TimeoutError:
+            raise AssertionError("名额应已释放")
+        return waited
+
+    waited = asyncio.run(main())
+    assert 0.3 < waited < 1.5, waited
+    print(f"lease: slot of a crashed replica reclaimed after {waited * 1000:.0f}ms")
+
+
+def check_partial() -> None:
+    """逐张产出图片的生成被调用方提前结束或中途失败时, 已上传的图片计入用量, 只退还未上传的部分"""
+
+    async def produce(coordinator: Coordinator, fail_after: int | None = None):
+        async with coordinator.generation("volcengine", images=3) as generation:
+            for index in range(3):
+                if index == fail_after:
+                    raise RuntimeError("upstream failed")
+                generation.uploaded = index + 1
+                yield index
+            generation.images = 3
+
+    async def main() -> dict:
+        config = CoordinationConfig(enabled=True, monthly_quota=10)
+        coordinator = Coordinator(config, fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer()))
+        # 调用方取得第一张后停止迭代
+        images = produce(coordinator)
+        await images.__anext__()
+        await images.aclose()
+        # 上传两张后上游失败
+        try:
+            async for _ in produce(coordinator, fail_after=2):
+                pass
+        except RuntimeError:
+            pass
+        return await coordinator.usage()
+
+    usage = run_sync(main())
+    assert usage["images"] == 3 and usage["total_images"] == 3, usage
+    assert usage["volcengine:images"] == 3 and usage["volcengine:failures"] == 1, usage
+    print(f"partial: delivered images kept in usage {usage}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--replicas", type=int, default=3)
+    parser.add_argument("--calls", type=int, default=8, help="每个副本的调用次数")
+    parser.add_argument("--threads", type=int, default=4, help="每个副本的并发调用数")
+    parser.add_argument("--concurrency", type=int, default=2, help="全局并发生成数")
+    parser.add_argument("--rate-limit", type=float, default=4, help="全局每秒请求数")
+    parser.add_argument("--quota", type=int, default=18, help="每月图片总额度")
+    parser.add_argument("--tenant-quota", type=int, default=7, help="每个租户每月图片额度")
+    parser.add_argument("--delay-ms", type=float, default=300, help="智能视觉服务替身的响应延迟")
+    parser.add_argument("--replica", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.replica is not None:
+        replica(args.replica, args.calls, args.threads)
+        return
+
+    image = PROJECT_DIR.joinpath("img.png").read_bytes()
+    for enabled in (False, True):
+        redis = start_redis()
+        with FakeVolcengine([image], response_delay=args.delay_ms / 1000) as volcengine, FakeOss(keep_objects=False) as oss:
+            use_fakes(volcengine=volcengine, oss=oss)
+            start = time.perf_counter()
+            results = run_replicas(args, redis.server_address[1], enabled)
+            elapsed = time.perf_counter() - start
+        redis.shutdown()
+        redis.server_close()
+
+        ok = sum(r["outcomes"].get("ok", 0) for r in results)
+        rejected = sum(r["outcomes"].get("QuotaExceededError", 0) for r in results)
+        peak_rate = volcengine.max_in_window(1)
+        print(
+            f"coordination={'on' if enabled else 'off'}: {ok} ok, {rejected} over quota in {elapsed:.1f}s, "
+            f"upstream max in-flight {volcengine.max_in_flight}, max requests in 1s {peak_rate}"
+        )
+        total = args.calls * args.replicas
+        if not enabled:
+            assert ok == total, results
+            assert volcengine.max_in_flight > args.concurrency, "未启用协调时各副本只按各自的限制并发"
+            continue
+        for result in results:
+            print(f"  {result['usage']} {result['metrics']}")
+        # 每个请求生成一张图片
+        expected = min(args.quota, args.replicas * min(args.calls, args.tenant_quota))
+        assert ok == expected and rejected == total - expected, results
+        assert all(r["usage"]["images"] <= args.tenant_quota for r in results)
+        # 各副本结束时读取总用量, 最后结束的副本读到全部用量
+        assert max(r["usage"]["total_images"] for r in results) == expected, results
+        assert sum(r["usage"]["volcengine:images"] for r in results) == expected
+        assert volcengine.max_in_flight <= args.concurrency, volcengine.max_in_flight
+        # 窗口按Redis时间计算, 替身按到达时间统计, 允许1个请求的误差
+        assert peak_rate <= round(args.rate_limit) + 1, peak_rate
+        assert volcengine.signature_failures == 0
+
+    check_lease()
+    check_partial()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+多租户凭证: 热路径上的租户查找耗时, 对各上游替身的真实鉴权校验, 按租户路由OSS上传和隔离缓存, 空闲租户淘汰
+对比每次调用读取环境变量并构建请求参数(旧实现)与按凭证指纹复用租户对象的开销
+
+python -m benchmarks.bench_credentials -n 100000
+"""
+
+import argparse
+import importlib
+import os
+import time
+import timeit
+
+from dify_plugin.entities.tool import ToolRuntime
+from dify_plugin.errors.tool import ToolProviderCredentialValidationError
+
+from benchmarks.fakes import FakeArk, FakeFileServer, FakeOss, FakeVolcengine, use_fakes
+from tools.prompt_to_image import Create_imageTool
+from utils.aio import run_sync
+from utils.cache import ResultCache, MemoryBackend
+from utils.credentials import CredentialError, CredentialRegistry, get_registry, use_tenant
+from utils.volcengine import Params, params_signer
+
+BODY = {"req_key": "high_aes_general_v30l_zt2i", "prompt": "a cat"}
+
+
+def per_call() -> None:
+    # 旧实现: 每次调用读取环境变量, 重新构建请求参数并查找签名器
+    params = Params(access_key=os.getenv("SEEDREAM_ACCESS_KEY"), secret_key=os.getenv("SEEDREAM_SECRET_KEY"), body=BODY)
+    params_signer(params)
+
+
+def bench_lookup(n: int, credentials: dict) -> None:
+    registry = get_registry()
+
+    def lookup() -> None:
+        registry.get(credentials).volcengine_params(BODY)
+
+    for label, fn in (("per-call env", per_call), ("registry", lookup), ("registry get only", lambda: registry.get(credentials))):
+        seconds = min(timeit.repeat(fn, number=n, repeat=3))
+        print(f"{label:<18} {seconds / n * 1e9:8.0f} ns/op")
+
+
+def expect_invalid(credentials: dict, reason: str) -> None:
+    try:
+        run_sync(get_registry().validate(credentials))
+    except CredentialError as e:
+        assert reason in str(e), e
+        print(f"rejected: {e}")
+        return
+    raise AssertionError(f"凭证应未通过校验: {reason}")
+
+
+def check_validation(volcengine: FakeVolcengine, ark: FakeArk, oss: FakeOss, tenant_b: dict) -> None:
+    tenant = run_sync(get_registry().validate({}))
+    assert tenant.validated_at is not None
+    run_sync(get_registry().validate(tenant_b))
+    expect_invalid({"seedream_secret_key": "wrong"}, "智能视觉服务鉴权失败")
+    expect_invalid({"ark_api_key": "wrong"}, "方舟API Key鉴权失败")
+    expect_invalid({"oss_access_key_secret": "wrong"}, "OSS鉴权失败")
+    expect_invalid({"oss_access_key_id": "unknown"}, "OSS鉴权失败")
+    assert oss.auth_failures == 2 and volcengine.signature_failures == 1, (oss.auth_failures, volcengine.signature_failures)
+
+    # Dify保存供应商配置时调用, 失败时抛出供应商的校验异常
+    provider = importlib.import_module("provider.custom-image-tools").CustomImageToolsProvider()
+    provider._validate_credentials({})
+    try:
+        provider._validate_credentials({"ark_api_key": "wrong"})
+    except ToolProviderCredentialValidationError as e:
+        print(f"provider rejected: {e}")
+    else:
+        raise AssertionError("供应商应拒绝无效凭证")
+    volcengine.signature_failures = 0
+
+
+def check_routing(oss: FakeOss, oss_b: FakeOss, tenant_b: dict) -> None:
+    registry = get_registry()
+    # 校验通过的租户直接复用, 工具调用不再发起校验请求
+    created = registry.created
+    puts_a, puts_b = oss.requests["PUT"], oss_b.requests["PUT"]
+    runtime = ToolRuntime(credentials=tenant_b, user_id=None, session_id=None)
+    messages = list(Create_imageTool(runtime=runtime, session=None)._invoke({"prompt": "a cat"}))
+    url = next(m.message.text for m in messages if m.type.value == "text")
+    assert url.startswith("https://oss-b.bench.local/"), url
+    assert oss_b.requests["PUT"] - puts_b == 1 and oss.requests["PUT"] == puts_a
+    list(Create_imageTool(runtime=None, session=None)._invoke({"prompt": "a cat"}))
+    assert oss.requests["PUT"] - puts_a == 1 and oss_b.requests["PUT"] - puts_b == 1
+    assert registry.created == created, registry.metrics()
+
+    # 相同请求体在不同租户下使用不同的缓存键, 缓存的链接不会返回给其它租户
+    cache = ResultCache(MemoryBackend(16))
+    keys = set()
+    for credentials in ({}, tenant_b):
+        with use_tenant(registry.get(credentials)):
+            keys.add(cache.key(BODY))
+    assert len(keys) == 2, keys
+    print(f"routing: tenant b -> {url}, {registry.metrics()}")
+
+
+def check_eviction() -> None:
+    registry = CredentialRegistry(idle_ttl=0.2, max_tenants=3)
+    tenants = [registry.get({"ark_api_key": f"key-{i}"}) for i in range(3)]
+    assert registry.get({"ark_api_key": "key-0"}) is tenants[0]
+    # 超出上限时淘汰最久未使用的租户
+    registry.get({"ark_api_key": "key-3"})
+    assert registry.metrics()["tenants"] == 3 and registry.get({"ark_api_key": "key-0"}) is tenants[0]
+    assert registry.get({"ark_api_key": "key-1"}) is not tenants[1]
+    # 空闲超过idle_ttl的租户在下次查找时被淘汰
+    time.sleep(0.3)
+    registry.get({"ark_api_key": "key-0"})
+    metrics = registry.metrics()
+    assert metrics["tenants"] == 1, metrics
+    print(f"eviction: {metrics}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=100000, help="查找耗时的调用次数")
+    args = parser.parse_args()
+
+    image = open(os.path.join(os.path.dirname(__file__), "..", "img.png"), "rb").read()
+    with (
+        FakeVolcengine([image]) as volcengine,
+        FakeOss() as oss,
+        FakeOss(access_key_id="tenant-b-ak", access_key_secret="tenant-b-sk") as oss_b,
+        FakeFileServer({"/result.png": image}) as files,
+        FakeArk(files.url + "/result.png") as ark,
+    ):
+        use_fakes(volcengine=volcengine, oss=oss, ark=ark)
+        # 租户B使用自己的OSS, 智能视觉服务和方舟凭证沿用环境变量
+        tenant_b = {
+            "oss_endpoint": oss_b.url,
+            "oss_access_key_id": "tenant-b-ak",
+            "oss_access_key_secret": "tenant-b-sk",
+            "oss_bucket_name": "tenant-b",
+            "oss_domain": "oss-b.bench.local",
+        }
+        bench_lookup(args.n, tenant_b)
+        check_validation(volcengine, ark, oss, tenant_b)
+        check_routing(oss, oss_b, tenant_b)
+        check_eviction()
+        assert volcengine.signature_failures == 0
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+智能视觉服务响应的内存占用: 用tracemalloc统计从响应体到可上传的图片内容过程中的峰值分配
+旧实现: response.json() 解析出完整的base64字符串, b64decode逐张解码, 包成BytesIO交给PIL识别格式
+新实现: 从响应体切出base64的memoryview, a2b_base64直接解码, 只读文件头识别格式
+
+python -m benchmarks.bench_cv_response --images 4 --size 1024
+"""
+
+import argparse
+import base64
+import binascii
+import json
+import os
+import time
+import tracemalloc
+from io import BytesIO
+
+from PIL import Image
+
+from utils.image import detect_image
+from utils.volcengine import parse_cv_response
+
+
+def build_response(count: int, size: int) -> bytes:
+    # 随机噪声图几乎不可压缩, PNG大小接近原始像素
+    images = []
+    for _ in range(count):
+        buffer = BytesIO()
+        Image.frombytes("RGB", (size, size), os.urandom(size * size * 3)).save(buffer, format="PNG", compress_level=1)
+        images.append(base64.b64encode(buffer.getvalue()).decode())
+    body = {"code": 10000, "message": "Success", "data": {"binary_data_base64": images, "image_urls": None}}
+    return json.dumps(body).encode()
+
+
+def legacy(content: bytes) -> list[bytes]:
+    data = json.loads(content)
+    blobs = []
+    for image_base64 in data["data"]["binary_data_base64"]:
+        image_bytes = base64.b64decode(image_base64)
+        Image.open(BytesIO(image_bytes)).format
+        blobs.append(image_bytes)
+    return blobs
+
+
+def lean(content: bytes) -> list[bytes]:
+    data = parse_cv_response(content)
+    blobs = []
+    for image_base64 in data["data"]["binary_data_base64"]:
+        image_bytes = binascii.a2b_base64(image_base64)
+        detect_image(image_bytes)
+        blobs.append(image_bytes)
+    return blobs
+
+
+def measure(func, content: bytes) -> tuple[float, float, list[bytes]]:
+    """返回 (峰值分配字节数, 耗时秒, 结果), 不含响应体本身"""
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    blobs = func(content)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak, elapsed, blobs
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images", type=int, default=4)
+    parser.add_argument("--size", type=int, default=1024, help="图片边长")
+    args = parser.parse_args()
+
+    content = build_response(args.images, args.size)
+    decoded = sum(len(blob) for blob in legacy(content))
+    print(f"response={len(content) / 1024 / 1024:.2f}MB images={args.images} decoded={decoded / 1024 / 1024:.2f}MB")
+
+    results = {}
+    for name, func in (("legacy", legacy), ("lean", lean)):
+        peak, elapsed, blobs = measure(func, content)
+        assert sum(len(blob) for blob in blobs) == decoded
+        results[name] = peak
+        print(
+            f"{name:<7} peak={peak / 1024 / 1024:.2f}MB per_image={peak / args.images / 1024 / 1024:.2f}MB "
+            f"overhead={(peak - decoded) / 1024 / 1024:.2f}MB time={elapsed * 1000:.1f}ms"
+        )
+    # 新实现的额外分配应远小于解码后的图片本身
+    assert results["lean"] - decoded < decoded * 0.1, results
+    assert results["lean"] < results["legacy"] / 2, results
+
+
+if __name__ == "__main__":
+    main()
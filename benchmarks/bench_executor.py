@@ -0,0 +1,126 @@
+"""
+CPU密集型图片处理的工作池: 突发的缩放转码任务对事件循环响应延迟的影响, 以及排队上限的背压
+inline: 在协程中直接执行(旧实现的同步工具即如此), thread: 线程池, process: 进程池
+事件循环上每5ms唤醒一次的探针记录最大延迟, 代表同一循环上网络I/O被耽误的时间
+
+python -m benchmarks.bench_executor --jobs 16 --size 2048
+"""
+
+import argparse
+import asyncio
+import os
+import time
+from io import BytesIO
+
+from PIL import Image
+
+from utils.executor import PoolBusyError, WorkerPool
+from utils.image import CompactOptions, compact_image
+
+
+def build_image(size: int) -> bytes:
+    buffer = BytesIO()
+    Image.frombytes("RGB", (size, size), os.urandom(size * size * 3)).save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def slow_job(seconds: float) -> float:
+    time.sleep(seconds)
+    return seconds
+
+
+async def probe(stop: asyncio.Event, lags: list[float]) -> None:
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.005)
+        lags.append(time.perf_counter() - start - 0.005)
+
+
+async def burst(mode: str, pool: WorkerPool | None, data: bytes, options: CompactOptions, jobs: int) -> dict:
+    stop, lags = asyncio.Event(), []
+    probe_task = asyncio.create_task(probe(stop, lags))
+    await asyncio.sleep(0.05)
+
+    async def job():
+        if pool is None:
+            return compact_image(data, options)
+        return await pool.run(compact_image, data, options)
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(job() for _ in range(jobs)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await probe_task
+    assert all(result.format == "jpeg" for result in results)
+    return {"mode": mode, "elapsed": elapsed, "max_lag_ms": max(lags) * 1000, "probes": len(lags)}
+
+
+async def check_backpressure() -> None:
+    # 2个工作线程 + 排队2个, 其余调用方等待空位
+    pool = WorkerPool("bp", max_workers=2, max_queue=2, max_wait=None)
+    peak = {"admitted": 0, "waiting": 0}
+
+    async def sample():
+        while True:
+            metrics = pool.metrics()
+            peak["admitted"] = max(peak["admitted"], metrics["running"] + metrics["queued"])
+            peak["waiting"] = max(peak["waiting"], metrics["waiting"])
+            await asyncio.sleep(0.005)
+
+    sampler = asyncio.create_task(sample())
+    await asyncio.gather(*(pool.run(slow_job, 0.05) for _ in range(20)))
+    sampler.cancel()
+    metrics = pool.metrics()
+    assert pool.admitted == 0 and metrics["completed"] == 20
+    assert peak["admitted"] <= 4, peak
+    assert peak["waiting"] >= 10, peak
+    assert metrics["max_wait_seconds"] >= 0.2, metrics
+    print(f"backpressure: peak={peak} avg_wait={metrics['avg_wait_seconds']}s max_wait={metrics['max_wait_seconds']}s")
+
+    # 等待空位超过max_wait时拒绝, 不在内存中继续堆积
+    pool = WorkerPool("busy", max_workers=1, max_queue=1, max_wait=0.05)
+    results = await asyncio.gather(*(pool.run(slow_job, 0.2) for _ in range(6)), return_exceptions=True)
+    busy = sum(isinstance(result, PoolBusyError) for result in results)
+    assert busy == 4, results
+    assert pool.metrics()["rejected"] == 4
+    # 同步调用方与协程共用同一组空位
+    assert pool.run_sync(slow_job, 0.01) == 0.01
+    print(f"rejected after max_wait: {busy}/6, metrics={pool.metrics()}")
+    pool.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, default=16, help="突发的缩放转码任务数")
+    parser.add_argument("--size", type=int, default=2048)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    data = build_image(args.size)
+    options = CompactOptions(max_dimension=1024, format="jpeg")
+    thread_pool = WorkerPool("thread", args.workers, args.jobs)
+    process_pool = WorkerPool("process", args.workers, args.jobs, processes=True)
+    # 预先启动子进程, 不计入对比
+    process_pool.run_sync(compact_image, data, options)
+
+    async def run():
+        results = []
+        for mode, pool in (("inline", None), ("thread", thread_pool), ("process", process_pool)):
+            results.append(await burst(mode, pool, data, options, args.jobs))
+        await check_backpressure()
+        return results
+
+    results = asyncio.run(run())
+    for result in results:
+        print(
+            f"{result['mode']:<8} jobs={args.jobs} workers={args.workers} elapsed={result['elapsed'] * 1000:.0f}ms "
+            f"max_loop_lag={result['max_lag_ms']:.1f}ms probes={result['probes']}"
+        )
+    inline, _, process = results
+    assert process["max_lag_ms"] < inline["max_lag_ms"], "进程池应显著降低事件循环延迟"
+    thread_pool.shutdown()
+    process_pool.shutdown()
+
+
+if __name__ == "__main__":
+    main()
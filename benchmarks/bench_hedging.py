@@ -0,0 +1,116 @@
+"""
+尾延迟控制: 方舟替身每隔若干个响应卡住一段时间, 对比关闭/开启对冲请求时的p50/p99
+熔断: 主端点持续返回503, 失败时改用备用端点, 熔断后直接使用备用端点, 到期后探测恢复
+
+python -m benchmarks.bench_hedging --requests 40 --stall-every 8 --stall 2
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+
+from benchmarks.fakes import FakeArk, use_fakes
+from tools.image_edit import ark_generate
+from utils import resilience
+from utils.aio import run_sync
+from utils.config import BreakerConfig, HedgeConfig, UpstreamRateLimit, settings
+
+MODEL = "doubao-seededit-3-0-i2i-250628"
+
+
+def call(url: str) -> int:
+    payload = {"model": MODEL, "prompt": "edit", "image": "https://example.com/a.png", "response_format": "url"}
+    response = run_sync(ark_generate(url, {"Authorization": "Bearer fake-key"}, payload))
+    return response.status_code
+
+
+def measure(url: str, count: int) -> list[float]:
+    latencies = []
+    for _ in range(count):
+        start = time.perf_counter()
+        assert call(url) == 200
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def summary(latencies: list[float]) -> str:
+    quantiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    return f"p50={quantiles[49] * 1000:.0f}ms p99={quantiles[98] * 1000:.0f}ms max={max(latencies) * 1000:.0f}ms"
+
+
+def check_hedge_failure() -> None:
+    """对冲请求先返回的失败结果不算胜出, 等待另一个请求的成功结果"""
+
+    async def main() -> int:
+        tracker = resilience.LatencyTracker(HedgeConfig(initial_delay=0.05))
+        calls = 0
+
+        async def send() -> int:
+            nonlocal calls
+            calls += 1
+            # 首个请求较慢但成功, 对冲请求很快返回503
+            if calls == 1:
+                await asyncio.sleep(0.3)
+                return 200
+            await asyncio.sleep(0.01)
+            return 503
+
+        return await resilience.hedged(send, tracker, lambda status: status >= 500)
+
+    assert run_sync(main()) == 200
+    print("hedge: fast 503 from the hedge did not beat the slower success")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=40)
+    parser.add_argument("--stall-every", type=int, default=8, help="每隔多少个响应卡住一次")
+    parser.add_argument("--stall", type=float, default=2, help="卡住的秒数")
+    args = parser.parse_args()
+
+    settings.ratelimit.ark = UpstreamRateLimit(rate_limit=1000, max_attempts=1)
+    settings.hedge = HedgeConfig(enabled=False, percentile=0.9, initial_delay=0.3, min_delay=0.1, min_samples=10)
+
+    with FakeArk("http://127.0.0.1/result.png", response_delay=0.05) as primary, FakeArk(
+        "http://127.0.0.1/result.png", response_delay=0.05
+    ) as fallback:
+        use_fakes(ark=primary)
+        url = primary.url + "/api/v3/images/generations"
+
+        primary.stall(every=args.stall_every, every_seconds=args.stall)
+        baseline = measure(url, args.requests)
+        print(f"hedge off: {summary(baseline)}")
+
+        settings.hedge.enabled = True
+        resilience._trackers.clear()
+        hedged = measure(url, args.requests)
+        print(f"hedge on:  {summary(hedged)} {resilience.get_tracker(url).metrics()}")
+        assert max(hedged) < max(baseline) / 2
+        primary.stall(every=None)
+
+        # 熔断: 主端点持续503
+        settings.hedge.enabled = False
+        settings.breaker = BreakerConfig(
+            min_requests=5, window=10, open_seconds=3, fallback_urls={url: fallback.url + "/api/v3/images/generations"}
+        )
+        resilience._breakers.clear()
+        primary.requests.clear()
+        primary.inject(*[503] * 100)
+        statuses = [call(url) for _ in range(20)]
+        # 熔断前主端点返回503时同样改用备用端点, 熔断后不再请求主端点
+        assert statuses.count(200) == 20, statuses
+        assert primary.requests["POST"] == 5 and fallback.requests["POST"] == 20, (primary.requests, fallback.requests)
+        print(f"breaker open: primary={primary.requests['POST']} fallback={fallback.requests['POST']}")
+
+        # 熔断到期后放行探测请求, 主端点恢复后关闭熔断
+        primary.failures.clear()
+        time.sleep(3.1)
+        assert call(url) == 200
+        assert resilience.get_breaker(url).state == "closed"
+        print(f"breaker closed after probe: {resilience.resilience_metrics()}")
+    check_hedge_failure()
+
+
+if __name__ == "__main__":
+    main()
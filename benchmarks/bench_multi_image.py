@@ -0,0 +1,87 @@
+"""
+多图响应端到端延迟: 对比逐张解码上传(旧实现)与异步并发解码上传
+OSS替身每个请求固定延迟, 并发时总耗时应接近单张上传耗时;
+另统计流式读取响应(逐张上传)时首条消息的延迟, 每张图片上传完成后立即返回, 不等待其余图片
+
+python -m benchmarks.bench_multi_image --images 4 --oss-ms 200
+"""
+
+import argparse
+import base64
+import json
+import os
+import time
+from pathlib import Path
+
+from benchmarks.fakes import FakeOss, FakeVolcengine, use_fakes
+from tools.prompt_to_image import Create_imageTool, RequestBody
+from utils.config import settings
+from utils.http_client import get_client
+from utils.image import detect_image, upload_image
+from utils.volcengine import Params, build_url, create_header
+
+
+def invoke_sequential(prompt: str) -> list[str]:
+    # 旧实现: 同步调用后逐张解码上传
+    body = RequestBody(req_key="high_aes_general_v30l_zt2i", prompt=prompt).model_dump(
+        exclude_unset=True, exclude_none=True
+    )
+    params = Params(access_key=os.getenv("SEEDREAM_ACCESS_KEY"), secret_key=os.getenv("SEEDREAM_SECRET_KEY"), body=body)
+    response = get_client("volcengine").post(build_url(params), content=json.dumps(body), headers=create_header(params))
+    urls = []
+    for image_base64 in response.json()["data"]["binary_data_base64"]:
+        image_bytes = base64.b64decode(image_base64)
+        info = detect_image(image_bytes)
+        urls.append(upload_image(f"image.{info.format}", image_bytes, prefix="seedream"))
+    return urls
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images", type=int, default=4, help="每次响应返回的图片数")
+    parser.add_argument("--oss-ms", type=float, default=200, help="OSS替身每个请求的延迟")
+    parser.add_argument("--cv-ms", type=float, default=100, help="CVProcess替身的延迟")
+    parser.add_argument("-n", type=int, default=5)
+    args = parser.parse_args()
+
+    image = Path(__file__).parent.parent.joinpath("img.png").read_bytes()
+    with (
+        FakeVolcengine([image] * args.images, response_delay=args.cv_ms / 1000) as volcengine,
+        FakeOss(response_delay=args.oss_ms / 1000, keep_objects=False) as oss,
+    ):
+        use_fakes(volcengine=volcengine, oss=oss)
+        tool = Create_imageTool(runtime=None, session=None)
+        for label, run in (
+            ("sequential", lambda: invoke_sequential("a cat")),
+            ("async", lambda: list(tool._invoke({"prompt": "a cat"}))),
+        ):
+            run()  # 预热连接
+            latencies = []
+            for _ in range(args.n):
+                start = time.perf_counter()
+                run()
+                latencies.append((time.perf_counter() - start) * 1000)
+            print(f"{label:<10} images={args.images} mean={sum(latencies) / len(latencies):.1f}ms min={min(latencies):.1f}ms")
+
+        check_streaming(tool, args.images, args.oss_ms / 1000)
+
+
+def check_streaming(tool: Create_imageTool, images: int, oss_delay: float) -> None:
+    settings.volcengine.stream_response = True
+    start = time.perf_counter()
+    first = None
+    urls = []
+    for message in tool._invoke({"prompt": "a cat"}):
+        first = first or time.perf_counter() - start
+        if message.type.value == "text":
+            urls.append(message.message.text.strip())
+    total = time.perf_counter() - start
+    settings.volcengine.stream_response = False
+    print(f"{'streaming':<10} images={images} first_message={first * 1000:.1f}ms total={total * 1000:.1f}ms")
+    # 每张图片各自返回链接, 第一张在其余图片上传之前返回
+    assert len(set(urls)) == images, urls
+    assert first < total - oss_delay * (images - 1) * 0.8, (first, total)
+
+
+if __name__ == "__main__":
+    main()
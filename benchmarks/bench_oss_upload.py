@@ -0,0 +1,57 @@
+"""
+OSS上传压测: 对比每次新建Bucket(旧实现)与进程级复用连接池的上传延迟
+
+python -m benchmarks.bench_oss_upload -n 200 --handshake-ms 20
+"""
+
+import argparse
+import statistics
+import time
+from pathlib import Path
+
+import oss2
+
+from benchmarks.fakes import FakeOss
+from utils.image import OssUploader
+
+BUCKET = "bench"
+ACCESS_KEY = ("fake-ak", "fake-sk")
+
+
+def upload_unpooled(endpoint: str, data: bytes) -> None:
+    # 旧实现: 每次调用都新建Auth/Bucket, 即新建Session和连接
+    bucket = oss2.Bucket(oss2.Auth(*ACCESS_KEY), endpoint, BUCKET)
+    bucket.put_object("seedream/unpooled.png", data)
+
+
+def run(label: str, n: int, fn) -> list[float]:
+    latencies = []
+    for _ in range(n):
+        start = time.perf_counter()
+        fn()
+        latencies.append((time.perf_counter() - start) * 1000)
+    print(
+        f"{label:<10} n={n} mean={statistics.mean(latencies):.2f}ms "
+        f"p50={statistics.median(latencies):.2f}ms max={max(latencies):.2f}ms"
+    )
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=200)
+    parser.add_argument("--handshake-ms", type=float, default=20, help="每个新连接模拟的握手耗时")
+    args = parser.parse_args()
+
+    data = Path(__file__).parent.parent.joinpath("img.png").read_bytes()
+    with FakeOss(handshake_delay=args.handshake_ms / 1000) as oss:
+        run("unpooled", args.n, lambda: upload_unpooled(oss.url, data))
+        unpooled_connections = oss.connections
+
+        uploader = OssUploader(oss.url, *ACCESS_KEY, BUCKET)
+        run("pooled", args.n, lambda: uploader.upload("img.png", data, prefix="seedream"))
+        print(f"connections: unpooled={unpooled_connections} pooled={oss.connections - unpooled_connections}")
+
+
+if __name__ == "__main__":
+    main()
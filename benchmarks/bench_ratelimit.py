@@ -0,0 +1,91 @@
+"""
+限流与重试: 替身服务按QPS上限返回429(携带Retry-After), 并按顺序注入429/503
+限流器从较高的初始速率自动下调, 全部请求最终成功
+
+python -m benchmarks.bench_ratelimit --requests 40 --server-qps 4
+"""
+
+import argparse
+import asyncio
+import io
+import os
+import time
+
+from PIL import Image
+
+from benchmarks.fakes import FakeArk, FakeFileServer, FakeOss, FakeVolcengine, use_fakes
+from tools.image_edit import ImageToImageTool
+from utils.aio import run_sync
+from utils.config import UpstreamRateLimit, settings
+from utils.ratelimit import get_limiter, limiter_metrics
+from utils.volcengine import Params, cv_process
+
+
+def params(prompt: str) -> Params:
+    return Params(
+        access_key=os.getenv("SEEDREAM_ACCESS_KEY"),
+        secret_key=os.getenv("SEEDREAM_SECRET_KEY"),
+        body={"req_key": "high_aes_general_v30l_zt2i", "prompt": prompt},
+    )
+
+
+async def burst(count: int) -> list[dict]:
+    return await asyncio.gather(*(cv_process(params(f"prompt {i}")) for i in range(count)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=40)
+    parser.add_argument("--server-qps", type=float, default=4, help="替身服务每秒接受的请求数")
+    parser.add_argument("--client-qps", type=float, default=20, help="限流器初始速率")
+    args = parser.parse_args()
+
+    settings.ratelimit.volcengine = UpstreamRateLimit(
+        rate_limit=args.client_qps, max_attempts=10, backoff_base=0.2, deadline=60
+    )
+    settings.ratelimit.ark = UpstreamRateLimit(rate_limit=args.client_qps, backoff_base=0.1)
+
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 64), "red").save(buffer, format="PNG")
+    png = buffer.getvalue()
+
+    with FakeVolcengine([png]) as volcengine, FakeOss() as oss, FakeFileServer({"/result.png": png}) as files:
+        with FakeArk(files.url + "/result.png") as ark:
+            use_fakes(volcengine=volcengine, oss=oss, ark=ark)
+
+            # 按顺序注入的错误逐个重试后成功
+            volcengine.inject(503, 429, 503, retry_after=0.2)
+            result = run_sync(cv_process(params("single")))
+            assert result["code"] == 10000, result
+            assert sum(volcengine.rejected.values()) == 3, volcengine.rejected
+
+            # 超出服务端QPS时自动降速
+            volcengine.inject(retry_after=1, max_qps=args.server_qps)
+            start = time.perf_counter()
+            results = run_sync(burst(args.requests))
+            elapsed = time.perf_counter() - start
+            assert all(result["code"] == 10000 for result in results)
+            metrics = get_limiter("volcengine", "high_aes_general_v30l_zt2i").metrics()
+            assert metrics["rate"] < args.client_qps, metrics
+            # 降速后大部分请求不再被拒绝
+            assert volcengine.rejected[429] < args.requests / 2, volcengine.rejected
+            print(
+                f"volcengine: requests={args.requests} elapsed={elapsed:.2f}s "
+                f"rejected={dict(volcengine.rejected)} limiter={metrics}"
+            )
+
+            # 同步工具调用方舟接口
+            ark.inject(429, 503, retry_after=0.1)
+            tool = ImageToImageTool(runtime=None, session=None)
+            messages = list(tool._invoke({"prompt": "edit", "image": files.url + "/result.png"}))
+            # 图片编辑先以JSON消息返回上游链接, 取第一条文本消息
+            text = next(m.message.text for m in messages if m.type.value == "text")
+            assert text.startswith("http"), text
+            assert sum(ark.rejected.values()) == 2, ark.rejected
+            print(f"ark: rejected={dict(ark.rejected)} url={text}")
+
+    print(limiter_metrics())
+
+
+if __name__ == "__main__":
+    main()
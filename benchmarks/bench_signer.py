@@ -0,0 +1,139 @@
+"""
+火山引擎签名: 校验已知签名向量, 并对比每次重新派生密钥(旧实现)与缓存签名器的每秒签名数
+
+python -m benchmarks.bench_signer -n 50000
+"""
+
+import argparse
+import hashlib
+import hmac
+import json
+import time
+from datetime import datetime, timezone
+
+import httpx
+
+from utils.volcengine import Params, Signer, canonical_query, dump_body, get_signature_key
+
+NOW = datetime(2025, 6, 10, 8, 30, 15, tzinfo=timezone.utc)
+
+# 由改造前的 create_header 在 NOW 时刻计算得到
+VECTORS = [
+    (
+        Params(
+            access_key="AKLTexample",
+            secret_key="c2VjcmV0LWV4YW1wbGU=",
+            body={"req_key": "high_aes_general_v30l_zt2i", "prompt": "一只猫", "seed": 42},
+        ),
+        "bbfa3f826d9b3f3541a21f982e4297d23fd0fc70fedd6abac21aab4dfc4f021f",
+        "81da797cc1d479b432ecb617368f886ecf57a1fdc565dbf6eaebf64aa0dc69b1",
+    ),
+    (
+        Params(
+            access_key="AKLTother",
+            secret_key="other-secret",
+            body={"req_key": "i2i_portrait_photo", "image_input": "https://x/y.png", "prompt": "portrait"},
+            query_params={"Version": "2022-08-31", "Action": "CVProcess"},
+        ),
+        "891183dc138637d44b66c70e95ab8452475d0e2fa8ac44782158291ecf1cb455",
+        "e51b2690525870e99bc731d6a1ac740553a7a6c3ec47f785342a29b250e508b4",
+    ),
+]
+
+# 与本仓库实现无关的向量: 由火山引擎官方Python SDK(volcengine 1.0.150)的 SignerV4.sign_only 计算.
+# 参数取自SDK示例 volcengine/example/DemoSignOnly.py(ak/sk、时间戳1640712206、IAM ListUsers查询),
+# 本仓库的签名固定包含content-type, 因此两个向量都带 Content-Type: application/json
+SDK_NOW = datetime.fromtimestamp(1640712206, timezone.utc)
+SDK_VECTORS = [
+    (
+        "iam",
+        "GET",
+        "open.volcengineapi.com",
+        "Action=ListUsers&Version=2018-01-01&Limit=5&Offset=0",
+        b"",
+        "HMAC-SHA256 Credential=ak/20211228/cn-north-1/iam/request, "
+        "SignedHeaders=content-type;host;x-content-sha256;x-date, "
+        "Signature=74ed322bad1e6875d9e7cca7adc177ce48305d2afcf92d7d10c29f48c85333a9",
+    ),
+    (
+        "cv",
+        "POST",
+        "visual.volcengineapi.com",
+        "Action=CVProcess&Version=2022-08-31",
+        dump_body({"req_key": "high_aes_general_v30l_zt2i", "prompt": "一只猫", "seed": 42}),
+        "HMAC-SHA256 Credential=ak/20211228/cn-north-1/cv/request, "
+        "SignedHeaders=content-type;host;x-content-sha256;x-date, "
+        "Signature=253030011a5cb2eaabdec2a373730d83abf1a925d384110158246ada3a78da7c",
+    ),
+]
+
+
+def legacy_sign(params: Params, now: datetime) -> dict:
+    # 旧实现: 每次序列化请求体、解析URL并重新派生签名密钥
+    signed_headers = "content-type;host;x-content-sha256;x-date"
+    payload_hash = hashlib.sha256(json.dumps(params.body).encode("utf-8")).hexdigest()
+    current_datetime = now.strftime("%Y%m%dT%H%M%SZ")
+    current_date = now.strftime("%Y%m%d")
+    host = httpx.URL(params.base_url).host
+    canonical_headers = (
+        f"content-type:application/json\nhost:{host}\nx-content-sha256:{payload_hash}\nx-date:{current_datetime}\n"
+    )
+    credential_scope = f"{current_date}/{params.region}/{params.service}/request"
+    canonical_request = f"{params.method}\n/\n{params.query_params}\n{canonical_headers}\n{signed_headers}\n{payload_hash}"
+    string_to_sign = f"{params.algorithm}\n{current_datetime}\n{credential_scope}\n{hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()}"
+    signing_key = get_signature_key(params.secret_key, current_date, params.region, params.service)
+    signature = hmac.new(signing_key, string_to_sign.encode("utf-8"), hashlib.sha256).hexdigest()
+    return {"Authorization": signature}
+
+
+class FixedTimeSigner(Signer):
+    def current_time(self) -> datetime:
+        return NOW
+
+
+def check_vectors() -> None:
+    for params, payload_hash, signature in VECTORS:
+        signer = FixedTimeSigner(params.access_key, params.secret_key)
+        query = httpx.URL(params.base_url, params=params.query_params).query.decode()
+        headers = signer.sign("POST", "visual.volcengineapi.com", canonical_query(query), dump_body(params.body))
+        assert headers["X-Content-Sha256"] == payload_hash, headers
+        assert headers["Authorization"].endswith(f"Signature={signature}"), headers
+
+        # 作为httpx的auth使用时, 签名基于实际发送的请求
+        request = httpx.Request("POST", params.base_url, params=params.query_params, content=dump_body(params.body))
+        request.headers["Content-Type"] = "application/json"
+        signed = next(signer.auth_flow(request))
+        assert signed.headers["Authorization"].endswith(f"Signature={signature}"), signed.headers
+
+    for service, method, host, query, body, authorization in SDK_VECTORS:
+        signer = Signer("ak", "sk", service=service)
+        headers = signer.sign(method, host, canonical_query(query), body, now=SDK_NOW)
+        assert headers["X-Date"] == "20211228T172326Z", headers
+        assert headers["Authorization"] == authorization, headers
+    print(f"vectors ok ({len(VECTORS)} regression, {len(SDK_VECTORS)} from the official SDK)")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=50000)
+    args = parser.parse_args()
+
+    check_vectors()
+    params = VECTORS[0][0]
+    signer = Signer(params.access_key, params.secret_key)
+    body = dump_body(params.body)
+    query = canonical_query(params.query_params)
+
+    for label, fn in (
+        ("legacy", lambda: legacy_sign(params, datetime.now(timezone.utc))),
+        ("signer", lambda: signer.sign("POST", "visual.volcengineapi.com", query, body)),
+    ):
+        start = time.perf_counter()
+        for _ in range(args.n):
+            fn()
+        elapsed = time.perf_counter() - start
+        print(f"{label:<8} {args.n / elapsed:>10.0f} signatures/s  {elapsed / args.n * 1e6:.2f}us/op")
+
+
+if __name__ == "__main__":
+    main()
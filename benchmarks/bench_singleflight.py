@@ -0,0 +1,155 @@
+"""
+相同请求合并: 突发流量中大量相同的文生图/图片编辑请求同时到达, 只调用一次上游并共享OSS链接和图片内容
+对比未启用合并(旧实现)时每个请求各自调用上游的次数; 未固定随机种子的请求只在窗口内合并
+
+python -m benchmarks.bench_singleflight -n 16
+"""
+
+import argparse
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from dify_plugin.entities.tool import ToolRuntime
+
+from benchmarks.fakes import FakeArk, FakeFileServer, FakeOss, FakeVolcengine, use_fakes
+from tools.image_edit import ImageToImageTool
+from tools.prompt_to_image import Create_imageTool
+from utils.aio import run_sync
+from utils.config import SingleFlightConfig, settings
+from utils.singleflight import SingleFlight, get_singleflight
+
+PROJECT_DIR = Path(__file__).parent.parent
+
+
+def burst(n: int, invoke, parameters: list[dict]) -> tuple[list[str], float]:
+    """同时发起n个调用, 返回各调用输出的链接"""
+
+    def call(i: int) -> str:
+        messages = list(invoke(parameters[i % len(parameters)]))
+        return next(m.message.text for m in messages if m.type.value == "text")
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(n) as executor:
+        urls = list(executor.map(call, range(n)))
+    return urls, time.perf_counter() - start
+
+
+def check_seeded(n: int, volcengine: FakeVolcengine, oss: FakeOss) -> None:
+    singleflight = get_singleflight()
+    invoke = Create_imageTool(runtime=None, session=None)._invoke
+    for enabled in (False, True):
+        singleflight.config.enabled = enabled
+        posts, puts = volcengine.requests["POST"], oss.requests["PUT"]
+        urls, elapsed = burst(n, invoke, [{"prompt": f"a cat {enabled}", "seed": 42}])
+        calls = volcengine.requests["POST"] - posts
+        print(
+            f"seeded singleflight={'on' if enabled else 'off'}: {n} calls -> {calls} upstream, "
+            f"{oss.requests['PUT'] - puts} uploads, {len(set(urls))} urls in {elapsed:.2f}s"
+        )
+        if not enabled:
+            assert calls == n, calls
+            continue
+        assert calls == 1 and oss.requests["PUT"] - puts == 1 and len(set(urls)) == 1, (calls, urls)
+
+    # 不同租户的结果保存在各自的OSS, 不合并
+    runtime = ToolRuntime(credentials={"oss_domain": "tenant-b.bench.local"}, user_id=None, session_id=None)
+    posts = volcengine.requests["POST"]
+    invokes = [Create_imageTool(runtime=None, session=None)._invoke, Create_imageTool(runtime=runtime, session=None)._invoke]
+    with ThreadPoolExecutor(4) as executor:
+        list(executor.map(lambda i: list(invokes[i % 2]({"prompt": "tenant", "seed": 7})), range(4)))
+    assert volcengine.requests["POST"] - posts == 2, volcengine.requests
+
+
+def check_unseeded(n: int, volcengine: FakeVolcengine, delay: float) -> None:
+    config = get_singleflight().config
+    invoke = Create_imageTool(runtime=None, session=None)._invoke
+    # 窗口为0(默认)时未固定随机种子的请求各自生成不同的图片
+    posts = volcengine.requests["POST"]
+    burst(n, invoke, [{"prompt": "unseeded"}])
+    assert volcengine.requests["POST"] - posts == n
+
+    config.unseeded_window = delay * 2
+    posts = volcengine.requests["POST"]
+    urls, _ = burst(n, invoke, [{"prompt": "unseeded"}])
+    assert volcengine.requests["POST"] - posts == 1 and len(set(urls)) == 1, urls
+
+    # 首个请求开始超过窗口后到达的请求重新调用, 即使首个请求仍未完成
+    config.unseeded_window = delay / 3
+    posts = volcengine.requests["POST"]
+    with ThreadPoolExecutor(2) as executor:
+        first = executor.submit(lambda: list(invoke({"prompt": "late"})))
+        time.sleep(delay / 2)
+        list(invoke({"prompt": "late"}))
+        first.result()
+    assert volcengine.requests["POST"] - posts == 2
+    config.unseeded_window = 0
+    print("unseeded: coalesced only within the window")
+
+
+def check_edit(n: int, ark: FakeArk, files: FakeFileServer, oss: FakeOss) -> None:
+    posts, gets, puts = ark.requests["POST"], files.requests["GET"], oss.requests["PUT"]
+    invoke = ImageToImageTool(runtime=None, session=None)._invoke
+    urls, elapsed = burst(n, invoke, [{"prompt": "make it blue", "image": files.url + "/input.png"}])
+    calls = ark.requests["POST"] - posts
+    print(
+        f"seededit: {n} calls -> {calls} upstream, {files.requests['GET'] - gets} downloads, "
+        f"{oss.requests['PUT'] - puts} uploads in {elapsed:.2f}s"
+    )
+    assert calls == 1 and files.requests["GET"] - gets == 1 and len(set(urls)) == 1, urls
+    assert oss.requests["PUT"] - puts == 1
+
+
+def check_cancel() -> None:
+    """首个等待方被取消时, 正在进行的调用继续完成, 其它等待方照常得到结果"""
+
+    async def main() -> None:
+        singleflight = SingleFlight(SingleFlightConfig())
+        calls = 0
+
+        async def call() -> str:
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.1)
+            return "done"
+
+        leader = asyncio.ensure_future(singleflight.do({"prompt": "x"}, call, True))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(singleflight.do({"prompt": "x"}, call, True))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        assert await follower == "done" and calls == 1
+        assert singleflight.metrics() == {"calls": 1, "coalesced": 1, "saved_rate": 0.5, "in_flight": 0}
+
+    run_sync(main())
+    print("cancel: follower unaffected by leader cancellation")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=16, help="同时到达的相同请求数")
+    parser.add_argument("--delay-ms", type=float, default=300, help="上游替身的响应延迟")
+    args = parser.parse_args()
+    delay = args.delay_ms / 1000
+
+    # 只测合并, 结果缓存会让后续请求直接命中
+    settings.cache.backend = "none"
+    image = PROJECT_DIR.joinpath("img.png").read_bytes()
+    with (
+        FakeVolcengine([image], response_delay=delay) as volcengine,
+        FakeOss(keep_objects=False) as oss,
+        FakeFileServer({"/result.png": image, "/input.png": image}) as files,
+        FakeArk(files.url + "/result.png", response_delay=delay) as ark,
+    ):
+        use_fakes(volcengine=volcengine, oss=oss, ark=ark)
+        check_seeded(args.n, volcengine, oss)
+        check_unseeded(args.n, volcengine, delay)
+        check_edit(args.n, ark, files, oss)
+        assert volcengine.signature_failures == 0
+    check_cancel()
+    print(f"metrics: {get_singleflight().metrics()}")
+
+
+if __name__ == "__main__":
+    main()
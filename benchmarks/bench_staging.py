@@ -0,0 +1,105 @@
+"""
+输入图片暂存: 连续编辑同一张图时只上传一次, 尺寸调整到512~2048, 临近过期时重新上传
+对比每次调用都上传输入图(旧实现)与按内容哈希暂存的OSS上传次数和耗时
+
+python -m benchmarks.bench_staging -n 10 --size 3000x2000
+"""
+
+import argparse
+import os
+import time
+from io import BytesIO
+
+from dify_plugin.file.file import File
+from PIL import Image
+
+from benchmarks.fakes import FakeFileServer, FakeOss, FakeVolcengine, use_fakes
+from utils.aio import run_sync
+from utils.cache import MemoryBackend
+from utils.config import StagingConfig, settings
+from tools.image_to_image import ImageToImageTool
+from utils.image import upload_image_async
+from utils.staging import InputStager, get_stager
+
+
+def build_image(width: int, height: int, img_format: str = "JPEG") -> bytes:
+    buffer = BytesIO()
+    Image.frombytes("RGB", (width, height), os.urandom(width * height * 3)).save(buffer, format=img_format)
+    return buffer.getvalue()
+
+
+def check_sizes(stager) -> None:
+    # 超大图缩小到最长边2048, 过小的图放大到最短边512, 范围内的JPEG原样上传
+    for size, expected in (((3000, 2000), (2048, 1365)), ((300, 400), (512, 683)), ((1024, 768), (1024, 768))):
+        data = build_image(*size)
+        staged = run_sync(stager.stage(data))
+        assert (staged.width, staged.height) == expected, (size, staged)
+        assert 512 <= min(expected) and max(expected) <= 2048
+        if size == (1024, 768):
+            assert staged.size == len(data), "范围内的图片不应重新编码"
+        print(f"size {size[0]}x{size[1]} -> {staged.width}x{staged.height} {staged.format} {staged.size}B")
+
+
+def check_expiry(oss: FakeOss) -> None:
+    stager = InputStager(MemoryBackend(), StagingConfig(ttl=3, margin=2))
+    data = build_image(600, 600)
+    puts = oss.requests["PUT"]
+    first = run_sync(stager.stage(data))
+    assert run_sync(stager.stage(data)).url == first.url
+    assert oss.requests["PUT"] - puts == 1
+    # 剩余有效期不足margin时不再复用, 重新上传以重新开始生命周期计时
+    time.sleep(1.1)
+    second = run_sync(stager.stage(data))
+    assert oss.requests["PUT"] - puts == 2, oss.requests
+    assert second.expires_at > first.expires_at
+    print(f"expiry: reuploaded after margin, stats={stager.stats()}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=10, help="同一张输入图的连续调用次数")
+    parser.add_argument("--size", default="3000x2000")
+    parser.add_argument("--oss-ms", type=float, default=50, help="OSS替身每个请求的延迟")
+    args = parser.parse_args()
+    width, height = map(int, args.size.split("x"))
+
+    source = build_image(width, height)
+    result = build_image(64, 64, "PNG")
+    with (
+        FakeVolcengine([result]) as volcengine,
+        FakeOss(response_delay=args.oss_ms / 1000) as oss,
+        FakeFileServer({"/files/input.jpg": source}) as files,
+    ):
+        use_fakes(volcengine=volcengine, oss=oss)
+        settings.files_url = files.url
+
+        tool = ImageToImageTool(runtime=None, session=None)
+        image = File(url="/files/input.jpg", filename="input.jpg", type="image")
+
+        async def legacy_upload():
+            return await upload_image_async("input.jpg", source, prefix="seedream")
+
+        start = time.perf_counter()
+        for _ in range(args.n):
+            run_sync(legacy_upload())
+        legacy = time.perf_counter() - start
+
+        puts = oss.requests["PUT"]
+        start = time.perf_counter()
+        for _ in range(args.n):
+            messages = list(tool._invoke({"prompt": "a portrait", "image": image}))
+            assert messages, "工具未返回结果"
+        staged = time.perf_counter() - start
+        staged_keys = [key for key in oss.objects if "/staging/" in key]
+        assert len(staged_keys) == 1, staged_keys
+        assert oss.requests["PUT"] - puts == args.n + 1, oss.requests
+        assert get_stager().stats()["hits"] == args.n - 1
+        print(f"legacy upload x{args.n}: {legacy * 1000:.1f}ms, {len(source)}B each")
+        print(f"image_to_image x{args.n}: input uploads=1, total={staged * 1000:.1f}ms, stats={get_stager().stats()}")
+
+        check_sizes(get_stager())
+        check_expiry(oss)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+插件冷启动: 用 python -X importtime 统计加载provider及全部工具模块的耗时
+dify_plugin自身(及其依赖的httpx/pydantic等)先行导入, 单独计时, 预算只约束本插件模块在其之上增加的耗时
+同时检查启动阶段没有加载配置文件, 也没有导入oss2/PIL等重量级模块, 超出预算时以非零状态退出
+
+python -m benchmarks.bench_startup --runs 5 --budget-ms 150
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+import yaml
+
+PROJECT_DIR = Path(__file__).parent.parent
+# 首次调用时才需要的模块, 不应在启动阶段导入
+LAZY_MODULES = ["oss2", "PIL"]
+
+LOADER = """
+import importlib.util, json, sys
+sys.path.insert(0, {project_dir!r})
+import dify_plugin
+for index, source in enumerate({sources!r}):
+    spec = importlib.util.spec_from_file_location(f"plugin_source_{{index}}", source)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+import utils.config
+print(json.dumps({{
+    "settings_loaded": utils.config._settings is not None,
+    "lazy_imported": [name for name in {lazy!r} if name in sys.modules],
+}}))
+"""
+
+
+def plugin_sources() -> list[str]:
+    """provider及其声明的全部工具源文件, 与插件运行时的加载范围一致"""
+    provider = yaml.safe_load(PROJECT_DIR.joinpath("provider/custom-image-tools.yaml").read_text("utf-8"))
+    sources = [provider["extra"]["python"]["source"]]
+    for tool in provider["tools"]:
+        config = yaml.safe_load(PROJECT_DIR.joinpath(tool).read_text("utf-8"))
+        sources.append(config["extra"]["python"]["source"])
+    return [str(PROJECT_DIR.joinpath(source)) for source in sources]
+
+
+def measure() -> tuple[float, float, dict]:
+    """返回 (dify_plugin耗时ms, 插件模块耗时ms, 启动状态)"""
+    code = LOADER.format(project_dir=str(PROJECT_DIR), sources=plugin_sources(), lazy=LAZY_MODULES)
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True, cwd=PROJECT_DIR, check=True
+    )
+    baseline = total = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.removeprefix("import time:").split("|")
+        # 只统计顶层导入, 缩进的为其依赖, 已计入顶层模块的累计耗时
+        if name.startswith("  "):
+            continue
+        total += int(cumulative)
+        if name.strip() == "dify_plugin":
+            baseline = int(cumulative)
+    state = json.loads(result.stdout.strip().splitlines()[-1])
+    return baseline / 1000, (total - baseline) / 1000, state
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, default=150, help="插件模块在dify_plugin之上增加的导入耗时上限")
+    args = parser.parse_args()
+
+    results = [measure() for _ in range(args.runs)]
+    baseline = statistics.median(result[0] for result in results)
+    plugin = statistics.median(result[1] for result in results)
+    state = results[-1][2]
+    print(f"dify_plugin={baseline:.1f}ms plugin={plugin:.1f}ms budget={args.budget_ms:.0f}ms state={state}")
+
+    errors = []
+    if plugin > args.budget_ms:
+        errors.append(f"插件模块导入耗时 {plugin:.1f}ms 超出预算 {args.budget_ms:.0f}ms")
+    if state["settings_loaded"]:
+        errors.append("启动阶段加载了配置")
+    if state["lazy_imported"]:
+        errors.append(f"启动阶段导入了 {state['lazy_imported']}")
+    if errors:
+        sys.exit("\n".join(errors))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+流式解析多图响应: 替身服务分块写出包含多张大图的CVProcess响应
+对比读取完整响应后并发解码上传, 与边读边逐张解码上传(settings.volcengine.stream_response)的峰值内存
+替身服务写出的是预先编码好的内容, tracemalloc统计到的基本都是客户端的分配
+
+python -m benchmarks.bench_stream_response --images 6 --size 1024
+"""
+
+import argparse
+import os
+import time
+import tracemalloc
+from io import BytesIO
+
+from PIL import Image
+
+from benchmarks.fakes import FakeOss, FakeVolcengine, use_fakes
+from utils.aio import run_sync
+from utils.config import settings
+from utils.volcengine import ImageArrayParser, Params, cv_iter_images
+
+
+def noise_png(size: int) -> bytes:
+    buffer = BytesIO()
+    Image.frombytes("RGB", (size, size), os.urandom(size * size * 3)).save(buffer, format="PNG", compress_level=1)
+    return buffer.getvalue()
+
+
+def check_parser(images: list[bytes]) -> None:
+    """任意切分位置都能还原全部图片, 包括转义的斜杠"""
+    import base64
+    import json
+
+    encoded = [base64.b64encode(image).decode() for image in images]
+    for escape in (False, True):
+        content = json.dumps({"code": 10000, "data": {"binary_data_base64": encoded, "image_urls": None}})
+        if escape:
+            content = content.replace("/", "\\/")
+        content = content.encode()
+        for chunk_size in (1, 7, 4096):
+            parser = ImageArrayParser()
+            decoded = []
+            for start in range(0, len(content), chunk_size):
+                decoded += parser.feed(content[start : start + chunk_size])
+            assert decoded == images, (escape, chunk_size)
+            assert parser.result() == {"code": 10000, "data": {"binary_data_base64": [], "image_urls": None}}
+
+
+def run(stream: bool) -> tuple[float, float, list]:
+    settings.volcengine.stream_response = stream
+    params = Params(
+        access_key=os.getenv("SEEDREAM_ACCESS_KEY"),
+        secret_key=os.getenv("SEEDREAM_SECRET_KEY"),
+        body={"req_key": "high_aes_general_v30l_zt2i", "prompt": "stream"},
+    )
+
+    async def collect() -> list:
+        # 与逐张返回消息的工具一致, 不保留已返回图片的内容; cv_generate_images 为调用方保留全部图片内容
+        return [image async for image in cv_iter_images(params)]
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    images = run_sync(collect())
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak, elapsed, images
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images", type=int, default=6)
+    parser.add_argument("--size", type=int, default=1024, help="图片边长")
+    args = parser.parse_args()
+
+    check_parser([noise_png(16), b"\xff\xd8\xff" + os.urandom(1000), noise_png(8)])
+
+    images = [noise_png(args.size) for _ in range(args.images)]
+    largest = max(len(image) for image in images)
+    with FakeVolcengine(images) as volcengine, FakeOss(keep_objects=False) as oss:
+        use_fakes(volcengine=volcengine, oss=oss)
+        run(False)  # 预热连接和模块
+        print(f"images={args.images} image_size={largest / 1024 / 1024:.2f}MB")
+        peaks = {}
+        for stream in (False, True):
+            peak, elapsed, uploaded = run(stream)
+            assert len(uploaded) == args.images and all(image.url for image in uploaded)
+            assert [image.size for image in uploaded] == [len(image) for image in images]
+            peaks[stream] = peak
+            print(
+                f"{'stream' if stream else 'buffered':<8} peak={peak / 1024 / 1024:.2f}MB "
+                f"peak/image={peak / largest:.2f} time={elapsed * 1000:.0f}ms"
+            )
+    # 流式模式的峰值与单张图片同一量级, 不随图片数增长
+    assert peaks[True] < largest * 3, peaks
+    assert peaks[True] < peaks[False] / 2, peaks
+
+
+if __name__ == "__main__":
+    main()
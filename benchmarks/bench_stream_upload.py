@@ -0,0 +1,93 @@
+"""
+生成结果下载+上传的内存压测: 对比整块读取(旧实现)与流式上传的峰值RSS
+每种模式在独立子进程中运行, 替身服务运行在父进程, 不计入子进程内存
+
+python -m benchmarks.bench_stream_upload --size 2048
+"""
+
+import argparse
+import json
+import resource
+import subprocess
+import sys
+from io import BytesIO
+from pathlib import Path
+
+BUCKET = "bench"
+ACCESS_KEY = ("fake-ak", "fake-sk")
+
+
+def max_rss_mb() -> float:
+    # Linux下ru_maxrss单位为KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def child(mode: str, oss_url: str, src_url: str) -> dict:
+    import httpx
+    from PIL import Image
+
+    from utils.image import OssUploader
+
+    uploader = OssUploader(oss_url, *ACCESS_KEY, BUCKET)
+    client = httpx.Client()
+    uploader.upload("warmup.png", b"\x89PNG\r\n\x1a\n")
+    baseline = max_rss_mb()
+
+    if mode == "buffered":
+        content = client.get(src_url).content
+        img_format = Image.open(BytesIO(content)).format.lower()
+        uploader.upload(f"image.{img_format}", content, prefix="seedream")
+        blob = content
+    else:
+        max_blob_bytes = 0 if mode == "streaming-noblob" else 64 * 1024 * 1024
+        with client.stream("GET", src_url) as response:
+            result = uploader.upload_stream(response.iter_bytes(), prefix="seedream", max_blob_bytes=max_blob_bytes)
+        blob = result.blob
+    return {
+        "mode": mode,
+        "blob_bytes": len(blob) if blob else 0,
+        "peak_rss_delta_mb": round(max_rss_mb() - baseline, 2),
+    }
+
+
+def make_image(size: int) -> bytes:
+    import os
+
+    from PIL import Image
+
+    # 随机噪声图, 压缩率低, 体积接近真实的大尺寸生成结果
+    image = Image.frombytes("RGB", (size, size), os.urandom(size * size * 3))
+    buffer = BytesIO()
+    image.save(buffer, format="PNG", compress_level=1)
+    return buffer.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=2048, help="生成图片的边长")
+    parser.add_argument("--child", nargs=3, metavar=("MODE", "OSS_URL", "SRC_URL"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(child(*args.child)))
+        return
+
+    from benchmarks.fakes import FakeFileServer, FakeOss
+
+    image = make_image(args.size)
+    print(f"image: {args.size}x{args.size} png, {len(image) / 1024 / 1024:.2f}MB")
+    with FakeOss(keep_objects=False) as oss, FakeFileServer({"/result.png": image}) as src:
+        for mode in ("buffered", "streaming", "streaming-noblob"):
+            output = subprocess.run(
+                [sys.executable, "-m", "benchmarks.bench_stream_upload", "--child", mode, oss.url, f"{src.url}/result.png"],
+                capture_output=True,
+                text=True,
+                check=True,
+                cwd=Path(__file__).parent.parent,
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print(f"{result['mode']:<18} peak_rss_delta={result['peak_rss_delta_mb']:.2f}MB blob={result['blob_bytes']}")
+
+
+if __name__ == "__main__":
+    main()
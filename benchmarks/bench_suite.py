@@ -0,0 +1,289 @@
+"""
+离线压测套件: 启动智能视觉服务(校验签名)、方舟、OSS和文件下载的本地替身, 按给定并发直接调用四个工具,
+统计吞吐量、p50/p95/p99延迟、首条消息延迟、峰值RSS和Python内存分配峰值, 结果保存为JSON以便在不同提交之间对比
+
+python -m benchmarks.bench_suite --concurrency 1,8 --requests 40
+python -m benchmarks.bench_suite --tools image_edit,url_to_file --rate-limit 100 --image-size 2048
+python -m benchmarks.bench_suite --compare benchmarks/results/<commit>.json --fail-on-regression 0.2
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from collections.abc import Callable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from io import BytesIO
+from pathlib import Path
+
+from dify_plugin.file.file import File
+from PIL import Image
+
+from benchmarks.fakes import FakeArk, FakeFileServer, FakeOss, FakeVolcengine, use_fakes
+from tools.image_edit import ImageToImageTool as ImageEditTool
+from tools.image_to_image import ImageToImageTool
+from tools.prompt_to_image import Create_imageTool
+from tools.url_to_file import UrlToFileTool
+from utils.config import UpstreamRateLimit, settings
+
+PROJECT_DIR = Path(__file__).parent.parent
+RESULTS_DIR = Path(__file__).parent.joinpath("results")
+TOOLS = ["prompt_to_image", "image_to_image", "image_edit", "url_to_file"]
+
+
+def build_image(size: int | None) -> bytes:
+    if not size:
+        return PROJECT_DIR.joinpath("img.png").read_bytes()
+    buffer = BytesIO()
+    Image.frombytes("RGB", (size, size), os.urandom(size * size * 3)).save(buffer, format="PNG", compress_level=1)
+    return buffer.getvalue()
+
+
+def git_commit() -> tuple[str, bool]:
+    def git(*args: str) -> str:
+        return subprocess.run(["git", *args], cwd=PROJECT_DIR, capture_output=True, text=True).stdout.strip()
+
+    return git("rev-parse", "--short", "HEAD") or "unknown", bool(git("status", "--porcelain", "--untracked-files=no"))
+
+
+def reset_peak_rss() -> bool:
+    """清零本进程的峰值RSS(VmHWM), 内核不支持时返回False"""
+    try:
+        Path("/proc/self/clear_refs").write_text("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb() -> float | None:
+    """本进程的峰值RSS, 不含工作池子进程"""
+    try:
+        for line in Path("/proc/self/status").read_text().splitlines():
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def failed(messages: list) -> bool:
+    """工具以文本消息报告失败, 或没有返回任何结果"""
+    if not messages:
+        return True
+    for message in messages:
+        text = getattr(message.message, "text", None)
+        if text and ("失败" in text or text.startswith("Error")):
+            return True
+    return False
+
+
+def build_calls(files: FakeFileServer) -> dict[str, Callable[[int], Iterator]]:
+    """各工具的调用, 返回消息生成器, 由调用方逐条读取以便统计首条消息的延迟"""
+    compact = {"blob_max_dimension": 512, "blob_format": "jpeg"}
+    input_url = files.url + "/files/input.png"
+    return {
+        "prompt_to_image": lambda i: Create_imageTool(runtime=None, session=None)._invoke({"prompt": f"a cat {i}"}),
+        "image_to_image": lambda i: ImageToImageTool(runtime=None, session=None)._invoke(
+            {"prompt": f"a cat {i}", "image": File(url="/files/input.png", filename="input.png", type="image")}
+        ),
+        "image_edit": lambda i: ImageEditTool(runtime=None, session=None)._invoke(
+            {"prompt": f"a cat {i}", "image": input_url, **compact}
+        ),
+        "url_to_file": lambda i: UrlToFileTool(runtime=None, session=None)._invoke({"image": input_url, **compact}),
+    }
+
+
+def quantile_ms(values: list[float], q: int) -> float:
+    quantiles = statistics.quantiles(values, n=100, method="inclusive") if len(values) > 1 else values * 99
+    return round(quantiles[q - 1] * 1000, 2)
+
+
+def run_scenario(call: Callable[[int], Iterator], concurrency: int, requests: int) -> dict:
+    latencies: list[float] = []
+    first_messages: list[float] = []
+    errors = 0
+    lock = threading.Lock()
+
+    def one(index: int) -> None:
+        nonlocal errors
+        start = time.perf_counter()
+        first = None
+        messages = []
+        try:
+            for message in call(index):
+                if first is None:
+                    first = time.perf_counter() - start
+                messages.append(message)
+            ok = not failed(messages)
+        except Exception:
+            ok = False
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            first_messages.append(elapsed if first is None else first)
+            errors += not ok
+
+    precise_rss = reset_peak_rss()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(one, range(requests)))
+    elapsed = time.perf_counter() - start
+    return {
+        "concurrency": concurrency,
+        "requests": requests,
+        "errors": errors,
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput_rps": round(requests / elapsed, 3),
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 2),
+        "p50_ms": quantile_ms(latencies, 50),
+        "p95_ms": quantile_ms(latencies, 95),
+        "p99_ms": quantile_ms(latencies, 99),
+        # 首条消息交给Dify的延迟, 流式返回的工具明显低于总延迟
+        "first_message_p50_ms": quantile_ms(first_messages, 50),
+        "first_message_p95_ms": quantile_ms(first_messages, 95),
+        "peak_rss_mb": round(peak_rss_mb() or 0, 2),
+        "peak_rss_scope": "scenario" if precise_rss else "process",
+    }
+
+
+def measure_allocations(call: Callable[[int], Iterator], calls: int) -> dict:
+    """串行调用若干次, 统计Python层内存分配峰值(tracemalloc会拖慢执行, 不与延迟一起测量)"""
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    for index in range(calls):
+        list(call(index))
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "alloc_peak_mb": round((peak - before) / 1024 / 1024, 3),
+        "alloc_retained_mb": round((current - before) / 1024 / 1024, 3),
+    }
+
+
+def compare(results: dict, baseline_path: Path, threshold: float | None) -> bool:
+    """打印与基线的差异, 吞吐量下降或p95上升超过阈值时返回False"""
+    baseline = json.loads(baseline_path.read_text())
+    previous = {(r["tool"], r["concurrency"]): r for r in baseline["results"]}
+    ok = True
+    print(f"\ncompare with {baseline['commit']} ({baseline_path})")
+    for result in results["results"]:
+        old = previous.get((result["tool"], result["concurrency"]))
+        if old is None:
+            continue
+        throughput = result["throughput_rps"] / old["throughput_rps"] - 1 if old["throughput_rps"] else 0
+        p95 = result["p95_ms"] / old["p95_ms"] - 1 if old["p95_ms"] else 0
+        rss = result["peak_rss_mb"] - old["peak_rss_mb"]
+        # 旧版本的结果文件没有首条消息延迟
+        first = result["first_message_p50_ms"] / old["first_message_p50_ms"] - 1 if old.get("first_message_p50_ms") else 0
+        regressed = threshold is not None and (throughput < -threshold or p95 > threshold)
+        ok = ok and not regressed
+        print(
+            f"{result['tool']:<16} c={result['concurrency']:<3} throughput {throughput:+.1%} p95 {p95:+.1%} "
+            f"first_message {first:+.1%} rss {rss:+.1f}MB{'  REGRESSION' if regressed else ''}"
+        )
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tools", default=",".join(TOOLS), help="逗号分隔的工具名")
+    parser.add_argument("--concurrency", default="1,8", help="逗号分隔的并发数")
+    parser.add_argument("--requests", type=int, default=40, help="每个场景的调用次数")
+    parser.add_argument("--image-size", type=int, default=0, help="替身返回的图片边长, 为0时使用img.png")
+    parser.add_argument("--volcengine-ms", type=float, default=200, help="智能视觉服务替身的响应延迟")
+    parser.add_argument("--ark-ms", type=float, default=200, help="方舟替身的响应延迟")
+    parser.add_argument("--oss-ms", type=float, default=20, help="OSS替身的响应延迟")
+    parser.add_argument("--rate-limit", type=float, help="覆盖智能视觉服务和方舟的每秒请求数, 默认使用配置中的限流")
+    parser.add_argument("--alloc-calls", type=int, default=3, help="统计内存分配时的调用次数, 为0时跳过")
+    parser.add_argument("--output", type=Path, help="结果文件, 默认为 benchmarks/results/<commit>.json")
+    parser.add_argument("--compare", type=Path, help="对比的基线结果文件")
+    parser.add_argument("--fail-on-regression", type=float, help="吞吐量下降或p95上升超过该比例时以非零状态退出")
+    args = parser.parse_args()
+
+    tools = [tool.strip() for tool in args.tools.split(",") if tool.strip()]
+    unknown = set(tools) - set(TOOLS)
+    if unknown:
+        parser.error(f"未知工具: {', '.join(sorted(unknown))}")
+    levels = [int(level) for level in args.concurrency.split(",")]
+    image = build_image(args.image_size)
+    commit, dirty = git_commit()
+    if args.rate_limit:
+        settings.ratelimit.volcengine = UpstreamRateLimit(rate_limit=args.rate_limit)
+        settings.ratelimit.ark = UpstreamRateLimit(rate_limit=args.rate_limit)
+
+    results = []
+    with (
+        FakeVolcengine([image], response_delay=args.volcengine_ms / 1000) as volcengine,
+        FakeOss(response_delay=args.oss_ms / 1000, keep_objects=False) as oss,
+        FakeFileServer({"/files/input.png": image, "/result.png": image}) as files,
+        FakeArk(files.url + "/result.png", response_delay=args.ark_ms / 1000) as ark,
+    ):
+        use_fakes(volcengine=volcengine, oss=oss, ark=ark)
+        settings.files_url = files.url
+        calls = build_calls(files)
+        for tool in tools:
+            call = calls[tool]
+            # 预热: 建立连接, 启动工作池子进程
+            assert not failed(list(call(-1))), f"{tool} 预热调用失败"
+            allocations = measure_allocations(call, args.alloc_calls) if args.alloc_calls else {}
+            for concurrency in levels:
+                result = {"tool": tool, **run_scenario(call, concurrency, args.requests), **allocations}
+                results.append(result)
+                print(
+                    f"{tool:<16} c={concurrency:<3} n={result['requests']} errors={result['errors']} "
+                    f"{result['throughput_rps']:.2f} req/s p50={result['p50_ms']:.0f}ms p95={result['p95_ms']:.0f}ms "
+                    f"p99={result['p99_ms']:.0f}ms first_message={result['first_message_p50_ms']:.0f}ms "
+                    f"rss={result['peak_rss_mb']:.0f}MB"
+                    + (f" alloc_peak={allocations['alloc_peak_mb']:.1f}MB" if allocations else "")
+                )
+        fakes = {
+            "volcengine_requests": dict(volcengine.requests),
+            "signature_failures": volcengine.signature_failures,
+            "ark_requests": dict(ark.requests),
+            "oss_requests": dict(oss.requests),
+        }
+
+    report = {
+        "commit": commit,
+        "dirty": dirty,
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": {
+            "requests": args.requests,
+            "image_bytes": len(image),
+            "volcengine_ms": args.volcengine_ms,
+            "ark_ms": args.ark_ms,
+            "oss_ms": args.oss_ms,
+            "rate_limit": {
+                "volcengine": settings.ratelimit.volcengine.rate_limit,
+                "ark": settings.ratelimit.ark.rate_limit,
+            },
+        },
+        "results": results,
+        "fakes": fakes,
+    }
+    output = args.output or RESULTS_DIR.joinpath(f"{commit}{'-dirty' if dirty else ''}.json")
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, ensure_ascii=False, indent=2))
+    print(f"results saved to {output}")
+
+    assert fakes["signature_failures"] == 0, "智能视觉服务替身签名校验失败"
+    assert all(result["errors"] == 0 for result in results), "存在失败的调用"
+    if args.compare and not compare(report, args.compare, args.fail_on_regression):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+分阶段追踪: 未启用时span的额外开销, 以及启用后四个工具的span树和导出的指标
+启用时通过替身服务调用各工具, 检查OTLP JSON文件中每次调用的span同属一个trace,
+并从 /metrics 端口读取Prometheus指标
+
+python -m benchmarks.bench_tracing --calls 200000
+"""
+
+import argparse
+import json
+import socket
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+
+import httpx
+from dify_plugin.file.file import File
+
+from benchmarks.fakes import FakeArk, FakeFileServer, FakeOss, FakeVolcengine, use_fakes
+from tools.image_edit import ImageToImageTool as ImageEditTool
+from tools.image_to_image import ImageToImageTool
+from tools.prompt_to_image import Create_imageTool
+from tools.url_to_file import UrlToFileTool
+from utils import tracing
+from utils.config import TracingConfig, settings
+
+STAGES = {
+    "prompt_to_image": {"volcengine.request", "volcengine.sign", "http.attempt", "image.decode", "oss.upload"},
+    "image_to_image": {"input.download", "staging.prepare", "oss.upload", "volcengine.request", "image.decode"},
+    "image_edit": {"ark.request", "http.attempt", "ark.download", "oss.upload_stream", "image.compact"},
+    "url_to_file": {"url.download", "image.compact"},
+}
+
+
+def overhead(calls: int) -> float:
+    """未启用时每次 with span(...) 的额外耗时(纳秒)"""
+    tracing._tracer = None
+
+    def baseline():
+        for i in range(calls):
+            pass
+
+    def traced():
+        for i in range(calls):
+            with tracing.span("bench", bytes=i):
+                pass
+
+    results = {}
+    for name, func in (("baseline", baseline), ("traced", traced)):
+        best = float("inf")
+        for _ in range(5):
+            start = time.perf_counter()
+            func()
+            best = min(best, time.perf_counter() - start)
+        results[name] = best
+    return (results["traced"] - results["baseline"]) / calls * 1e9
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=200000)
+    args = parser.parse_args()
+
+    per_span = overhead(args.calls)
+    print(f"disabled span overhead: {per_span:.0f}ns/span")
+    assert per_span < 2000, "未启用时span开销应接近于零"
+
+    image = Path(__file__).parent.parent.joinpath("img.png").read_bytes()
+    directory = Path(tempfile.mkdtemp(prefix="tracing-"))
+    port = free_port()
+    settings.tracing = TracingConfig(
+        enabled=True, span_file=directory / "spans.json", prometheus_file=directory / "metrics.prom", prometheus_port=port
+    )
+    tracing._tracer = tracing._UNSET
+
+    with (
+        FakeVolcengine([image]) as volcengine,
+        FakeOss() as oss,
+        FakeFileServer({"/files/input.png": image, "/result.png": image}) as files,
+    ):
+        with FakeArk(files.url + "/result.png") as ark:
+            use_fakes(volcengine=volcengine, oss=oss, ark=ark)
+            settings.files_url = files.url
+            compact = {"blob_max_dimension": 256, "blob_format": "jpeg"}
+            calls = {
+                "prompt_to_image": lambda: Create_imageTool(runtime=None, session=None)._invoke({"prompt": "a cat"}),
+                "image_to_image": lambda: ImageToImageTool(runtime=None, session=None)._invoke(
+                    {"prompt": "a cat", "image": File(url="/files/input.png", filename="input.png", type="image")}
+                ),
+                "image_edit": lambda: ImageEditTool(runtime=None, session=None)._invoke(
+                    {"prompt": "a cat", "image": files.url + "/files/input.png", **compact}
+                ),
+                "url_to_file": lambda: UrlToFileTool(runtime=None, session=None)._invoke(
+                    {"image": files.url + "/files/input.png", **compact}
+                ),
+            }
+            for name, call in calls.items():
+                start = time.perf_counter()
+                messages = list(call())
+                assert messages and all(m.type.value != "text" or "失败" not in m.message.text for m in messages), messages
+                print(f"{name:<16} {(time.perf_counter() - start) * 1000:.0f}ms messages={len(messages)}")
+
+            metrics = httpx.get(f"http://127.0.0.1:{port}/metrics").text
+
+    tracer = tracing.get_tracer()
+    tracer.flush()
+    spans = [
+        span
+        for line in (directory / "spans.json").read_text().splitlines()
+        for resource in json.loads(line)["resourceSpans"]
+        for scope in resource["scopeSpans"]
+        for span in scope["spans"]
+    ]
+    traces = defaultdict(list)
+    for span in spans:
+        traces[span["traceId"]].append(span)
+    for tool, expected in STAGES.items():
+        # 每次工具调用是一个trace, 根span为tool.<名称>, 各阶段都挂在该trace下
+        matched = [group for group in traces.values() if any(s["name"] == f"tool.{tool}" for s in group)]
+        assert len(matched) == 1, (tool, len(matched))
+        names = {s["name"] for s in matched[0]}
+        assert expected <= names, (tool, expected - names)
+        root = next(s for s in matched[0] if s["name"] == f"tool.{tool}")
+        assert not root["parentSpanId"]
+        assert "tool.emit" in names
+        print(f"{tool:<16} spans={len(matched[0])} stages={sorted(names - {'tool.emit', root['name']})}")
+
+    for stage in ("oss.upload", "volcengine.request", "ark.request", "tool.emit"):
+        assert f'stage="{stage}"' in metrics, stage
+    assert 'stage_bytes_total{stage="oss.upload"}' in metrics
+    assert (directory / "metrics.prom").read_text().startswith("# HELP")
+    print(f"exported {len(spans)} spans to {directory / 'spans.json'}, /metrics {len(metrics.splitlines())} lines")
+
+
+if __name__ == "__main__":
+    main()
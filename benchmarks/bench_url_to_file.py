@@ -0,0 +1,113 @@
+"""
+批量链接转文件: 并行下载与逐个返回, 条件请求缓存, 大小上限, 超时和按总大小的LRU淘汰
+逐个调用: 每次调用转换一个链接(旧实现只支持单个链接), 批量: 一次调用传入全部链接
+
+python -m benchmarks.bench_url_to_file --files 8 --delay-ms 200
+"""
+
+import argparse
+import os
+import tempfile
+import time
+from io import BytesIO
+
+from PIL import Image
+
+from benchmarks.fakes import FakeFileServer
+from tools.url_to_file import UrlToFileTool
+from utils import download
+from utils.config import DownloadConfig, settings
+
+
+def build_image(size: int) -> bytes:
+    buffer = BytesIO()
+    Image.frombytes("RGB", (size, size), os.urandom(size * size * 3)).save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def invoke(urls: list[str]) -> tuple[float, list[float], list[str], list]:
+    """返回总耗时、每个blob消息的到达时间、文本消息和blob消息"""
+    start = time.perf_counter()
+    arrivals, texts, blobs = [], [], []
+    for message in UrlToFileTool(runtime=None, session=None)._invoke({"image": "\n".join(urls)}):
+        if message.type.value == "blob":
+            arrivals.append(time.perf_counter() - start)
+            blobs.append(message.message.blob)
+        elif message.type.value == "text":
+            texts.append(message.message.text)
+    return time.perf_counter() - start, arrivals, texts, blobs
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=8)
+    parser.add_argument("--size", type=int, default=512, help="图片边长")
+    parser.add_argument("--delay-ms", type=float, default=200, help="文件服务的首字节延迟")
+    parser.add_argument("--concurrency", type=int, default=4)
+    args = parser.parse_args()
+
+    images = {f"/files/{i}.jpg": build_image(args.size) for i in range(args.files)}
+    paths = list(images)
+    total = sum(len(image) for image in images.values())
+    files = {**images, "/large.bin": os.urandom(2 * 1024 * 1024), "/stream.bin": os.urandom(2 * 1024 * 1024)}
+    files["/slow.jpg"] = images[paths[0]]
+    directory = tempfile.mkdtemp(prefix="url-cache-")
+    # 缓存约能容纳3.5张图片
+    settings.download = DownloadConfig(
+        max_bytes=1024 * 1024,
+        timeout=1,
+        concurrency=args.concurrency,
+        cache_directory=directory,
+        cache_max_bytes=int(total / args.files * 3.5),
+    )
+    download._url_cache = None
+
+    with FakeFileServer(
+        files, response_delay=args.delay_ms / 1000, delays={"/slow.jpg": 3}, chunked={"/stream.bin"}
+    ) as server:
+        urls = [server.url + path for path in paths]
+
+        settings.download.cache = False
+        sequential = sum(invoke([url])[0] for url in urls)
+        settings.download.cache = True
+        elapsed, arrivals, texts, blobs = invoke(urls)
+        print(
+            f"sequential {sequential * 1000:.0f}ms, bulk {elapsed * 1000:.0f}ms, "
+            f"first file after {arrivals[0] * 1000:.0f}ms, last after {arrivals[-1] * 1000:.0f}ms"
+        )
+        assert not texts, texts
+        assert sorted(blobs) == sorted(images.values())
+        assert elapsed < sequential / 2, "并行下载应明显快于逐个下载"
+        assert arrivals[0] < elapsed / 2, "每个文件应在下载完成后立即返回"
+
+        cache = download.get_url_cache()
+        stats = cache.stats()
+        assert stats["bytes"] <= settings.download.cache_max_bytes and stats["evicted"] > 0, stats
+        print(f"cache after bulk call: {stats}")
+
+        # 仍在缓存中的链接发送条件请求, 服务端返回304, 不再传输内容
+        cached = [url for url in urls if cache.lookup(url) is not None]
+        requests, not_modified = server.requests["GET"], server.not_modified
+        elapsed, _, texts, blobs = invoke(cached)
+        assert not texts and sorted(blobs) == sorted(images[url[len(server.url) :]] for url in cached)
+        assert server.not_modified - not_modified == len(cached) and server.requests["GET"] == requests + len(cached)
+        print(f"revalidated {len(cached)} cached files in {elapsed * 1000:.0f}ms, {cache.stats()}")
+
+        # 按最近使用淘汰: 0,1,2依次缓存, 再次使用0, 缓存3时淘汰1
+        for url in urls:
+            cache.delete(url)
+        for index in (0, 1, 2, 0, 3):
+            invoke([urls[index]])
+        assert [cache.lookup(url) is not None for url in urls[:4]] == [True, False, True, True], cache.stats()
+
+        _, _, texts, blobs = invoke([server.url + "/large.bin", server.url + "/stream.bin", server.url + "/slow.jpg"])
+        print("errors:", *texts, sep="\n  ")
+        assert not blobs and len(texts) == 3
+        assert sum("超出上限" in text for text in texts) == 2
+        assert any("超时" in text for text in texts)
+        _, _, texts, _ = invoke([server.url + "/missing.jpg"])
+        assert "404" in texts[0], texts
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,623 @@
+"""
+本地替身服务, 用于离线压测, 不消耗真实API额度
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from collections.abc import Iterator
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import datetime, timezone
+from urllib.parse import parse_qs, parse_qsl, quote, unquote, urlencode, urlsplit
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "_Server"
+
+    def setup(self):
+        # 每个新连接模拟一次TLS握手的耗时
+        self.server.connections += 1
+        if self.server.handshake_delay:
+            time.sleep(self.server.handshake_delay)
+        super().setup()
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self) -> bytes:
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def drain_body(self) -> int:
+        """分块读取并丢弃请求体, 返回其长度"""
+        length = remaining = int(self.headers.get("Content-Length") or 0)
+        while remaining:
+            chunk = self.rfile.read(min(remaining, 64 * 1024))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+        return length
+
+    def reject(self) -> bool:
+        """按替身服务的注入规则返回限流或服务端错误, 已返回时为True"""
+        fake = self.server.fake
+        status, retry_after = fake.take_failure()
+        if status is None:
+            return False
+        self.read_body()
+        self.server.rejected[status] += 1
+        headers = {"Content-Type": "application/json"}
+        if retry_after is not None:
+            headers["Retry-After"] = str(retry_after)
+        self.send(status, json.dumps(fake.error_body(status)).encode(), headers=headers)
+        return True
+
+    def send(self, status: int, body: bytes = b"", headers: dict | None = None):
+        self.server.requests[self.command] += 1
+        delay = self.server.response_delay + self.server.fake.take_stall()
+        if delay:
+            time.sleep(delay)
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body and self.command != "HEAD":
+            try:
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                # 客户端已取消请求(如对冲请求的落败方)
+                self.close_connection = True
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    handshake_delay: float = 0
+    response_delay: float = 0
+    connections: int = 0
+
+
+class FakeServer:
+    """在后台线程中运行的本地HTTP服务"""
+
+    handler_class: type[_Handler] = _Handler
+
+    def __init__(self, handshake_delay: float = 0, response_delay: float = 0):
+        self.httpd = _Server(("127.0.0.1", 0), self.handler_class)
+        self.httpd.handshake_delay = handshake_delay
+        self.httpd.response_delay = response_delay
+        self.httpd.requests = Counter()
+        self.httpd.rejected = Counter()
+        self.httpd.fake = self
+        self.failures: deque[int] = deque()
+        self.retry_after: float | None = None
+        self.max_qps: float | None = None
+        self._accepted: deque[float] = deque()
+        self.stalls: deque[float] = deque()
+        self.stall_every: tuple[int, float] | None = None
+        self._responses = 0
+        self._failure_lock = threading.Lock()
+        # 请求到达时间(time.time())和同时处理中的请求数, 用于检查全局限流与并发
+        self.arrivals: list[float] = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def connections(self) -> int:
+        return self.httpd.connections
+
+    @property
+    def requests(self) -> Counter:
+        """按请求方法统计的请求数"""
+        return self.httpd.requests
+
+    @property
+    def rejected(self) -> Counter:
+        """按状态码统计的注入错误数"""
+        return self.httpd.rejected
+
+    def inject(self, *statuses: int, retry_after: float | None = None, max_qps: float | None = None) -> None:
+        """
+        注入错误
+        :param statuses: 接下来的请求依次返回这些状态码
+        :param retry_after: 429响应携带的Retry-After秒数
+        :param max_qps: 最近1秒内已接受的请求数达到该值时返回429
+        """
+        self.failures.extend(statuses)
+        self.retry_after = retry_after
+        self.max_qps = max_qps
+
+    def take_failure(self) -> tuple[int | None, float | None]:
+        with self._failure_lock:
+            if self.failures:
+                status = self.failures.popleft()
+                return status, self.retry_after if status == 429 else None
+            if self.max_qps:
+                now = time.monotonic()
+                while self._accepted and self._accepted[0] <= now - 1:
+                    self._accepted.popleft()
+                if len(self._accepted) >= self.max_qps:
+                    return 429, self.retry_after
+                self._accepted.append(now)
+            return None, None
+
+    def stall(self, *seconds: float, every: int | None = None, every_seconds: float = 0) -> None:
+        """
+        注入响应延迟
+        :param seconds: 接下来的响应依次额外延迟这些秒数
+        :param every: 此后每every个响应中有一个额外延迟every_seconds秒
+        """
+        self.stalls.extend(seconds)
+        self.stall_every = (every, every_seconds) if every else None
+
+    @contextmanager
+    def tracking(self) -> Iterator[None]:
+        with self._failure_lock:
+            self.arrivals.append(time.time())
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            yield
+        finally:
+            with self._failure_lock:
+                self.in_flight -= 1
+
+    def max_in_window(self, window: float) -> int:
+        """任意window秒内到达的最多请求数"""
+        arrivals = sorted(self.arrivals)
+        best = start = 0
+        for end, arrived in enumerate(arrivals):
+            while arrived - arrivals[start] >= window:
+                start += 1
+            best = max(best, end - start + 1)
+        return best
+
+    def take_stall(self) -> float:
+        with self._failure_lock:
+            self._responses += 1
+            if self.stalls:
+                return self.stalls.popleft()
+            if self.stall_every and self._responses % self.stall_every[0] == 0:
+                return self.stall_every[1]
+            return 0
+
+    def error_body(self, status: int) -> dict:
+        return {"code": status, "message": "injected"}
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class _OssHandler(_Handler):
+    # 参与签名的子资源(已排序), 只列出替身支持的操作
+    SUBRESOURCES = ("acl", "partNumber", "uploadId", "uploads")
+
+    def authorized(self) -> bool:
+        """按OSS V1签名校验请求头或预签名URL中的签名, 未通过时返回403"""
+        fake = self.server.fake
+        path, query = self.split_path()
+        if "Signature" in query:
+            access_key_id = query.get("OSSAccessKeyId", [""])[0]
+            signature = query["Signature"][0]
+            date = query.get("Expires", [""])[0]
+            expired = not date.isdigit() or int(date) < time.time()
+        else:
+            access_key_id, _, signature = self.headers.get("Authorization", "").removeprefix("OSS ").partition(":")
+            date = self.headers.get("x-oss-date") or self.headers.get("Date", "")
+            expired = False
+        oss_headers = sorted((k.lower(), v) for k, v in self.headers.items() if k.lower().startswith("x-oss-"))
+        subresources = "&".join(k + (f"={query[k][0]}" if query[k][0] else "") for k in self.SUBRESOURCES if k in query)
+        string_to_sign = "\n".join([
+            self.command,
+            self.headers.get("Content-MD5", ""),
+            self.headers.get("Content-Type", ""),
+            date,
+            "".join(f"{k}:{v}\n" for k, v in oss_headers) + path + (f"?{subresources}" if subresources else ""),
+        ])
+        digest = hmac.new(fake.access_key_secret.encode(), string_to_sign.encode(), hashlib.sha1).digest()
+        if access_key_id == fake.access_key_id and not expired:
+            if hmac.compare_digest(signature, base64.b64encode(digest).decode()):
+                return True
+        fake.auth_failures += 1
+        # 未读取请求体, 不复用连接
+        self.close_connection = True
+        code = "InvalidAccessKeyId" if access_key_id != fake.access_key_id else "SignatureDoesNotMatch"
+        self.send(403, f"<Error><Code>{code}</Code></Error>".encode(), headers={"x-oss-request-id": "fake"})
+        return False
+
+    def do_PUT(self):
+        if not self.authorized():
+            return
+        path, query = self.split_path()
+        if isinstance(self.server.fake.objects, _Discard) and "uploadId" not in query:
+            size = self.drain_body()
+            self.server.fake.objects[path] = b""
+            self.send(200, headers={"ETag": f'"{size}"', "x-oss-request-id": "fake"})
+            return
+        body = self.read_body()
+        if "uploadId" in query:
+            parts = self.server.fake.uploads[query["uploadId"][0]]
+            parts[int(query["partNumber"][0])] = body
+        else:
+            self.server.fake.objects[path] = body
+        self.send(200, headers={"ETag": f'"{len(body)}"', "x-oss-request-id": "fake"})
+
+    def do_POST(self):
+        if not self.authorized():
+            return
+        path, query = self.split_path()
+        self.read_body()
+        if "uploads" in query:
+            upload_id = uuid.uuid4().hex
+            self.server.fake.uploads[upload_id] = {}
+            body = f"<InitiateMultipartUploadResult><UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>"
+            self.send(200, body.encode(), headers={"x-oss-request-id": "fake"})
+        elif "uploadId" in query:
+            parts = self.server.fake.uploads.pop(query["uploadId"][0])
+            self.server.fake.objects[path] = b"".join(parts[n] for n in sorted(parts))
+            self.send(200, headers={"ETag": '"multipart"', "x-oss-request-id": "fake"})
+        else:
+            self.send(400, headers={"x-oss-request-id": "fake"})
+
+    def do_DELETE(self):
+        if not self.authorized():
+            return
+        path, query = self.split_path()
+        if "uploadId" in query:
+            self.server.fake.uploads.pop(query["uploadId"][0], None)
+        else:
+            self.server.fake.objects.pop(path, None)
+        self.send(204, headers={"x-oss-request-id": "fake"})
+
+    def split_path(self) -> tuple[str, dict]:
+        parts = urlsplit(self.path)
+        return unquote(parts.path), parse_qs(parts.query, keep_blank_values=True)
+
+    def do_HEAD(self):
+        if not self.authorized():
+            return
+        body = self.server.fake.objects.get(self.split_path()[0])
+        if body is None:
+            self.send(404, headers={"x-oss-request-id": "fake"})
+        else:
+            self.send(200, body, headers={"ETag": f'"{len(body)}"', "x-oss-request-id": "fake"})
+
+    def do_GET(self):
+        if not self.authorized():
+            return
+        body = self.server.fake.objects.get(self.split_path()[0])
+        if body is None:
+            self.send(404, headers={"x-oss-request-id": "fake"})
+        else:
+            self.send(200, body, headers={"Content-Type": "application/octet-stream"})
+
+
+class FakeOss(FakeServer):
+    """
+    OSS替身, 支持PUT/HEAD/GET, 对象保存在内存中, 每个请求都校验签名
+    endpoint为IP时oss2使用path-style, 对象路径为 /{bucket}/{key}
+    """
+
+    handler_class = _OssHandler
+
+    def __init__(
+        self,
+        handshake_delay: float = 0,
+        response_delay: float = 0,
+        keep_objects: bool = True,
+        access_key_id: str = "fake-ak",
+        access_key_secret: str = "fake-sk",
+    ):
+        super().__init__(handshake_delay, response_delay)
+        self.access_key_id = access_key_id
+        self.access_key_secret = access_key_secret
+        self.auth_failures = 0
+        self.objects: dict[str, bytes] = {} if keep_objects else _Discard()
+        self.uploads: dict[str, dict[int, bytes]] = {}
+
+
+class _Discard(dict):
+    """只记录对象key, 不保存内容, 避免替身服务占用内存"""
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, b"")
+
+
+class _FileHandler(_Handler):
+    def do_GET(self):
+        fake = self.server.fake
+        path = urlsplit(self.path).path
+        body = fake.files.get(path)
+        if body is None:
+            self.send(404)
+            return
+        etag = fake.etag(path)
+        if self.headers.get("If-None-Match") == etag:
+            fake.not_modified += 1
+            self.send(304, headers={"ETag": etag})
+            return
+        self.server.requests[self.command] += 1
+        delay = self.server.response_delay + fake.delays.get(path, 0)
+        if delay:
+            time.sleep(delay)
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", fake.last_modified)
+        chunked = path in fake.chunked
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        else:
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        view = memoryview(body)
+        try:
+            for start in range(0, len(body), 64 * 1024):
+                chunk = view[start : start + 64 * 1024]
+                if chunked:
+                    self.wfile.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+                else:
+                    self.wfile.write(chunk)
+            if chunked:
+                self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端超出大小上限后中止读取
+            self.close_connection = True
+
+
+class FakeFileServer(FakeServer):
+    """
+    静态文件替身, 模拟生成结果的下载链接, 按64KB分块写出, 支持按ETag返回304
+    :param delays: 按路径额外延迟响应的秒数
+    :param chunked: 以分块编码返回(不带Content-Length)的路径
+    """
+
+    handler_class = _FileHandler
+
+    def __init__(
+        self,
+        files: dict[str, bytes],
+        handshake_delay: float = 0,
+        response_delay: float = 0,
+        delays: dict[str, float] | None = None,
+        chunked: set[str] | None = None,
+    ):
+        super().__init__(handshake_delay, response_delay)
+        self.files = files
+        self.delays = delays or {}
+        self.chunked = chunked or set()
+        self.not_modified = 0
+        self.last_modified = datetime.now(timezone.utc).strftime("%a, %d %b %Y %H:%M:%S GMT")
+
+    def etag(self, path: str) -> str:
+        return f'"{hashlib.md5(self.files[path]).hexdigest()}"'
+
+
+class _VolcengineHandler(_Handler):
+    def do_POST(self):
+        with self.server.fake.tracking():
+            self.handle_post()
+
+    def handle_post(self):
+        if self.reject():
+            return
+        raw = self.read_body()
+        error = self.server.fake.verify(self.command, self.path, self.headers, raw)
+        if error is not None:
+            self.server.fake.signature_failures += 1
+            result = {"ResponseMetadata": {"Error": {"Code": "SignatureDoesNotMatch", "Message": error}}}
+            self.send(401, json.dumps(result).encode(), headers={"Content-Type": "application/json"})
+            return
+        body = json.loads(raw or b"{}")
+        action = parse_qs(urlsplit(self.path).query).get("Action", ["CVProcess"])[0]
+        fake = self.server.fake
+        if action == "CVSync2AsyncSubmitTask":
+            task_id = uuid.uuid4().hex
+            fake.tasks[task_id] = time.monotonic() + fake.task_delay
+            data = {"task_id": task_id}
+        elif action == "CVSync2AsyncGetResult":
+            ready_at = fake.tasks.get(body.get("task_id"))
+            if ready_at is None:
+                data = {"status": "not_found"}
+            elif time.monotonic() < ready_at - fake.task_delay / 2:
+                data = {"status": "in_queue"}
+            elif time.monotonic() < ready_at:
+                data = {"status": "generating"}
+            else:
+                data = {"status": "done", "binary_data_base64": fake.images_base64}
+        else:
+            self.send_images()
+            return
+        result = {"code": 10000, "message": "Success", "request_id": uuid.uuid4().hex, "data": data}
+        self.send(200, json.dumps(result).encode(), headers={"Content-Type": "application/json"})
+
+    def send_images(self):
+        """按64KB分块写出CVProcess响应, 图片base64直接取自预先编码的内容, 替身服务不额外占用内存"""
+        fake = self.server.fake
+        head = json.dumps({"code": 10000, "message": "Success", "request_id": uuid.uuid4().hex})[:-1]
+        parts = [f'{head}, "data": {{"binary_data_base64": ['.encode()]
+        for index, image in enumerate(fake.images_base64_bytes):
+            parts.extend([b", " if index else b"", b'"', image, b'"'])
+        parts.append(b"]}}")
+        self.server.requests[self.command] += 1
+        if self.server.response_delay:
+            time.sleep(self.server.response_delay)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(sum(len(part) for part in parts)))
+        self.end_headers()
+        try:
+            for part in parts:
+                view = memoryview(part)
+                for start in range(0, len(part), 64 * 1024):
+                    self.wfile.write(view[start : start + 64 * 1024])
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+
+class FakeVolcengine(FakeServer):
+    """
+    智能视觉服务替身, 每次返回固定的若干张图片
+    支持CVProcess同步调用, 以及提交任务/查询结果, 任务在task_delay秒后完成(前一半时间为排队状态)
+    """
+
+    handler_class = _VolcengineHandler
+
+    def __init__(
+        self,
+        images: list[bytes],
+        handshake_delay: float = 0,
+        response_delay: float = 0,
+        task_delay: float = 0,
+        access_key: str = "fake-ak",
+        secret_key: str = "fake-sk",
+    ):
+        super().__init__(handshake_delay, response_delay)
+        self.images_base64_bytes = [base64.b64encode(image) for image in images]
+        self.images_base64 = [image.decode() for image in self.images_base64_bytes]
+        self.task_delay = task_delay
+        self.tasks: dict[str, float] = {}
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.signature_failures = 0
+
+    def verify(self, method: str, path: str, headers, body: bytes) -> str | None:
+        """
+        按火山引擎签名规则独立重算签名, 不复用插件的签名实现; 签名有误时返回原因
+        域名不含端口, 与线上服务一致
+        """
+        authorization = headers.get("Authorization") or ""
+        algorithm, _, fields = authorization.partition(" ")
+        parts = dict(field.strip().split("=", 1) for field in fields.split(",") if "=" in field)
+        if algorithm != "HMAC-SHA256" or not {"Credential", "SignedHeaders", "Signature"} <= parts.keys():
+            return "missing authorization"
+        access_key, date, region, service, terminator = parts["Credential"].split("/")
+        if access_key != self.access_key:
+            return "unknown access key"
+        x_date = headers.get("X-Date") or ""
+        try:
+            signed_at = datetime.strptime(x_date, "%Y%m%dT%H%M%SZ").replace(tzinfo=timezone.utc)
+        except ValueError:
+            return "invalid X-Date"
+        if abs((datetime.now(timezone.utc) - signed_at).total_seconds()) > 15 * 60 or x_date[:8] != date:
+            return "X-Date expired"
+        payload_hash = hashlib.sha256(body).hexdigest()
+        if headers.get("X-Content-Sha256") != payload_hash:
+            return "payload hash mismatch"
+
+        url = urlsplit(path)
+        query = urlencode(sorted(parse_qsl(url.query, keep_blank_values=True)), quote_via=quote)
+        values = {"host": (headers.get("Host") or "").split(":")[0]}
+        canonical_headers = "".join(
+            f"{name}:{(values.get(name) or headers.get(name) or '').strip()}\n"
+            for name in parts["SignedHeaders"].split(";")
+        )
+        canonical_request = "\n".join(
+            [method, url.path or "/", query, canonical_headers, parts["SignedHeaders"], payload_hash]
+        )
+        scope = f"{date}/{region}/{service}/{terminator}"
+        string_to_sign = f"HMAC-SHA256\n{x_date}\n{scope}\n{hashlib.sha256(canonical_request.encode()).hexdigest()}"
+        key = self.secret_key.encode()
+        for value in (date, region, service, terminator):
+            key = hmac.new(key, value.encode(), hashlib.sha256).digest()
+        expected = hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+        if not hmac.compare_digest(expected, parts["Signature"]):
+            return "signature mismatch"
+        return None
+
+    def error_body(self, status: int) -> dict:
+        # 50429: QPS超限, 50500: 服务内部错误
+        code = 50429 if status == 429 else 50500
+        return {"code": code, "message": "injected", "request_id": uuid.uuid4().hex, "data": None}
+
+
+class _ArkHandler(_Handler):
+    def do_POST(self):
+        if self.reject():
+            return
+        body = json.loads(self.read_body() or b"{}")
+        fake = self.server.fake
+        if self.headers.get("Authorization") != f"Bearer {fake.api_key}":
+            error = {"error": {"code": "AuthenticationError", "message": "invalid api key", "type": "Unauthorized"}}
+            self.send(401, json.dumps(error).encode(), headers={"Content-Type": "application/json"})
+            return
+        if not body.get("model"):
+            # 与线上一致, 先鉴权再校验参数
+            error = {"error": {"code": "MissingParameter", "message": "model is required", "type": "BadRequest"}}
+            self.send(400, json.dumps(error).encode(), headers={"Content-Type": "application/json"})
+            return
+        result = {
+            "model": body.get("model"),
+            "created": int(time.time()),
+            "data": [{"url": fake.image_url}],
+        }
+        self.send(200, json.dumps(result).encode(), headers={"Content-Type": "application/json"})
+
+
+class FakeArk(FakeServer):
+    """方舟图片生成接口替身, 返回固定的图片链接"""
+
+    handler_class = _ArkHandler
+
+    def __init__(
+        self, image_url: str, handshake_delay: float = 0, response_delay: float = 0, api_key: str = "fake-key"
+    ):
+        super().__init__(handshake_delay, response_delay)
+        self.image_url = image_url
+        self.api_key = api_key
+
+    def error_body(self, status: int) -> dict:
+        code = "RateLimitExceeded" if status == 429 else "InternalServiceError"
+        return {"error": {"code": code, "message": "injected", "type": "injected"}}
+
+
+def use_fakes(
+    volcengine: FakeServer | None = None,
+    oss: FakeOss | None = None,
+    bucket: str = "bench",
+    ark: FakeArk | None = None,
+) -> None:
+    """把插件的上游地址和OSS配置指向替身服务"""
+    import os
+
+    import utils.credentials
+    import utils.image
+
+    os.environ.setdefault("SEEDREAM_ACCESS_KEY", "fake-ak")
+    os.environ.setdefault("SEEDREAM_SECRET_KEY", "fake-sk")
+    if volcengine is not None:
+        os.environ["SEEDREAM_BASE_URL"] = volcengine.url
+        if isinstance(volcengine, FakeVolcengine):
+            # 替身按这组凭证校验签名
+            os.environ.update(SEEDREAM_ACCESS_KEY=volcengine.access_key, SEEDREAM_SECRET_KEY=volcengine.secret_key)
+    if ark is not None:
+        os.environ["ARK_API_KEY"] = ark.api_key
+        os.environ["ARK_BASE_URL"] = ark.url + "/api/v3"
+    if oss is not None:
+        os.environ.update(
+            OSS_ENDPOINT=oss.url,
+            OSS_ACCESS_KEY_ID=oss.access_key_id,
+            OSS_ACCESS_KEY_SECRET=oss.access_key_secret,
+            OSS_BUCKET_NAME=bucket,
+            OSS_DOMAIN="oss.bench.local",
+        )
+        utils.image._uploader = None
+    # 环境变量变化后重新解析默认租户
+    utils.credentials._registry = None
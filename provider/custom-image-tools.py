@@ -7,8 +7,11 @@ from dify_plugin.errors.tool import ToolProviderCredentialValidationError
 class CustomImageToolsProvider(ToolProvider):
     def _validate_credentials(self, credentials: dict[str, Any]) -> None:
         try:
-            """
-            IMPLEMENT YOUR VALIDATION HERE
-            """
+            # 插件启动时只加载供应商, 工具依赖在校验凭证时才导入
+            from utils.aio import run_sync
+            from utils.credentials import get_registry
+
+            # 对已填写的上游各做一次真实的鉴权请求, 通过后租户对象留在进程内供工具复用
+            run_sync(get_registry().validate(credentials))
         except Exception as e:
             raise ToolProviderCredentialValidationError(str(e))
@@ -1,39 +1,90 @@
-import base64
-import json
-import os
+import asyncio
 from collections.abc import Generator
-from io import BytesIO
 from typing import Any
-from urllib.parse import urlencode
-from uuid import uuid4
-import httpx
 
-import requests
-from PIL import Image
+import httpx
 from dify_plugin import Tool
 from dify_plugin.entities.tool import ToolInvokeMessage
-from dify_plugin.file.file import File
-from dotenv import find_dotenv
-from flask.cli import load_dotenv
-from pydantic import BaseModel, Field
 
-from utils.image import upload_image
-from utils.volcengine import Img2ImgRequest, Params, create_header
-load_dotenv(find_dotenv())
+from utils.aio import run_sync
+from utils.cache import is_deterministic
+from utils.config import settings
+from utils.coordination import generation_slot
+from utils.credentials import CredentialError, Tenant, get_tenant, use_tenant
+from utils.http_client import client_for, get_async_client
+from utils.image import CompactOptions, UploadedImage, compact_image_pooled, upload_image_stream
+from utils.ratelimit import get_limiter, send_with_retry
+from utils.resilience import call_endpoint
+from utils.singleflight import coalesce
+from utils.tracing import span, trace_messages
+
+
+async def ark_generate(url: str, headers: dict, payload: dict) -> httpx.Response:
+    """
+    调用方舟图片生成接口
+    按模型共享限流, 限流及服务端错误自动重试; 按端点熔断, 可选对冲请求
+    """
+    client = get_async_client("ark")
+    limiter = get_limiter("ark", payload["model"])
+
+    async def send(endpoint: str) -> httpx.Response:
+        return await send_with_retry(lambda: client.post(endpoint, headers=headers, json=payload), limiter)
+
+    async with generation_slot("ark") as generation:
+        with span("ark.request", model=payload["model"]) as s:
+            response = await call_endpoint("ark", url, send)
+            s.set("status", response.status_code).set("bytes", len(response.content))
+        # 上游返回错误时不计入用量
+        generation.failed = response.status_code >= 400
+    return response
+
+
+def transfer_result(url: str) -> UploadedImage:
+    """流式下载方舟返回的图片并上传到OSS"""
+    with span("ark.download") as s, client_for(url).stream("GET", url) as response:
+        s.set("status", response.status_code)
+        response.raise_for_status()
+        uploaded = upload_image_stream(response.iter_bytes(), prefix="seedream", max_blob_bytes=settings.blob_max_bytes)
+        s.set("bytes", uploaded.size)
+    return uploaded
+
+
+async def edit_image(tenant: Tenant, payload: dict) -> str:
+    """
+    调用方舟图片编辑, 返回上游生成的图片链接
+    同时进行的相同请求(模型、提示词、输入图片、随机种子等)只调用一次
+    """
+
+    async def call() -> str:
+        response = await ark_generate(tenant.ark_url, tenant.ark_headers, payload)
+        response.raise_for_status()
+        result: dict = response.json()
+        data: dict = result.get("data", [])[0]
+        return data.get("url", "https://ark-project.tos-cn-beijing.volces.com/doc_image/seedream_i2i.jpeg")
+
+    return await coalesce(payload, call, is_deterministic(payload))
+
+
+async def transfer_image(url: str) -> UploadedImage:
+    """
+    把上游生成的图片转存到OSS, 合并的请求得到同一个链接, 只下载上传一次
+    :return: 合并的请求共享同一个结果对象
+    """
+    return await coalesce({"transfer": url}, lambda: asyncio.to_thread(transfer_result, url), True)
 
 
 class ImageToImageTool(Tool):
     def _invoke(self, tool_parameters: dict[str, Any]) -> Generator[ToolInvokeMessage]:
+        tenant = get_tenant(self.runtime.credentials if self.runtime else None)
+        with use_tenant(tenant):
+            yield from trace_messages("image_edit", self._run(tenant, tool_parameters))
+
+    def _run(self, tenant: Tenant, tool_parameters: dict[str, Any]) -> Generator[ToolInvokeMessage]:
         prompt = tool_parameters.get("prompt", "")
         image: str = tool_parameters.get("image", "https://ark-project.tos-cn-beijing.volces.com/doc_image/seedream_i2i.jpeg")  # 获取图像参数, 应该是Dify File对象
 
         seed = tool_parameters.get("seed", None)
-        url = "https://ark.cn-beijing.volces.com/api/v3/images/generations"
-        api_key = os.getenv("ARK_API_KEY")
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key}",
-        }
+        compact_options = CompactOptions.from_tool_parameters(tool_parameters)
         payload = {
             "model": "doubao-seededit-3-0-i2i-250628",
             "prompt": prompt,
@@ -45,29 +96,24 @@ class ImageToImageTool(Tool):
             "watermark": False,
         }
         try:
-            with httpx.Client() as client:
-                response = client.post(
-                    url, headers=headers, json=payload, timeout=60
-                )
-                response.raise_for_status()
-                result: dict = response.json()
-                data: dict = result.get("data", [])[0]
-                url = data.get("url", "https://ark-project.tos-cn-beijing.volces.com/doc_image/seedream_i2i.jpeg")
-
-            # 上传图片
-            response = httpx.get(url, timeout=60)
-
-            content = response.content
-            pil = Image.open(BytesIO(content))
-            img_format = pil.format.lower() or "png"
-            filename = f"{str(uuid4())}.{img_format}"
-
-            image_url = upload_image(filename, data=content, prefix="seedream")
-
-            yield self.create_text_message(image_url)
-            yield self.create_json_message({"url": image_url})
-            metadata = {"mime_type": f"image/{img_format}"}
-            yield self.create_blob_message(content, meta=metadata)
+            if tenant.ark_headers is None:
+                raise CredentialError("未配置方舟API Key")
+            source_url = run_sync(edit_image(tenant, payload))
+            # 上游链接可立即使用, 先返回, 再转存到OSS
+            if settings.emit_source_url:
+                yield self.create_json_message({"source_url": source_url})
+            uploaded = run_sync(transfer_image(source_url))
+            yield self.create_text_message(uploaded.url)
+
+            # OSS中保存原图, blob消息按需缩放转码
+            compact = compact_image_pooled(uploaded.blob, compact_options) if uploaded.blob is not None else None
+            result = {"url": uploaded.url, "source_url": source_url}
+            if compact and compact_options.enabled:
+                result["blob"] = compact.report()
+            yield self.create_json_message(result)
+            if compact:
+                metadata = {"mime_type": f"image/{compact.format}"}
+                yield self.create_blob_message(compact.blob, meta=metadata)
             return
         except Exception as e:
             yield self.create_text_message(f"工具调用失败, 错误提示: {e}")
@@ -1,81 +1,70 @@
-import base64
-import json
-import os
-from collections.abc import Generator
-from typing import Any
-from urllib.parse import urlencode
-from uuid import uuid4
+from collections.abc import AsyncGenerator, Generator
+from typing import TYPE_CHECKING, Any
 
-import requests
 from dify_plugin import Tool
 from dify_plugin.entities.tool import ToolInvokeMessage
-from dify_plugin.file.file import File
-from dotenv import find_dotenv
-from flask.cli import load_dotenv
-from pydantic import BaseModel, Field
 
-from utils.image import upload_image
-from utils.volcengine import Img2ImgRequest, Params, create_header
-load_dotenv(find_dotenv())
+from utils.aio import iter_async
+from utils.cache import cached_generate
+from utils.config import settings
+from utils.credentials import current_tenant, get_tenant, use_tenant
+from utils.executor import run_thread
+from utils.http_client import async_client_for
+from utils.image import UploadedImage
+from utils.staging import content_digest, stage_input
+from utils.tracing import span, trace_messages
+from utils.volcengine import Img2ImgRequest, cv_generate_images
 
+if TYPE_CHECKING:
+    from dify_plugin.file.file import File
 
 
 class ImageToImageTool(Tool):
     def _invoke(self, tool_parameters: dict[str, Any]) -> Generator[ToolInvokeMessage]:
+        with use_tenant(get_tenant(self.runtime.credentials if self.runtime else None)):
+            yield from trace_messages("image_to_image", iter_async(self._invoke_async(tool_parameters)))
+
+    async def _invoke_async(self, tool_parameters: dict[str, Any]) -> AsyncGenerator[ToolInvokeMessage]:
         prompt = tool_parameters.get("prompt", "")
-        image: File = tool_parameters.get("image")  # 获取图像参数, 应该是Dify File对象
+        image: "File" = tool_parameters.get("image")  # 获取图像参数, 应该是Dify File对象
         if isinstance(image, list):
             image = image[0]
 
-        image.url = f"http://agent.aimark.net.cn{image.url}" if image.url.startswith("/") else image.url
         seed = tool_parameters.get("seed", None)
 
-        # TODO image to url
-        # filename = str(uuid4())
-        print(image)
-        print(type(image))
-
         if not image:
             yield self.create_text_message("Error: Input image file is required.")
             return
-        image_url = upload_image(image.filename, image.blob, prefix="seedream")
+        # Dify文件链接可能是相对路径
+        image_url = f"{settings.files_url.rstrip('/')}{image.url}" if image.url.startswith("/") else image.url
+        with span("input.download") as s:
+            response = await async_client_for(image_url).get(image_url)
+            s.set("status", response.status_code)
+            response.raise_for_status()
+            image_bytes = response.content
+            s.set("bytes", len(image_bytes))
         body_pydantic = Img2ImgRequest(
             req_key="i2i_portrait_photo",
             prompt=prompt,
-            image_input=image_url
+            image_input=""
         )
         if seed:
             body_pydantic.seed = seed
-        body = body_pydantic.model_dump(exclude_unset=True, exclude_none=True)
-        params = Params(
-            access_key=os.getenv("SEEDREAM_ACCESS_KEY"),
-            secret_key=os.getenv("SEEDREAM_SECRET_KEY"),
-            body=body,
-        )
-        query_string = (
-            urlencode(sorted(params.query_params.items()))
-            if isinstance(params.query_params, dict)
-            else params.query_params
-        )
-        url = params.base_url + "?" + query_string
-        headers = create_header(params)
-        response = requests.post(url=url, data=json.dumps(body), headers=headers)
-        data = response.json()
-        images_base64 = data.get("data", {}).get("binary_data_base64", [])
-        urls = []
-        for image_base64 in images_base64:
-            if not image_base64:
-                continue
-            # Decode the base64 image bytes
-            # Create an ImageArtifact from the decoded bytes
-            image_bytes = base64.b64decode(image_base64)
-            id = str(uuid4())
-            filename = f"{id}.png"
+        # 缓存键使用输入图片内容的哈希, 而不是每次上传得到的新链接
+        cache_body = body_pydantic.model_dump(exclude_unset=True, exclude_none=True)
+        digest = await run_thread(content_digest, image_bytes)
+        cache_body["image_input"] = f"sha256:{digest}"
+
+        async def generate() -> list[UploadedImage]:
+            # 同一张输入图在OSS生命周期内只上传一次
+            staged = await stage_input(image_bytes, digest)
+            body_pydantic.image_input = staged.url
+            body = body_pydantic.model_dump(exclude_unset=True, exclude_none=True)
+            return await cv_generate_images(current_tenant().volcengine_params(body), prefix="seedream")
 
-            url = upload_image(filename, image_bytes, prefix="seedream")
-            urls.append(url)
+        images = await cached_generate(cache_body, generate)
 
-        url = urls[0] if len(urls) > 0 else ""
+        url = images[0].url if len(images) > 0 else ""
 
         yield self.create_json_message({
             "url": url
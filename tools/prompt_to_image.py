@@ -1,23 +1,17 @@
-import base64
-import json
-import os
-from collections.abc import Generator
-from io import BytesIO
+from collections.abc import AsyncGenerator, AsyncIterator, Generator
 from typing import Any
-from urllib.parse import urlencode
-from uuid import uuid4
 
-import requests
-from PIL import Image
 from dify_plugin import Tool
 from dify_plugin.entities.tool import ToolInvokeMessage
-from dotenv import find_dotenv
-from flask.cli import load_dotenv
 from pydantic import BaseModel, Field
 
-from utils.image import upload_image
-from utils.volcengine import Params, create_header
-load_dotenv(find_dotenv())
+from utils.aio import iter_async
+from utils.cache import cached_generate, cached_generate_iter
+from utils.credentials import current_tenant, get_tenant, use_tenant
+from utils.image import CompactOptions, UploadedImage, compact_image_async
+from utils.tracing import trace_messages
+from utils.volcengine import cv_generate_images, cv_iter_images
+
 
 class RequestBody(BaseModel):
     """
@@ -52,57 +46,65 @@ class RequestBody(BaseModel):
     )
     logo_info: dict | None = Field(None, title="水印信息")
 
+def request_body(prompt: str, seed: int | None = None) -> dict:
+    body_pydantic = RequestBody(
+        req_key="high_aes_general_v30l_zt2i",
+        prompt=prompt,
+    )
+    if seed:
+        body_pydantic.seed = seed
+    return body_pydantic.model_dump(exclude_unset=True, exclude_none=True)
+
+
+async def generate_images(prompt: str, seed: int | None = None) -> list[UploadedImage]:
+    """调用文生图接口并上传返回的全部图片, 固定随机种子时优先使用缓存结果"""
+    body = request_body(prompt, seed)
+    tenant = current_tenant() or get_tenant(None)
+
+    async def generate() -> list[UploadedImage]:
+        return await cv_generate_images(tenant.volcengine_params(body), prefix="seedream")
+
+    return await cached_generate(body, generate)
+
+
+async def iter_images(prompt: str, seed: int | None = None) -> AsyncIterator[UploadedImage]:
+    """与 generate_images 相同, 但每张图片上传完成后立即产出"""
+    body = request_body(prompt, seed)
+    tenant = current_tenant() or get_tenant(None)
+
+    def generate() -> AsyncIterator[UploadedImage]:
+        return cv_iter_images(tenant.volcengine_params(body), prefix="seedream")
+
+    async for image in cached_generate_iter(body, generate):
+        yield image
+
+
 class Create_imageTool(Tool):
     def _invoke(self, tool_parameters: dict[str, Any]) -> Generator[ToolInvokeMessage]:
+        with use_tenant(get_tenant(self.runtime.credentials if self.runtime else None)):
+            yield from trace_messages("prompt_to_image", iter_async(self._invoke_async(tool_parameters)))
+
+    async def _invoke_async(self, tool_parameters: dict[str, Any]) -> AsyncGenerator[ToolInvokeMessage]:
         prompt = tool_parameters.get("prompt", "")
         seed = tool_parameters.get("seed", None)
+        compact_options = CompactOptions.from_tool_parameters(tool_parameters)
+
+        count = 0
+        # 每张图片上传完成后立即返回链接和blob, 不等待其余图片
+        async for image in iter_images(prompt, seed):
+            # OSS中保存原图, blob消息按需缩放转码
+            compact = await compact_image_async(image.blob, compact_options) if image.blob is not None else None
+            result = {"url": image.url}
+            if compact and compact_options.enabled:
+                result["blob"] = compact.report()
+            yield self.create_json_message(result)
+            # 多张图片时文本输出为按行分隔的链接
+            yield self.create_text_message(image.url if not count else f"\n{image.url}")
+            if compact:
+                metadata = {"mime_type": f"image/{compact.format}"}
+                yield self.create_blob_message(compact.blob, meta=metadata)
+            count += 1
 
-        body_pydantic = RequestBody(
-            req_key="high_aes_general_v30l_zt2i",
-            prompt=prompt,
-        )
-        if seed:
-            body_pydantic.seed = seed
-        body = body_pydantic.model_dump(exclude_unset=True, exclude_none=True)
-        params = Params(
-            access_key=os.getenv("SEEDREAM_ACCESS_KEY"),
-            secret_key=os.getenv("SEEDREAM_SECRET_KEY"),
-            body=body,
-        )
-        query_string = (
-            urlencode(sorted(params.query_params.items()))
-            if isinstance(params.query_params, dict)
-            else params.query_params
-        )
-        url = params.base_url + "?" + query_string
-        headers = create_header(params)
-        response = requests.post(url=url, data=json.dumps(body), headers=headers)
-        data = response.json()
-        images_base64 = data.get("data", {}).get("binary_data_base64", [])
-        urls = []
-        images = []
-        for image_base64 in images_base64:
-            if not image_base64:
-                continue
-            # Decode the base64 image bytes
-            # Create an ImageArtifact from the decoded bytes
-            image_bytes = base64.b64decode(image_base64)
-            id = str(uuid4())
-            pil = Image.open(BytesIO(image_bytes))
-            img_format = pil.format.lower()
-            filename = f"{id}.{img_format}"
-
-            images.append((image_bytes, img_format))
-            url = upload_image(filename, image_bytes, prefix="seedream")
-            urls.append(url)
-
-        url = urls[0] if len(urls) > 0 else ""
-        image_bytes, img_format = images[0] if len(images) >0 else None
-
-        yield self.create_json_message({
-            "url": url
-        })
-
-        yield self.create_text_message(url)
-        metadata = {"mime_type": f"image/{img_format}"}
-        yield self.create_blob_message(image_bytes, meta=metadata)
+        if not count:
+            yield self.create_json_message({"url": ""})
+            yield self.create_text_message("")
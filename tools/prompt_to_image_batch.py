@@ -0,0 +1,137 @@
+import asyncio
+import json
+import time
+from collections.abc import AsyncGenerator, Generator
+from typing import Any
+
+from dify_plugin import Tool
+from dify_plugin.entities.tool import ToolInvokeMessage
+
+from tools.prompt_to_image import generate_images
+from utils.aio import iter_async
+from utils.coordination import coordination_metrics
+from utils.credentials import get_tenant, use_tenant
+from utils.executor import executor_metrics
+from utils.ratelimit import TokenBucket, limiter_metrics
+from utils.singleflight import singleflight_metrics
+from utils.tracing import trace_messages
+
+MAX_BATCH_SIZE = 100
+# 与工具参数定义中的取值范围一致, Dify以外的调用方可能传入超出范围的值
+MAX_CONCURRENCY = 16
+MAX_RATE_LIMIT = 50
+
+
+def parse_prompts(value: str | list | None) -> list[str]:
+    """提示词列表, 支持JSON数组或按行分隔"""
+    if not value:
+        return []
+    if isinstance(value, str):
+        try:
+            parsed = json.loads(value)
+        except json.JSONDecodeError:
+            parsed = None
+        # 只有JSON数组按列表处理, "2024"、"null"、对象等仍是普通提示词
+        value = parsed if isinstance(parsed, list) else value.splitlines()
+    return [str(prompt).strip() for prompt in value if str(prompt).strip()]
+
+
+def parse_seeds(value: str | list | int | None) -> list[int]:
+    """随机种子列表, 支持JSON数组或按逗号/换行分隔"""
+    if value is None or value == "":
+        return []
+    if isinstance(value, (int, float)):
+        return [int(value)]
+    if isinstance(value, str):
+        value = value.replace("\n", ",").strip("[]").split(",")
+    return [int(seed) for seed in value if str(seed).strip()]
+
+
+class Create_image_batchTool(Tool):
+    def _invoke(self, tool_parameters: dict[str, Any]) -> Generator[ToolInvokeMessage]:
+        with use_tenant(get_tenant(self.runtime.credentials if self.runtime else None)):
+            yield from trace_messages("prompt_to_image_batch", iter_async(self._invoke_async(tool_parameters)))
+
+    async def _invoke_async(self, tool_parameters: dict[str, Any]) -> AsyncGenerator[ToolInvokeMessage]:
+        prompts = parse_prompts(tool_parameters.get("prompts"))
+        try:
+            seeds = parse_seeds(tool_parameters.get("seeds"))
+        except ValueError:
+            yield self.create_text_message("随机种子必须为整数")
+            return
+        try:
+            concurrency = int(tool_parameters.get("concurrency") or 4)
+            rate_limit = tool_parameters.get("rate_limit")
+            rate_limit = 2 if rate_limit is None or rate_limit == "" else float(rate_limit)
+        except ValueError:
+            yield self.create_text_message("并发数和每秒请求数必须为数字")
+            return
+        if not 0 < rate_limit:
+            yield self.create_text_message("每秒请求数必须大于0")
+            return
+        concurrency = min(max(concurrency, 1), MAX_CONCURRENCY)
+        rate_limit = min(rate_limit, MAX_RATE_LIMIT)
+
+        if not prompts:
+            yield self.create_text_message("提示词不能为空")
+            return
+        # 提示词与随机种子两两组合
+        items = [(prompt, seed) for prompt in prompts for seed in (seeds or [None])]
+        if len(items) > MAX_BATCH_SIZE:
+            yield self.create_text_message(f"单次批量最多生成{MAX_BATCH_SIZE}项, 当前为{len(items)}项")
+            return
+
+        semaphore = asyncio.Semaphore(concurrency)
+        bucket = TokenBucket(rate_limit)
+
+        async def run(index: int, prompt: str, seed: int | None) -> dict:
+            async with semaphore:
+                await bucket.acquire()
+                try:
+                    images = await generate_images(prompt, seed)
+                except Exception as e:
+                    return {"index": index, "prompt": prompt, "seed": seed, "error": str(e), "images": []}
+            return {"index": index, "prompt": prompt, "seed": seed, "images": images}
+
+        start = time.perf_counter()
+        tasks = [asyncio.ensure_future(run(index, prompt, seed)) for index, (prompt, seed) in enumerate(items)]
+        succeeded = failed = image_count = 0
+        try:
+            # 每项完成后立即返回, 单项失败不影响其它项
+            for future in asyncio.as_completed(tasks):
+                result = await future
+                images = result.pop("images")
+                if "error" in result or not images:
+                    failed += 1
+                    result.setdefault("error", "未返回图片")
+                    yield self.create_json_message(result)
+                    continue
+                succeeded += 1
+                image_count += len(images)
+                yield self.create_json_message({**result, "urls": [image.url for image in images]})
+                for image in images:
+                    # 未保留图片内容时只返回链接
+                    if image.blob is not None:
+                        yield self.create_blob_message(image.blob, meta={"mime_type": f"image/{image.format}"})
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        elapsed = time.perf_counter() - start
+        throughput = image_count / elapsed * 60 if elapsed > 0 else 0
+        yield self.create_json_message({
+            "total": len(items),
+            "succeeded": succeeded,
+            "failed": failed,
+            "images": image_count,
+            "elapsed_seconds": round(elapsed, 2),
+            "images_per_minute": round(throughput, 2),
+            "limiters": limiter_metrics(),
+            "workers": executor_metrics(),
+            "coordination": coordination_metrics(),
+            "singleflight": singleflight_metrics(),
+        })
+        yield self.create_text_message(
+            f"批量生成完成: 成功{succeeded}项, 失败{failed}项, 共{image_count}张图片, "
+            f"耗时{elapsed:.1f}秒, 吞吐量{throughput:.1f}张/分钟"
+        )
@@ -1,29 +1,68 @@
-from collections.abc import Generator
-from io import BytesIO
+import asyncio
+import json
+from collections.abc import AsyncGenerator, Generator
 from typing import Any
 
-import requests
 from dify_plugin import Tool
 from dify_plugin.entities.tool import ToolInvokeMessage
-from dotenv import find_dotenv
-from flask.cli import load_dotenv
-from PIL import Image
 
-load_dotenv(find_dotenv())
+from utils.aio import iter_async
+from utils.config import settings
+from utils.download import download
+from utils.image import CompactImage, CompactOptions, compact_image_async
+from utils.tracing import trace_messages
+
+
+def parse_urls(value: str | list | None) -> list[str]:
+    """链接列表, 支持JSON数组或按空白/换行分隔, 去除重复链接"""
+    if not value:
+        return []
+    if isinstance(value, str):
+        try:
+            parsed = json.loads(value)
+        except json.JSONDecodeError:
+            parsed = None
+        # 只有JSON数组按列表处理, 数字、对象等按普通文本切分
+        value = parsed if isinstance(parsed, list) else value.split()
+    return list(dict.fromkeys(str(url).strip() for url in value if str(url).strip()))
 
 
 class UrlToFileTool(Tool):
     def _invoke(self, tool_parameters: dict[str, Any]) -> Generator[ToolInvokeMessage]:
-        image = tool_parameters.get("image")
-        if not image:
+        yield from trace_messages("url_to_file", iter_async(self._invoke_async(tool_parameters)))
+
+    async def _invoke_async(self, tool_parameters: dict[str, Any]) -> AsyncGenerator[ToolInvokeMessage]:
+        urls = parse_urls(tool_parameters.get("image"))
+        if not urls:
             yield self.create_text_message("图像不存在")
             return
-        print(image)
-        response = requests.get(image)
-        image_bytes = response.content
-        pil = Image.open(BytesIO(image_bytes))
-        img_format = pil.format.lower()
+        config = settings.download
+        if len(urls) > config.max_urls:
+            yield self.create_text_message(f"单次最多转换{config.max_urls}个链接, 当前为{len(urls)}个")
+            return
+        compact_options = CompactOptions.from_tool_parameters(tool_parameters)
+        semaphore = asyncio.Semaphore(config.concurrency)
 
-        metadata = {"mime_type": f"image/{img_format}"}
-        yield self.create_blob_message(image_bytes, meta=metadata)
+        async def fetch(url: str) -> tuple[str, CompactImage | None, dict]:
+            try:
+                async with semaphore:
+                    result = await download(url)
+                compact = await compact_image_async(result.content, compact_options)
+            except Exception as e:
+                return url, None, {"url": url, "error": str(e)}
+            return url, compact, {"url": url, "cached": result.cached, "blob": compact.report()}
 
+        tasks = [asyncio.ensure_future(fetch(url)) for url in urls]
+        try:
+            # 每个文件下载完成后立即返回, 单个链接失败不影响其它链接
+            for future in asyncio.as_completed(tasks):
+                url, compact, report = await future
+                if compact is None:
+                    yield self.create_text_message(f"图像下载失败: {url}, 错误提示: {report['error']}")
+                    continue
+                if compact_options.enabled:
+                    yield self.create_json_message(report)
+                yield self.create_blob_message(compact.blob, meta={"mime_type": f"image/{compact.format}"})
+        finally:
+            for task in tasks:
+                task.cancel()
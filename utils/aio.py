@@ -0,0 +1,84 @@
+"""
+异步执行核心
+进程内维护一个后台事件循环, 工具的同步 _invoke 通过 run_sync / iter_async 把协程提交到该循环执行,
+异步HTTP客户端等资源绑定在同一个循环上, 可在多次调用之间复用
+"""
+
+import asyncio
+import concurrent.futures
+import contextvars
+import threading
+from collections.abc import AsyncIterator, Coroutine, Generator
+from typing import Any, TypeVar
+
+T = TypeVar("T")
+
+_loop: asyncio.AbstractEventLoop | None = None
+_lock = threading.Lock()
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    """获取后台事件循环, 首次调用时在守护线程中启动"""
+    global _loop
+    if _loop is None:
+        with _lock:
+            if _loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="aio-loop", daemon=True).start()
+                _loop = loop
+    return _loop
+
+
+def submit(
+    coro: Coroutine[Any, Any, T], context: contextvars.Context | None = None
+) -> concurrent.futures.Future[T]:
+    """
+    把协程提交到后台事件循环, 与 asyncio.run_coroutine_threadsafe 相同,
+    但协程在调用方的上下文(或指定的上下文)中执行, 追踪span等上下文变量可跨线程传递
+    """
+    loop = get_loop()
+    context = context if context is not None else contextvars.copy_context()
+    future: concurrent.futures.Future[T] = concurrent.futures.Future()
+
+    def done(task: asyncio.Task) -> None:
+        if future.cancelled():
+            return
+        if task.cancelled():
+            future.set_exception(concurrent.futures.CancelledError())
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+
+    def start() -> None:
+        if not future.set_running_or_notify_cancel():
+            coro.close()
+            return
+        loop.create_task(coro, context=context).add_done_callback(done)
+
+    loop.call_soon_threadsafe(start)
+    return future
+
+
+def run_sync(coro: Coroutine[Any, Any, T], timeout: float | None = None) -> T:
+    """在后台事件循环中执行协程并阻塞等待结果"""
+    return submit(coro).result(timeout)
+
+
+def iter_async(agen: AsyncIterator[T]) -> Generator[T, None, None]:
+    """
+    把异步生成器桥接为同步生成器, 每产出一项就立即交给调用方
+    调用方提前结束迭代时关闭异步生成器; 各次迭代在同一个上下文中执行, 跨越yield的span可以正常结束
+    """
+    context = contextvars.copy_context()
+    try:
+        while True:
+            try:
+                item = submit(agen.__anext__(), context).result()
+            except StopAsyncIteration:
+                return
+            yield item
+    finally:
+        aclose = getattr(agen, "aclose", None)
+        if aclose is not None:
+            submit(aclose(), context).result()
@@ -0,0 +1,305 @@
+"""
+生成结果缓存
+固定随机种子时, 相同的请求体会生成相同的图片, 按请求体的规范化哈希缓存已上传的OSS链接(及可选的图片内容),
+避免重复的付费调用和上传
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import AsyncIterator, Awaitable, Callable
+from pathlib import Path
+
+import httpx
+from pydantic import BaseModel
+
+from utils.config import CacheConfig, settings
+from utils.credentials import tenant_namespace
+from utils.http_client import async_client_for
+from utils.image import UploadedImage
+from utils.singleflight import coalesce
+from utils.tracing import span
+
+
+class CacheBackend:
+    """缓存存储后端, 键为字符串, 值为字节串"""
+
+    def get(self, key: str) -> bytes | None:
+        raise NotImplementedError
+
+    def set(self, key: str, value: bytes, ttl: int | None = None) -> None:
+        raise NotImplementedError
+
+    def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+
+class MemoryBackend(CacheBackend):
+    """进程内LRU缓存, 按条目数和总字节数淘汰, 条目过期后失效"""
+
+    def __init__(self, max_items: int = 1024, max_bytes: int = 256 * 1024 * 1024, ttl: int | None = None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self._items: OrderedDict[str, tuple[float | None, bytes]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> bytes | None:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at is not None and expires_at < time.monotonic():
+                self._pop(key)
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: bytes, ttl: int | None = None) -> None:
+        ttl = ttl or self.ttl
+        with self._lock:
+            self._pop(key)
+            self._items[key] = (time.monotonic() + ttl if ttl else None, value)
+            self.size += len(value)
+            while self._items and (len(self._items) > self.max_items or self.size > self.max_bytes):
+                self._pop(next(iter(self._items)))
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._pop(key)
+
+    def _pop(self, key: str) -> None:
+        item = self._items.pop(key, None)
+        if item is not None:
+            self.size -= len(item[1])
+
+
+class DiskBackend(CacheBackend):
+    """本地磁盘缓存, 每个键一个文件, 按修改时间判断过期, 超出总大小时删除最旧的文件"""
+
+    def __init__(self, directory: Path, max_bytes: int = 1024 * 1024 * 1024, ttl: int | None = None):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+    def _path(self, key: str) -> Path:
+        return self.directory.joinpath(hashlib.sha256(key.encode("utf-8")).hexdigest())
+
+    def get(self, key: str) -> bytes | None:
+        path = self._path(key)
+        try:
+            if self.ttl and path.stat().st_mtime + self.ttl < time.time():
+                path.unlink(missing_ok=True)
+                return None
+            return path.read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def set(self, key: str, value: bytes, ttl: int | None = None) -> None:
+        path = self._path(key)
+        tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_bytes(value)
+        os.replace(tmp, path)
+        self._evict()
+
+    def delete(self, key: str) -> None:
+        self._path(key).unlink(missing_ok=True)
+
+    def _evict(self) -> None:
+        files = []
+        for path in self.directory.iterdir():
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+
+
+class RedisBackend(CacheBackend):
+    """Redis缓存, 使用 settings.redis 配置, 默认过期时间为 settings.redis_expire_time"""
+
+    def __init__(self, client=None, ttl: int | None = None):
+        if client is None:
+            import redis
+
+            client = redis.Redis.from_url(settings.redis_dsn)
+        self.client = client
+        self.ttl = ttl or settings.redis_expire_time
+
+    def get(self, key: str) -> bytes | None:
+        return self.client.get(key)
+
+    def set(self, key: str, value: bytes, ttl: int | None = None) -> None:
+        self.client.set(key, value, ex=ttl or self.ttl)
+
+    def delete(self, key: str) -> None:
+        self.client.delete(key)
+
+
+class CachedImages(BaseModel):
+    images: list[UploadedImage]
+
+
+class ResultCache:
+    """
+    生成结果缓存
+    :param backend: 存储后端
+    :param store_bytes: 是否同时缓存图片内容, 否则命中时从OSS链接重新下载
+    :param namespace: 键前缀
+    """
+
+    def __init__(self, backend: CacheBackend, store_bytes: bool = False, namespace: str = "result"):
+        self.backend = backend
+        self.store_bytes = store_bytes
+        self.namespace = namespace
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, body: dict) -> str:
+        """请求体的规范化哈希, 字段顺序不影响结果; 缓存的链接指向租户自己的OSS, 按租户区分"""
+        canonical = json.dumps(body, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+        digest = hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+        return f"{settings.app_name}:{tenant_namespace()}:{self.namespace}:{digest}"
+
+    def get(self, body: dict) -> list[UploadedImage] | None:
+        value = self.backend.get(self.key(body))
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return CachedImages.model_validate_json(value).images
+
+    def set(self, body: dict, images: list[UploadedImage]) -> None:
+        if not self.store_bytes:
+            images = [image.model_copy(update={"blob": None}) for image in images]
+        self.backend.set(self.key(body), CachedImages(images=images).model_dump_json().encode("utf-8"))
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0}
+
+
+def build_backend(config: CacheConfig) -> CacheBackend | None:
+    if config.backend == "memory":
+        return MemoryBackend(max_items=config.max_items, max_bytes=config.max_bytes, ttl=config.ttl)
+    if config.backend == "disk":
+        directory = config.directory or settings.temp_dir.joinpath("result_cache")
+        return DiskBackend(directory, max_bytes=config.max_bytes, ttl=config.ttl)
+    if config.backend == "redis":
+        return RedisBackend(ttl=config.ttl)
+    return None
+
+
+_result_cache: ResultCache | None = None
+_result_cache_lock = threading.Lock()
+
+
+def get_result_cache() -> ResultCache | None:
+    """获取进程级共享的生成结果缓存, 未启用时返回None"""
+    global _result_cache
+    if _result_cache is None:
+        with _result_cache_lock:
+            if _result_cache is None:
+                backend = build_backend(settings.cache)
+                if backend is None:
+                    return None
+                _result_cache = ResultCache(backend, store_bytes=settings.cache.store_bytes)
+    return _result_cache
+
+
+def is_deterministic(body: dict) -> bool:
+    """指定了随机种子的请求结果可复现"""
+    return body.get("seed") not in (None, -1)
+
+
+async def cached_generate(
+    body: dict, generate: Callable[[], Awaitable[list[UploadedImage]]]
+) -> list[UploadedImage]:
+    """
+    带缓存的生成调用, 仅缓存固定随机种子的请求; 同时进行的相同请求合并为一次调用, 见 utils.singleflight
+    :param body: 用于计算缓存键的请求体
+    :param generate: 未命中时执行的生成协程函数
+    """
+    seeded = is_deterministic(body)
+    images = await coalesce(body, lambda: _cached_generate(body, generate, seeded), seeded)
+    # 合并的请求共享同一组图片, 各自返回副本
+    return [image.model_copy() for image in images]
+
+
+async def cached_generate_iter(
+    body: dict, generate: Callable[[], AsyncIterator[UploadedImage]]
+) -> AsyncIterator[UploadedImage]:
+    """
+    逐张产出的 cached_generate: 实际调用上游时每张图片完成后立即产出,
+    命中缓存或合并到其它请求时在结果就绪后一次产出全部图片
+    :param generate: 未命中时执行的生成函数, 返回逐张产出图片的异步迭代器
+    """
+    queue: asyncio.Queue[UploadedImage | None] = asyncio.Queue()
+
+    async def collect() -> list[UploadedImage]:
+        images = []
+        async for image in generate():
+            images.append(image)
+            queue.put_nowait(image)
+        return images
+
+    task = asyncio.ensure_future(cached_generate(body, collect))
+    task.add_done_callback(lambda _: queue.put_nowait(None))
+    streamed = 0
+    try:
+        while (image := await queue.get()) is not None:
+            streamed += 1
+            yield image.model_copy()
+        # 结果列表按完成顺序排列, 已产出的在前
+        for image in task.result()[streamed:]:
+            yield image
+    finally:
+        task.cancel()
+
+
+async def _cached_generate(
+    body: dict, generate: Callable[[], Awaitable[list[UploadedImage]]], seeded: bool
+) -> list[UploadedImage]:
+    cache = get_result_cache()
+    if cache is None or not seeded:
+        return await generate()
+
+    images = await asyncio.to_thread(cache.get, body)
+    if images is not None:
+        missing = [image for image in images if image.blob is None and image.url]
+        try:
+            blobs = await asyncio.gather(*(_download(image.url) for image in missing))
+        except httpx.HTTPError:
+            # OSS对象已被生命周期规则删除等情况, 视为未命中
+            await asyncio.to_thread(cache.backend.delete, cache.key(body))
+        else:
+            for image, blob in zip(missing, blobs):
+                image.blob = blob
+            return images
+
+    images = await generate()
+    if images and all(image.url for image in images):
+        await asyncio.to_thread(cache.set, body, images)
+    return images
+
+
+async def _download(url: str) -> bytes:
+    with span("cache.download") as s:
+        response = await async_client_for(url).get(url)
+        s.set("status", response.status_code)
+        response.raise_for_status()
+        s.set("bytes", len(response.content))
+    return response.content
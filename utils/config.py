@@ -1,8 +1,10 @@
+import threading
 import uuid
+from functools import cached_property
 from pathlib import Path
-from typing import Any, Tuple, Type
+from typing import TYPE_CHECKING, Any, Literal, Tuple, Type, cast
 
-import httpx
+from dotenv import find_dotenv, load_dotenv
 from pydantic import BaseModel, Field, SecretStr, computed_field
 from pydantic_settings import (
     BaseSettings,
@@ -11,6 +13,9 @@ from pydantic_settings import (
     TomlConfigSettingsSource,
 )
 
+if TYPE_CHECKING:
+    import httpx
+
 
 class MidjourneyConfig(BaseModel):
     user_token: str
@@ -43,6 +48,193 @@ class AliyunOssConfig(BaseModel):
     path_prefix: str = "midjourney_simple_api"
 
 
+class HttpPoolConfig(BaseModel):
+    """单个上游的HTTP连接池及超时配置"""
+
+    hosts: list[str] = Field([], title="匹配的域名", description="域名或其上级域名, 如 aliyuncs.com")
+    http2: bool = True
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+    keepalive_expiry: float = 30
+    connect_timeout: float = 10
+    read_timeout: float = 60
+    write_timeout: float = 60
+    pool_timeout: float = 10
+
+
+class HttpConfig(BaseModel):
+    volcengine: HttpPoolConfig = HttpPoolConfig(hosts=["visual.volcengineapi.com"])
+    ark: HttpPoolConfig = HttpPoolConfig(hosts=["ark.cn-beijing.volces.com"])
+    oss: HttpPoolConfig = HttpPoolConfig(hosts=["aliyuncs.com"], max_keepalive_connections=16)
+    default: HttpPoolConfig = HttpPoolConfig()
+
+
+class CacheConfig(BaseModel):
+    """生成结果缓存配置"""
+
+    backend: Literal["none", "memory", "disk", "redis"] = "memory"
+    ttl: int | None = Field(60 * 60 * 24, title="过期时间(秒)", description="为空时redis使用redis_expire_time")
+    max_items: int = 1024
+    max_bytes: int = 256 * 1024 * 1024
+    store_bytes: bool = Field(False, title="是否缓存图片内容", description="否则命中时从OSS重新下载")
+    directory: Path | None = Field(None, title="磁盘缓存目录", description="默认为temp_dir/result_cache")
+
+
+class SingleFlightConfig(BaseModel):
+    """相同请求合并配置, 同时进行的相同生成请求只调用一次上游, 共享生成结果(OSS链接和图片内容)"""
+
+    enabled: bool = True
+    unseeded_window: float = Field(
+        0,
+        ge=0,
+        title="未固定随机种子的请求合并窗口(秒)",
+        description="在首个请求开始后该时间内到达的相同请求共享同一结果(同一张图片); 为0时只合并固定随机种子的请求",
+    )
+
+
+class StagingConfig(BaseModel):
+    """图生图等工具的输入图片暂存配置, 按内容哈希复用已上传的OSS链接"""
+
+    prefix: str = Field("staging", title="OSS目录", description="需为该目录配置与ttl一致的生命周期规则")
+    ttl: int = Field(60 * 60 * 24, title="OSS生命周期(秒)", description="暂存对象在OSS上的保留时间")
+    margin: int = Field(
+        60 * 10, title="提前失效时间(秒)", description="剩余有效期不足该值时重新上传, 保证上游拉取图片时链接仍有效"
+    )
+    min_side: int = Field(512, title="最短边下限")
+    max_side: int = Field(2048, title="最长边上限")
+    quality: int = Field(90, title="重新编码的JPEG质量")
+    backend: Literal["memory", "redis"] = Field("memory", title="暂存索引存储", description="多进程部署时使用redis共享")
+    max_items: int = 4096
+
+
+class DownloadConfig(BaseModel):
+    """链接转文件等工具下载外部链接的配置"""
+
+    max_bytes: int = Field(50 * 1024 * 1024, title="单个文件大小上限")
+    timeout: float = Field(60, title="单个文件下载超时(秒)", description="包括排队、连接和读取响应体的总时间")
+    concurrency: int = Field(4, ge=1, title="并行下载数")
+    max_urls: int = Field(20, ge=1, title="单次调用最多下载的链接数")
+    cache: bool = Field(True, title="是否启用磁盘缓存", description="按ETag/Last-Modified发送条件请求, 未修改时使用本地副本")
+    cache_directory: Path | None = Field(None, title="磁盘缓存目录", description="默认为temp_dir/url_cache")
+    cache_max_bytes: int = Field(512 * 1024 * 1024, title="磁盘缓存总大小上限", description="超出时删除最久未使用的文件")
+
+
+class TenantConfig(BaseModel):
+    """多租户凭证配置, Dify传入的供应商凭证中未填写的项使用环境变量"""
+
+    idle_ttl: int = Field(60 * 60, title="空闲租户的保留时间(秒)", description="超过该时间未使用的租户释放其签名器和OSS连接")
+    max_tenants: int = Field(256, ge=1, title="最多保留的租户数", description="超出时移除最久未使用的租户")
+    validate_timeout: float = Field(15, title="凭证校验超时(秒)")
+
+
+class CoordinationConfig(BaseModel):
+    """多副本部署时通过Redis在所有副本间共享的并发、限流与额度控制, 需要配置redis"""
+
+    enabled: bool = Field(False, title="是否启用")
+    concurrency: dict[str, int] = Field(
+        {"volcengine": 8, "ark": 8}, title="各上游的全局并发生成数", description="所有副本合计, 未列出的上游不限制"
+    )
+    lease: float = Field(60, gt=0, title="并发名额租约(秒)", description="持有期间定期续约, 副本异常退出后名额在租约到期后释放")
+    acquire_timeout: float = Field(60, title="等待并发名额的时限(秒)")
+    rate_window: float = Field(
+        1, gt=0, title="限流滑动窗口(秒)", description="各限流器按 ratelimit 中的每秒请求数在所有副本间共享"
+    )
+    monthly_quota: int | None = Field(None, ge=0, title="每月图片总额度", description="为空时不限制")
+    tenant_monthly_quota: int | None = Field(None, ge=0, title="每个租户每月图片额度", description="为空时不限制")
+
+
+class ExecutorConfig(BaseModel):
+    """CPU密集型图片处理(解码、缩放、编码、base64解码、哈希)的工作池配置"""
+
+    processes: bool = Field(True, title="图片编解码使用进程池", description="false时使用线程池")
+    max_workers: int | None = Field(None, title="进程数", description="为空时等于CPU核数")
+    thread_workers: int = Field(4, title="线程池大小", description="用于哈希和base64解码等不便跨进程传递的任务, gevent环境下为原生线程")
+    max_queue: int = Field(32, title="排队上限", description="每个工作池在执行中的任务之外最多排队的任务数")
+    max_wait: float = Field(30, title="排队等待上限(秒)", description="排队已满时等待空位的最长时间, 超时抛出PoolBusyError")
+
+
+class TracingConfig(BaseModel):
+    """分阶段耗时追踪与指标导出配置, 未启用时span为空操作"""
+
+    enabled: bool = False
+    span_file: Path | None = Field(
+        None, title="span文件", description="OTLP JSON格式, 每行一批, 可由OpenTelemetry Collector的otlpjsonfile接收器读取"
+    )
+    prometheus_file: Path | None = Field(
+        None, title="指标文件", description="Prometheus文本格式, 供node_exporter的textfile收集器读取"
+    )
+    prometheus_port: int | None = Field(None, title="指标端口", description="在该端口的 /metrics 提供Prometheus文本格式指标")
+    flush_interval: float = Field(10, title="导出间隔(秒)")
+    max_buffer: int = Field(1024, title="span缓冲上限", description="缓冲的span达到该数量时立即写出")
+
+
+class VolcengineConfig(BaseModel):
+    """火山引擎智能视觉服务调用配置"""
+
+    mode: Literal["sync", "async_task"] = Field(
+        "sync", title="调用方式", description="sync: CVProcess同步调用; async_task: 提交任务后轮询结果"
+    )
+    poll_interval: float = Field(1.0, title="首次轮询间隔(秒)")
+    poll_max_interval: float = Field(8.0, title="最大轮询间隔(秒)")
+    poll_backoff: float = Field(1.5, title="轮询间隔增长倍数")
+    stream_response: bool = Field(
+        False,
+        title="流式解析响应",
+        description="同步调用时边读取响应边逐张解码上传, 峰值内存为单张图片而不是整个响应",
+    )
+
+
+class UpstreamRateLimit(BaseModel):
+    """单个上游(或其某个算法/模型)的限流与重试配置"""
+
+    rate_limit: int | float = Field(5, title="每秒请求数", description="收到限流响应后自动下调, 请求成功后逐步恢复")
+    burst: int | float | None = Field(None, title="突发请求数", description="为空时取 max(rate_limit, 1)")
+    min_rate_limit: int | float = Field(0.1, title="下调后的最低每秒请求数")
+    max_attempts: int = Field(4, title="最多尝试次数", description="包含首次请求")
+    backoff_base: float = Field(0.5, title="重试退避基数(秒)")
+    backoff_max: float = Field(10, title="单次重试最长等待(秒)")
+    deadline: float | None = Field(None, title="含重试的总时限(秒)", description="为空时取 wait_max_seconds")
+
+
+class RateLimitConfig(BaseModel):
+    """上游限流配置, keys 按 `上游:算法/模型` 覆盖, 如 volcengine:high_aes_general_v30l_zt2i, ark:doubao-seededit-3-0-i2i-250628"""
+
+    volcengine: UpstreamRateLimit = UpstreamRateLimit()
+    volcengine_result: UpstreamRateLimit = Field(UpstreamRateLimit(rate_limit=10), title="异步任务结果查询")
+    ark: UpstreamRateLimit = UpstreamRateLimit()
+    default: UpstreamRateLimit = UpstreamRateLimit(rate_limit=10)
+    keys: dict[str, UpstreamRateLimit] = {}
+
+    def for_key(self, upstream: str, key: str | None = None) -> UpstreamRateLimit:
+        if key is not None and f"{upstream}:{key}" in self.keys:
+            return self.keys[f"{upstream}:{key}"]
+        config = getattr(self, upstream, None)
+        return config if isinstance(config, UpstreamRateLimit) else self.default
+
+
+class HedgeConfig(BaseModel):
+    """对冲请求配置, 请求超过近期耗时分位数仍未返回时再发一个相同请求, 取先完成的结果"""
+
+    enabled: bool = Field(False, title="是否启用", description="对冲请求会产生额外的生成费用")
+    upstreams: list[str] = Field(["ark"], title="启用对冲的上游")
+    percentile: float = Field(0.95, gt=0, lt=1, title="触发对冲的耗时分位数")
+    initial_delay: float = Field(10, title="样本不足时的对冲延迟(秒)")
+    min_delay: float = Field(0.5, title="最短对冲延迟(秒)")
+    min_samples: int = Field(20, title="计算分位数所需的最少样本数")
+    window: int = Field(200, title="保留的最近耗时样本数")
+
+
+class BreakerConfig(BaseModel):
+    """按端点熔断配置, 近期错误率超过阈值时快速失败或切换到备用端点"""
+
+    enabled: bool = True
+    error_rate: float = Field(0.5, gt=0, le=1, title="熔断错误率")
+    min_requests: int = Field(10, title="统计窗口内的最少请求数")
+    window: float = Field(60, title="统计窗口(秒)")
+    open_seconds: float = Field(30, title="熔断持续时间(秒)", description="到期后放行一个探测请求, 成功则恢复")
+    fallback_urls: dict[str, str] = Field({}, title="备用端点", description="端点地址 -> 备用端点地址")
+
+
 class LLMConfig(BaseModel):
     base_url: str
     api_key: str
@@ -70,13 +262,31 @@ class Settings(BaseSettings):
     app_name: str = "ai-tools"
     httpx_timeout: int = 60
     wait_max_seconds: int = 60 * 2
-    midjourney: MidjourneyConfig = None
+    blob_max_bytes: int = Field(10 * 1024 * 1024, title="blob消息保留图片内容的上限")
+    emit_source_url: bool = Field(
+        True, title="是否先返回上游图片链接", description="图片编辑在上游返回结果后立即以JSON消息返回其链接, 再转存到OSS"
+    )
+    midjourney: MidjourneyConfig | None = None
     project_dir: Path = Path(__file__).parent.parent
     temp_dir: Path = project_dir.joinpath("temp")
-    oss: AliyunOssConfig = None
+    oss: AliyunOssConfig | None = None
     proxy_url: str | None = "http://127.0.0.1:7890"
     redis: RedisConfig | None = None
     redis_expire_time: int = 60 * 60 * 24 * 30
+    http: HttpConfig = Field(default_factory=HttpConfig, title="上游HTTP连接池配置")
+    cache: CacheConfig = Field(default_factory=CacheConfig, title="生成结果缓存配置")
+    singleflight: SingleFlightConfig = Field(default_factory=SingleFlightConfig, title="相同请求合并配置")
+    tracing: TracingConfig = Field(default_factory=TracingConfig, title="追踪与指标配置")
+    executor: ExecutorConfig = Field(default_factory=ExecutorConfig, title="图片处理工作池配置")
+    staging: StagingConfig = Field(default_factory=StagingConfig, title="输入图片暂存配置")
+    download: DownloadConfig = Field(default_factory=DownloadConfig, title="外部链接下载配置")
+    tenants: TenantConfig = Field(default_factory=TenantConfig, title="多租户凭证配置")
+    coordination: CoordinationConfig = Field(default_factory=CoordinationConfig, title="多副本协调配置")
+    files_url: str = Field("http://agent.aimark.net.cn", title="Dify文件服务地址", description="用于补全相对路径的文件链接")
+    volcengine: VolcengineConfig = Field(default_factory=VolcengineConfig, title="火山引擎视觉服务配置")
+    ratelimit: RateLimitConfig = Field(default_factory=RateLimitConfig, title="上游限流与重试配置")
+    hedge: HedgeConfig = Field(default_factory=HedgeConfig, title="对冲请求配置")
+    breaker: BreakerConfig = Field(default_factory=BreakerConfig, title="熔断配置")
     llms: LLMProvider | None = Field(None, title="LLM提供商配置")
     solutions: SolutionConfig | None = Field(None, title="解决方案配置")
     apps: Any | None = Field(None, title="多应用配置")
@@ -86,9 +296,13 @@ class Settings(BaseSettings):
 
     @computed_field
     @property
-    def redis_dsn(self) -> str:
+    def redis_dsn(self) -> str | None:
+        if self.redis is None:
+            return None
+        # 未设置密码时为默认值空字符串, 不是SecretStr
+        password = self.redis.password.get_secret_value() if self.redis.password else ""
         return (
-            f"redis://:{self.redis.password.get_secret_value() or ''}@{self.redis.host}:{self.redis.port}/"
+            f"redis://:{password}@{self.redis.host}:{self.redis.port}/"
             f"{self.redis.db}?health_check_interval=2"
         )
 
@@ -138,18 +352,50 @@ class Settings(BaseSettings):
             TomlConfigSettingsSource(settings_cls),
         )
 
-    @computed_field
-    @property
-    def http_client(self) -> httpx.Client:
-        return httpx.Client(proxy=self.proxy_url or "http://127.0.0.1:7890")
+    @cached_property
+    def http_client(self) -> "httpx.Client":
+        import httpx
+
+        return httpx.Client(proxy=self.proxy_url or "http://127.0.0.1:7890", timeout=self.httpx_timeout)
+
+    @cached_property
+    def http_client_async(self) -> "httpx.AsyncClient":
+        import httpx
+
+        return httpx.AsyncClient(proxy=self.proxy_url or "http://127.0.0.1:7890", timeout=self.httpx_timeout)
+
+
+_settings: Settings | None = None
+_settings_lock = threading.Lock()
+
+
+def get_settings() -> Settings:
+    """获取配置, 首次调用时读取环境变量及TOML配置文件, 进程内只加载一次"""
+    global _settings
+    if _settings is None:
+        with _settings_lock:
+            if _settings is None:
+                _settings = Settings()
+    return _settings
+
+
+class _LazySettings:
+    """延迟加载的配置, 兼容 `from utils.config import settings` 的用法, 首次读取属性时才加载"""
+
+    def __getattr__(self, name: str):
+        return getattr(get_settings(), name)
+
+    def __setattr__(self, name: str, value) -> None:
+        setattr(get_settings(), name, value)
+
+    def __repr__(self) -> str:
+        return repr(get_settings()) if _settings is not None else "<settings (not loaded)>"
 
-    @computed_field
-    @property
-    def http_client_async(self) -> httpx.AsyncClient:
-        return httpx.AsyncClient(proxy=self.proxy_url or "http://127.0.0.1:7890")
 
+# 未在Dify中填写的凭证从环境变量读取, 在此统一加载一次.env, 各模块不再重复查找
+load_dotenv(find_dotenv())
 
-settings = Settings()
+settings = cast(Settings, _LazySettings())
 
 if __name__ == "__main__":
     print(settings.midjourney)
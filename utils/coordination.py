@@ -0,0 +1,384 @@
+"""
+多副本协调
+多个插件副本共用上游的QPS限制和每月图片额度, 进程内的限流器彼此不可见. 启用后通过Redis在所有副本间共享:
+- 全局并发: 每个上游的生成请求需先取得名额, 名额带租约并定期续约, 副本异常退出后租约到期自动释放
+- 全局限流: 每次HTTP请求前按限流器名称做滑动窗口计数, 速率取 ratelimit 中的配置
+- 额度与用量: 按月统计总用量和各租户用量, 超出额度时拒绝生成, 失败的生成退还额度
+判断与计数在Lua脚本中原子完成, 时间取Redis服务器时间, 不受各副本时钟偏差影响.
+Redis不可用时放行并计数, 仍受进程内限流器约束
+"""
+
+import asyncio
+import random
+import threading
+import time
+import uuid
+import weakref
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from typing import Any
+
+from utils.config import CoordinationConfig, settings
+from utils.credentials import tenant_namespace
+from utils.tracing import span
+
+# KEYS[1] 持有者有序集合(分值为租约到期时间); ARGV: 持有者, 上限, 租约毫秒
+SEMAPHORE_ACQUIRE = """
+local t = redis.call('TIME')
+local now = t[1] * 1000 + math.floor(t[2] / 1000)
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[2]) then
+    redis.call('ZADD', KEYS[1], now + tonumber(ARGV[3]), ARGV[1])
+    redis.call('PEXPIRE', KEYS[1], ARGV[3])
+    return 1
+end
+return 0
+"""
+
+# KEYS[1] 持有者有序集合; ARGV: 持有者, 租约毫秒; 名额已过期被回收时返回0
+SEMAPHORE_RENEW = """
+local t = redis.call('TIME')
+local now = t[1] * 1000 + math.floor(t[2] / 1000)
+local expires = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if not expires or tonumber(expires) < now then
+    return 0
+end
+redis.call('ZADD', KEYS[1], now + tonumber(ARGV[2]), ARGV[1])
+redis.call('PEXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+# KEYS[1] 窗口内的请求时间; ARGV: 请求标识, 上限, 窗口毫秒; 放行时返回0, 否则返回需要等待的毫秒数
+SLIDING_WINDOW = """
+local t = redis.call('TIME')
+local now = t[1] * 1000 + math.floor(t[2] / 1000)
+local window = tonumber(ARGV[3])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - window)
+if redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[2]) then
+    redis.call('ZADD', KEYS[1], now, ARGV[1])
+    redis.call('PEXPIRE', KEYS[1], window)
+    return 0
+end
+local oldest = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+return math.max(tonumber(oldest[2]) + window - now, 1)
+"""
+
+# KEYS: 本月总用量, 本月租户用量; ARGV: 数量, 总额度, 租户额度(0为不限), 过期秒数
+# 预留成功返回1, 超出总额度返回-1, 超出租户额度返回-2
+QUOTA_RESERVE = """
+local n = tonumber(ARGV[1])
+local total = tonumber(redis.call('GET', KEYS[1]) or '0')
+local tenant = tonumber(redis.call('GET', KEYS[2]) or '0')
+if tonumber(ARGV[2]) > 0 and total + n > tonumber(ARGV[2]) then
+    return -1
+end
+if tonumber(ARGV[3]) > 0 and tenant + n > tonumber(ARGV[3]) then
+    return -2
+end
+redis.call('INCRBY', KEYS[1], n)
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+redis.call('INCRBY', KEYS[2], n)
+redis.call('EXPIRE', KEYS[2], ARGV[4])
+return 1
+"""
+
+# KEYS: 本月总用量, 本月租户用量, 本月租户明细; ARGV: 与预留数量的差额, 上游, 图片数, 是否失败, 过期秒数
+QUOTA_COMMIT = """
+local delta = tonumber(ARGV[1])
+if delta ~= 0 then
+    redis.call('INCRBY', KEYS[1], delta)
+    redis.call('INCRBY', KEYS[2], delta)
+end
+redis.call('HINCRBY', KEYS[3], ARGV[2] .. ':requests', 1)
+redis.call('HINCRBY', KEYS[3], ARGV[2] .. ':images', ARGV[3])
+redis.call('HINCRBY', KEYS[3], ARGV[2] .. ':failures', ARGV[4])
+redis.call('EXPIRE', KEYS[3], ARGV[5])
+return 1
+"""
+
+# 用量计数保留到下个月之后, 便于对账
+USAGE_TTL = 62 * 24 * 60 * 60
+
+
+class QuotaExceededError(Exception):
+    """本月图片额度已用完"""
+
+
+class Generation:
+    """
+    一次生成的额度记录, 生成完成后把实际图片数写入 images, 逐张上传时每上传一张累加 uploaded
+    :param images: 预计的图片数, 限制额度时预先扣除, 生成失败或被取消时退还未上传的部分
+    """
+
+    def __init__(self, upstream: str, tenant: str, images: int = 1):
+        self.upstream = upstream
+        self.tenant = tenant
+        self.reserved = images
+        self.images = images
+        self.uploaded = 0
+        self.failed = False
+
+
+class Coordinator:
+    """
+    基于Redis的跨副本并发、限流与额度控制
+    :param config: 协调配置
+    :param client: redis.asyncio 客户端, 为空时按事件循环从 settings.redis_dsn 创建
+    """
+
+    def __init__(self, config: CoordinationConfig, client: Any = None):
+        from redis.exceptions import RedisError
+
+        self.config = config
+        self.prefix = f"{settings.app_name}:coord"
+        self._client = client
+        self._errors = (RedisError, OSError)
+        # 客户端的连接绑定在创建它的事件循环上, 按事件循环分别缓存, 脚本随客户端注册
+        self._loops: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, tuple]" = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self.slot_waits = 0
+        self.slot_wait_seconds = 0.0
+        self.throttled = 0
+        self.lost_leases = 0
+        self.quota_rejections = 0
+        self.redis_errors = 0
+
+    def _scripts(self) -> tuple:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            scripts = self._loops.get(loop)
+            if scripts is None:
+                client = self._client
+                if client is None:
+                    import redis.asyncio
+
+                    client = redis.asyncio.Redis.from_url(settings.redis_dsn)
+                scripts = self._loops[loop] = (
+                    client,
+                    client.register_script(SEMAPHORE_ACQUIRE),
+                    client.register_script(SEMAPHORE_RENEW),
+                    client.register_script(SLIDING_WINDOW),
+                    client.register_script(QUOTA_RESERVE),
+                    client.register_script(QUOTA_COMMIT),
+                )
+        return scripts
+
+    def _month(self) -> str:
+        return datetime.now(timezone.utc).strftime("%Y%m")
+
+    def _quota_keys(self, tenant: str) -> list[str]:
+        month = self._month()
+        return [f"{self.prefix}:quota:{month}:total", f"{self.prefix}:quota:{month}:{tenant}"]
+
+    async def _backoff(self, attempt: int) -> None:
+        await asyncio.sleep(min(0.02 * 2**attempt, 0.5) * random.uniform(0.5, 1))
+
+    @asynccontextmanager
+    async def slot(self, upstream: str) -> AsyncIterator[None]:
+        """
+        占用上游的一个全局并发名额, 未配置该上游的并发数时直接放行
+        :raise TimeoutError: 超过 acquire_timeout 仍未取得名额
+        """
+        limit = self.config.concurrency.get(upstream)
+        if not limit:
+            yield
+            return
+        client, acquire, renew, *_ = self._scripts()
+        key = f"{self.prefix}:slots:{upstream}"
+        token = uuid.uuid4().hex
+        lease_ms = int(self.config.lease * 1000)
+        start = time.monotonic()
+        acquired = False
+        with span("coordination.slot", upstream=upstream) as s:
+            attempt = 0
+            while True:
+                try:
+                    acquired = bool(await acquire(keys=[key], args=[token, limit, lease_ms]))
+                except self._errors:
+                    self.redis_errors += 1
+                    break
+                if acquired:
+                    break
+                if time.monotonic() - start > self.config.acquire_timeout:
+                    raise TimeoutError(f"{upstream} 等待全局并发名额超过{self.config.acquire_timeout}秒")
+                await self._backoff(attempt)
+                attempt += 1
+            waited = time.monotonic() - start
+            s.set("wait_ms", round(waited * 1000, 1)).set("acquired", acquired)
+        if attempt:
+            self.slot_waits += 1
+            self.slot_wait_seconds += waited
+
+        async def keep_alive() -> None:
+            while True:
+                await asyncio.sleep(self.config.lease / 3)
+                try:
+                    if not await renew(keys=[key], args=[token, lease_ms]):
+                        self.lost_leases += 1
+                        return
+                except self._errors:
+                    self.redis_errors += 1
+
+        renewer = asyncio.ensure_future(keep_alive()) if acquired else None
+        try:
+            yield
+        finally:
+            if renewer is not None:
+                renewer.cancel()
+                try:
+                    await client.zrem(key, token)
+                except self._errors:
+                    self.redis_errors += 1
+
+    async def throttle(self, name: str, rate: float, deadline: float | None = None) -> None:
+        """
+        按滑动窗口在所有副本间限流, 窗口内请求数达到上限时等待到最早的请求移出窗口
+        :param name: 限流器名称, 如 volcengine:high_aes_general_v30l_zt2i
+        :param rate: 所有副本合计的每秒请求数
+        :param deadline: time.monotonic() 时间点, 等待会超过该时间时抛出TimeoutError
+        """
+        window = self.config.rate_window
+        limit = max(round(rate * window), 1)
+        script = self._scripts()[3]
+        key = f"{self.prefix}:rate:{name}"
+        member = uuid.uuid4().hex
+        while True:
+            try:
+                wait_ms = await script(keys=[key], args=[member, limit, int(window * 1000)])
+            except self._errors:
+                self.redis_errors += 1
+                return
+            if not wait_ms:
+                return
+            delay = wait_ms / 1000 * random.uniform(1, 1.2)
+            if deadline is not None and time.monotonic() + delay > deadline:
+                raise TimeoutError(f"{name} 全局限流等待超过时限")
+            self.throttled += 1
+            await asyncio.sleep(delay)
+
+    async def reserve(self, generation: Generation) -> None:
+        """
+        预留本次生成的图片额度
+        :raise QuotaExceededError: 总额度或租户额度不足
+        """
+        config = self.config
+        if config.monthly_quota is None and config.tenant_monthly_quota is None:
+            # 不限额度时不预留, 结算时按实际图片数累加用量
+            generation.reserved = 0
+            return
+        script = self._scripts()[4]
+        try:
+            result = await script(
+                keys=self._quota_keys(generation.tenant),
+                args=[generation.reserved, config.monthly_quota or 0, config.tenant_monthly_quota or 0, USAGE_TTL],
+            )
+        except self._errors:
+            self.redis_errors += 1
+            generation.reserved = 0
+            return
+        if result < 0:
+            self.quota_rejections += 1
+            quota = config.monthly_quota if result == -1 else config.tenant_monthly_quota
+            scope = "插件" if result == -1 else "当前租户"
+            raise QuotaExceededError(f"{scope}本月图片额度({quota}张)已用完")
+
+    async def commit(self, generation: Generation) -> None:
+        """按实际图片数修正预留的额度, 并累加租户的用量明细"""
+        # 失败前已上传的图片可能已交给调用方, 仍计入用量
+        images = generation.uploaded if generation.failed else generation.images
+        delta = images - generation.reserved
+        script = self._scripts()[5]
+        keys = [*self._quota_keys(generation.tenant), f"{self.prefix}:usage:{self._month()}:{generation.tenant}"]
+        try:
+            await script(keys=keys, args=[delta, generation.upstream, images, int(generation.failed), USAGE_TTL])
+        except self._errors:
+            self.redis_errors += 1
+
+    @asynccontextmanager
+    async def generation(self, upstream: str, images: int = 1) -> AsyncIterator[Generation]:
+        """预留当前租户的额度并占用上游的并发名额, 结束时按实际图片数结算"""
+        generation = Generation(upstream, tenant_namespace(), images)
+        await self.reserve(generation)
+        try:
+            async with self.slot(upstream):
+                yield generation
+        except Exception:
+            generation.failed = True
+            raise
+        except BaseException:
+            # 调用方取消或提前结束迭代(GeneratorExit)不是生成失败, 按已上传的图片数结算
+            generation.images = generation.uploaded
+            raise
+        finally:
+            await self.commit(generation)
+
+    async def usage(self, tenant: str | None = None, month: str | None = None) -> dict:
+        """租户(默认为当前租户)本月的用量, 包括额度内的图片数和各上游的请求数、图片数、失败数"""
+        tenant = tenant or tenant_namespace()
+        month = month or self._month()
+        client = self._scripts()[0]
+        total, used = await client.mget(f"{self.prefix}:quota:{month}:total", f"{self.prefix}:quota:{month}:{tenant}")
+        details = await client.hgetall(f"{self.prefix}:usage:{month}:{tenant}")
+        return {
+            "month": month,
+            "tenant": tenant,
+            "images": int(used or 0),
+            "total_images": int(total or 0),
+            **{k.decode(): int(v) for k, v in sorted(details.items())},
+        }
+
+    def metrics(self) -> dict:
+        return {
+            "slot_waits": self.slot_waits,
+            "slot_wait_seconds": round(self.slot_wait_seconds, 3),
+            "throttled": self.throttled,
+            "lost_leases": self.lost_leases,
+            "quota_rejections": self.quota_rejections,
+            "redis_errors": self.redis_errors,
+        }
+
+
+_UNSET: Any = object()
+_coordinator: Coordinator | None = _UNSET
+_coordinator_lock = threading.Lock()
+
+
+def get_coordinator() -> Coordinator | None:
+    """获取进程级共享的协调器, 未启用或未配置redis时返回None"""
+    global _coordinator
+    if _coordinator is _UNSET:
+        with _coordinator_lock:
+            if _coordinator is _UNSET:
+                config = settings.coordination
+                _coordinator = Coordinator(config) if config.enabled and settings.redis is not None else None
+    return _coordinator
+
+
+@asynccontextmanager
+async def generation_slot(upstream: str, images: int = 1) -> AsyncIterator[Generation]:
+    """
+    生成请求的全局名额与额度, 未启用协调时只记录不限制
+    :param upstream: 上游名称, 如 volcengine, ark
+    :param images: 预计生成的图片数
+    :raise QuotaExceededError: 本月额度不足
+    """
+    coordinator = _coordinator if _coordinator is not _UNSET else get_coordinator()
+    if coordinator is None:
+        yield Generation(upstream, "", images)
+        return
+    async with coordinator.generation(upstream, images) as generation:
+        yield generation
+
+
+async def throttle(name: str, rate: float, deadline: float | None = None) -> None:
+    """在所有副本间按滑动窗口限流, 未启用协调时直接返回"""
+    coordinator = _coordinator if _coordinator is not _UNSET else get_coordinator()
+    if coordinator is not None:
+        await coordinator.throttle(name, rate, deadline)
+
+
+def coordination_metrics() -> dict | None:
+    """协调器的等待与错误计数, 未启用时返回None"""
+    coordinator = _coordinator if _coordinator is not _UNSET else get_coordinator()
+    return coordinator.metrics() if coordinator is not None else None
@@ -0,0 +1,344 @@
+"""
+多租户凭证
+Dify按租户传入供应商凭证, 未填写的项使用环境变量. 按凭证指纹缓存签名器、方舟请求头和OSS上传器等长期对象,
+热路径上只需一次字典查找; 空闲超过 idle_ttl 的租户被移除.
+凭证在Dify保存供应商配置时由 validate_credentials 对各上游做一次真实的鉴权检查, 而不是在生成中途失败.
+HTTP连接池仍按上游共享, 租户之间只区分签名和鉴权头
+"""
+
+import asyncio
+import hashlib
+import os
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import TYPE_CHECKING
+
+import httpx
+from pydantic import BaseModel, ConfigDict
+
+from utils.config import settings
+
+if TYPE_CHECKING:
+    from utils.image import OssUploader
+    from utils.volcengine import Params, Signer
+
+# 凭证名 -> 未填写时读取的环境变量
+CREDENTIAL_ENV = {
+    "seedream_access_key": "SEEDREAM_ACCESS_KEY",
+    "seedream_secret_key": "SEEDREAM_SECRET_KEY",
+    "seedream_base_url": "SEEDREAM_BASE_URL",
+    "ark_api_key": "ARK_API_KEY",
+    "ark_base_url": "ARK_BASE_URL",
+    "oss_endpoint": "OSS_ENDPOINT",
+    "oss_access_key_id": "OSS_ACCESS_KEY_ID",
+    "oss_access_key_secret": "OSS_ACCESS_KEY_SECRET",
+    "oss_bucket_name": "OSS_BUCKET_NAME",
+    "oss_domain": "OSS_DOMAIN",
+}
+
+# 智能视觉服务表示签名或AccessKey无效的错误码
+VOLCENGINE_AUTH_ERRORS = {"SignatureDoesNotMatch", "InvalidAccessKey", "InvalidAuthorization", "AccessDenied"}
+
+
+class CredentialError(Exception):
+    """凭证缺失或未通过上游鉴权"""
+
+
+class TenantCredentials(BaseModel):
+    """单个租户的凭证"""
+
+    model_config = ConfigDict(frozen=True)
+
+    seedream_access_key: str | None = None
+    seedream_secret_key: str | None = None
+    seedream_base_url: str = "https://visual.volcengineapi.com"
+    ark_api_key: str | None = None
+    ark_base_url: str = "https://ark.cn-beijing.volces.com/api/v3"
+    oss_endpoint: str | None = None
+    oss_access_key_id: str | None = None
+    oss_access_key_secret: str | None = None
+    oss_bucket_name: str | None = None
+    oss_domain: str | None = None
+
+    @classmethod
+    def resolve(cls, credentials: dict | None) -> "TenantCredentials":
+        """Dify传入的凭证, 未填写的项使用环境变量"""
+        values = {}
+        for name, env in CREDENTIAL_ENV.items():
+            value = (credentials or {}).get(name) or os.getenv(env)
+            if value and str(value).strip():
+                values[name] = str(value).strip()
+        return cls(**values)
+
+    def fingerprint(self) -> str:
+        """凭证指纹, 不可逆推出密钥, 用作租户的缓存键和命名空间"""
+        data = "\0".join(getattr(self, name) or "" for name in CREDENTIAL_ENV)
+        return hashlib.blake2b(data.encode("utf-8"), digest_size=16).hexdigest()
+
+    @property
+    def has_volcengine(self) -> bool:
+        return bool(self.seedream_access_key or self.seedream_secret_key)
+
+    @property
+    def has_oss(self) -> bool:
+        return any((self.oss_endpoint, self.oss_access_key_id, self.oss_access_key_secret, self.oss_bucket_name))
+
+
+class Tenant:
+    """
+    单个租户的长期对象, 签名器和请求头在创建时构建, OSS上传器在首次使用时创建
+    :param credentials: 已合并环境变量的凭证
+    """
+
+    def __init__(self, credentials: TenantCredentials):
+        self.credentials = credentials
+        self.fingerprint = credentials.fingerprint()
+        self.last_used = time.monotonic()
+        self.validated_at: float | None = None
+        self._uploader: "OssUploader | None" = None
+        self._lock = threading.Lock()
+        self.signer: "Signer | None" = None
+        self._params: "Params | None" = None
+        if credentials.seedream_access_key and credentials.seedream_secret_key:
+            from utils.volcengine import Params, get_signer
+
+            self.signer = get_signer(credentials.seedream_access_key, credentials.seedream_secret_key)
+            self._params = Params(
+                access_key=credentials.seedream_access_key,
+                secret_key=credentials.seedream_secret_key,
+                base_url=credentials.seedream_base_url,
+                body={},
+            )
+        self.ark_headers: dict | None = None
+        if credentials.ark_api_key:
+            self.ark_headers = {"Content-Type": "application/json", "Authorization": f"Bearer {credentials.ark_api_key}"}
+
+    @property
+    def ark_url(self) -> str:
+        return self.credentials.ark_base_url.rstrip("/") + "/images/generations"
+
+    def volcengine_params(self, body: dict, **kwargs) -> "Params":
+        """使用本租户凭证的智能视觉服务请求参数, 复制预先构建的模板, 不再逐个校验字段"""
+        if self._params is None:
+            raise CredentialError("未配置智能视觉服务的AccessKey")
+        return self._params.model_copy(update={"body": body, **kwargs})
+
+    @property
+    def uploader(self) -> "OssUploader":
+        """本租户的OSS上传器, 复用已认证的Bucket和连接池"""
+        if self._uploader is None:
+            with self._lock:
+                if self._uploader is None:
+                    from utils.image import OssUploader
+
+                    c = self.credentials
+                    if not all((c.oss_endpoint, c.oss_access_key_id, c.oss_access_key_secret, c.oss_bucket_name)):
+                        raise CredentialError("OSS配置不完整, 需要Endpoint、AccessKey和Bucket")
+                    self._uploader = OssUploader(
+                        endpoint=c.oss_endpoint,
+                        access_key_id=c.oss_access_key_id,
+                        access_key_secret=c.oss_access_key_secret,
+                        bucket_name=c.oss_bucket_name,
+                        domain=c.oss_domain,
+                        pool_size=settings.http.oss.max_keepalive_connections,
+                        connect_timeout=settings.http.oss.connect_timeout,
+                    )
+        return self._uploader
+
+    def close(self) -> None:
+        uploader, self._uploader = self._uploader, None
+        if uploader is not None:
+            uploader.session.session.close()
+
+    async def _check_volcengine(self) -> str | None:
+        from utils.http_client import get_async_client
+        from utils.volcengine import CVAction, action_query, build_url, dump_body
+
+        if self.signer is None:
+            return "智能视觉服务需要同时填写AccessKey和SecretKey"
+        # 查询不存在的异步任务: 不产生费用, 签名和AccessKey无效时返回401/403
+        params = self.volcengine_params(
+            {"req_key": "high_aes_general_v30l_zt2i", "task_id": "credential-check"},
+            query_params=action_query(CVAction.GetResult),
+        )
+        response = await get_async_client("volcengine").post(
+            build_url(params),
+            content=dump_body(params.body),
+            headers={"Content-Type": "application/json"},
+            auth=self.signer,
+        )
+        try:
+            code = response.json().get("ResponseMetadata", {}).get("Error", {}).get("Code")
+        except ValueError:
+            code = None
+        if response.status_code in (401, 403) or code in VOLCENGINE_AUTH_ERRORS:
+            return f"智能视觉服务鉴权失败: {code or response.status_code}"
+        return None
+
+    async def _check_ark(self) -> str | None:
+        from utils.http_client import get_async_client
+
+        # 空请求体: 鉴权先于参数校验, 密钥有效时返回400且不产生费用
+        response = await get_async_client("ark").post(self.ark_url, headers=self.ark_headers, json={})
+        if response.status_code in (401, 403):
+            return f"方舟API Key鉴权失败: {response.status_code}"
+        return None
+
+    async def _check_oss(self) -> str | None:
+        try:
+            uploader = self.uploader
+        except CredentialError as e:
+            return str(e)
+        status = await uploader.head_async("credential-check")
+        if status == 403:
+            return "OSS鉴权失败, 请检查AccessKey及其对Bucket的权限"
+        if status not in (200, 404):
+            return f"OSS返回{status}, 请检查Endpoint和Bucket"
+        return None
+
+    async def check(self) -> list[str]:
+        """对已配置的上游并行做一次鉴权检查, 返回失败原因"""
+        checks = {}
+        if self.credentials.has_volcengine:
+            checks["智能视觉服务"] = self._check_volcengine()
+        if self.ark_headers is not None:
+            checks["方舟"] = self._check_ark()
+        if self.credentials.has_oss:
+            checks["OSS"] = self._check_oss()
+        if not checks:
+            return ["未配置任何上游凭证"]
+        results = await asyncio.gather(*checks.values(), return_exceptions=True)
+        errors = []
+        for name, result in zip(checks, results):
+            if isinstance(result, httpx.HTTPError):
+                errors.append(f"{name}无法连接: {result!r}")
+            elif isinstance(result, Exception):
+                errors.append(f"{name}校验失败: {result}")
+            elif result:
+                errors.append(result)
+        return errors
+
+
+class CredentialRegistry:
+    """
+    按凭证指纹缓存的租户表
+    :param idle_ttl: 空闲超过该秒数的租户被移除
+    :param max_tenants: 租户数上限, 超出时移除最久未使用的租户
+    """
+
+    def __init__(self, idle_ttl: float, max_tenants: int):
+        self.idle_ttl = idle_ttl
+        self.max_tenants = max_tenants
+        self.created = 0
+        self.evicted = 0
+        self._tenants: dict[str, Tenant] = {}
+        # Dify传入的原始凭证 -> 租户, 命中时不需要合并环境变量和计算指纹
+        self._by_raw: dict[tuple, Tenant] = {}
+        self._lock = threading.Lock()
+        self._swept_at = time.monotonic()
+
+    def get(self, credentials: dict | None) -> Tenant:
+        """取得凭证对应的租户, 首次使用时创建, 不做网络校验"""
+        # 同一租户每次传入的字段顺序相同, 不排序; 顺序不同时按指纹对应到同一个租户
+        raw = tuple(credentials.items()) if credentials else ()
+        tenant = self._by_raw.get(raw)
+        now = time.monotonic()
+        if tenant is None:
+            with self._lock:
+                tenant = self._by_raw.get(raw)
+                if tenant is None:
+                    resolved = TenantCredentials.resolve(credentials)
+                    tenant = self._tenants.get(resolved.fingerprint())
+                    if tenant is None:
+                        tenant = Tenant(resolved)
+                        self._tenants[tenant.fingerprint] = tenant
+                        self.created += 1
+                    self._by_raw[raw] = tenant
+            if len(self._tenants) > self.max_tenants:
+                self._evict(now, lambda t: False)
+        tenant.last_used = now
+        if now - self._swept_at > min(self.idle_ttl, 60):
+            self._swept_at = now
+            self._evict(now, lambda t: now - t.last_used > self.idle_ttl)
+        return tenant
+
+    async def validate(self, credentials: dict | None) -> Tenant:
+        """
+        校验凭证并登记租户
+        :raise CredentialError: 凭证缺失或未通过任一上游的鉴权
+        """
+        tenant = self.get(credentials)
+        try:
+            async with asyncio.timeout(settings.tenants.validate_timeout):
+                errors = await tenant.check()
+        except TimeoutError:
+            errors = [f"凭证校验超时({settings.tenants.validate_timeout}秒)"]
+        if errors:
+            raise CredentialError("; ".join(errors))
+        tenant.validated_at = time.time()
+        return tenant
+
+    def _evict(self, now: float, idle) -> None:
+        with self._lock:
+            expired = [t for t in self._tenants.values() if idle(t)]
+            overflow = len(self._tenants) - len(expired) - self.max_tenants
+            if overflow > 0:
+                alive = sorted((t for t in self._tenants.values() if not idle(t)), key=lambda t: t.last_used)
+                expired += alive[:overflow]
+            if not expired:
+                return
+            removed = {t.fingerprint for t in expired}
+            for fingerprint in removed:
+                del self._tenants[fingerprint]
+            self._by_raw = {raw: t for raw, t in self._by_raw.items() if t.fingerprint not in removed}
+            self.evicted += len(removed)
+        for tenant in expired:
+            tenant.close()
+
+    def metrics(self) -> dict:
+        return {"tenants": len(self._tenants), "created": self.created, "evicted": self.evicted}
+
+
+_registry: CredentialRegistry | None = None
+_registry_lock = threading.Lock()
+
+_current: ContextVar[Tenant | None] = ContextVar("current_tenant", default=None)
+
+
+def get_registry() -> CredentialRegistry:
+    """获取进程级共享的租户表"""
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = CredentialRegistry(settings.tenants.idle_ttl, settings.tenants.max_tenants)
+    return _registry
+
+
+def get_tenant(credentials: dict | None) -> Tenant:
+    """Dify传入的供应商凭证对应的租户"""
+    return get_registry().get(credentials)
+
+
+def current_tenant() -> Tenant | None:
+    """当前调用所属的租户, 不在工具调用中时为None"""
+    return _current.get()
+
+
+def tenant_namespace() -> str:
+    """当前租户的缓存命名空间, 不同租户的缓存结果和暂存链接互不共享"""
+    tenant = _current.get()
+    return tenant.fingerprint if tenant is not None else "default"
+
+
+@contextmanager
+def use_tenant(tenant: Tenant) -> Iterator[Tenant]:
+    """在该上下文中上传到租户自己的OSS, 缓存按租户隔离"""
+    token = _current.set(tenant)
+    try:
+        yield tenant
+    finally:
+        _current.reset(token)
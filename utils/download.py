@@ -0,0 +1,266 @@
+"""
+外部链接下载
+使用按上游共享的连接池流式读取响应体, 超出大小上限时立即中止, 每个链接有包括连接和读取的总超时.
+下载结果按URL缓存在本地磁盘, 再次下载同一链接时按ETag/Last-Modified发送条件请求,
+服务端返回304时直接使用本地副本; 缓存按总大小淘汰最久未使用的文件
+"""
+
+import asyncio
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+import httpx
+from pydantic import BaseModel
+
+from utils.config import DownloadConfig, settings
+from utils.http_client import async_client_for
+from utils.tracing import span
+
+
+class DownloadError(Exception):
+    """链接无法下载、超时或超出大小上限"""
+
+
+class CachedResponse(BaseModel):
+    """缓存条目的元数据, 用于发送条件请求"""
+
+    url: str
+    etag: str | None = None
+    last_modified: str | None = None
+    content_type: str | None = None
+    size: int
+
+
+class Download(BaseModel):
+    """
+    下载结果
+    :param status: 服务端状态码, 304时内容来自本地缓存
+    :param cached: 是否使用了本地缓存的副本
+    """
+
+    url: str
+    content: bytes
+    content_type: str | None = None
+    status: int
+    cached: bool = False
+    elapsed: float = 0
+
+
+class UrlCache:
+    """
+    下载结果的磁盘缓存, 每个URL对应一个内容文件和一个元数据文件, 使用时更新内容文件的修改时间,
+    进程重启后按修改时间恢复使用顺序. 多个进程共用目录时各自统计总大小
+    :param directory: 缓存目录
+    :param max_bytes: 内容文件的总大小上限, 超出时删除最久未使用的条目
+    """
+
+    def __init__(self, directory: Path, max_bytes: int):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        # 键 -> 内容大小, 最近使用的在末尾
+        self._entries: OrderedDict[str, int] = OrderedDict()
+        self._lock = threading.Lock()
+        self._load()
+
+    def key(self, url: str) -> str:
+        return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+    def _paths(self, key: str) -> tuple[Path, Path]:
+        return self.directory.joinpath(key), self.directory.joinpath(f"{key}.json")
+
+    def _load(self) -> None:
+        entries = []
+        for path in self.directory.iterdir():
+            if path.suffix == ".tmp":
+                # 上次写入中断留下的临时文件
+                path.unlink(missing_ok=True)
+                continue
+            if path.suffix:
+                continue
+            meta_path = self._paths(path.name)[1]
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            if not meta_path.exists():
+                path.unlink(missing_ok=True)
+                continue
+            entries.append((stat.st_mtime, path.name, stat.st_size))
+        with self._lock:
+            for _, key, size in sorted(entries):
+                self._entries[key] = size
+                self.size += size
+        self._evict()
+
+    def lookup(self, url: str) -> CachedResponse | None:
+        """返回已缓存条目的元数据, 未缓存时返回None"""
+        key = self.key(url)
+        with self._lock:
+            if key not in self._entries:
+                return None
+        try:
+            meta = CachedResponse.model_validate_json(self._paths(key)[1].read_bytes())
+        except (OSError, ValueError):
+            self.delete(url)
+            return None
+        return meta if meta.url == url else None
+
+    def read(self, url: str) -> bytes | None:
+        """读取本地副本并标记为最近使用, 已被淘汰时返回None"""
+        key = self.key(url)
+        path = self._paths(key)[0]
+        try:
+            content = path.read_bytes()
+            os.utime(path)
+        except FileNotFoundError:
+            self.delete(url)
+            return None
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+        return content
+
+    def store(self, url: str, content: bytes, meta: CachedResponse) -> None:
+        if len(content) > self.max_bytes:
+            return
+        key = self.key(url)
+        suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+        # 先写内容再写元数据, 只有元数据存在的条目才会被使用
+        for path, value in zip(self._paths(key), (content, meta.model_dump_json().encode("utf-8"))):
+            tmp = path.with_name(path.name + suffix)
+            tmp.write_bytes(value)
+            os.replace(tmp, path)
+        with self._lock:
+            self.size += len(content) - self._entries.pop(key, 0)
+            self._entries[key] = len(content)
+        self._evict()
+
+    def delete(self, url: str) -> None:
+        key = self.key(url)
+        with self._lock:
+            self.size -= self._entries.pop(key, 0)
+        for path in self._paths(key):
+            path.unlink(missing_ok=True)
+
+    def _evict(self) -> None:
+        while True:
+            with self._lock:
+                if self.size <= self.max_bytes or not self._entries:
+                    return
+                key, size = self._entries.popitem(last=False)
+                self.size -= size
+                self.evicted += 1
+            for path in reversed(self._paths(key)):
+                path.unlink(missing_ok=True)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evicted": self.evicted,
+            "hit_rate": self.hits / total if total else 0,
+        }
+
+
+_url_cache: UrlCache | None = None
+_url_cache_lock = threading.Lock()
+
+
+def get_url_cache() -> UrlCache | None:
+    """获取进程级共享的下载缓存, 未启用时返回None"""
+    global _url_cache
+    config = settings.download
+    if not config.cache:
+        return None
+    if _url_cache is None:
+        with _url_cache_lock:
+            if _url_cache is None:
+                directory = config.cache_directory or settings.temp_dir.joinpath("url_cache")
+                _url_cache = UrlCache(directory, config.cache_max_bytes)
+    return _url_cache
+
+
+def _cacheable(response: httpx.Response) -> bool:
+    if "no-store" in response.headers.get("Cache-Control", "").lower():
+        return False
+    return "ETag" in response.headers or "Last-Modified" in response.headers
+
+
+async def _fetch(url: str, config: DownloadConfig, cache: UrlCache | None, conditional: bool = True) -> Download:
+    meta = await asyncio.to_thread(cache.lookup, url) if cache is not None and conditional else None
+    headers = {}
+    if meta is not None:
+        if meta.etag:
+            headers["If-None-Match"] = meta.etag
+        if meta.last_modified:
+            headers["If-Modified-Since"] = meta.last_modified
+
+    async with async_client_for(url).stream("GET", url, headers=headers, follow_redirects=True) as response:
+        if response.status_code == 304 and meta is not None:
+            content = await asyncio.to_thread(cache.read, url)
+            if content is not None:
+                cache.hits += 1
+                return Download(url=url, content=content, content_type=meta.content_type, status=304, cached=True)
+        else:
+            response.raise_for_status()
+            length = response.headers.get("Content-Length")
+            if length and length.isdigit() and int(length) > config.max_bytes:
+                raise DownloadError(f"文件大小{length}字节, 超出上限{config.max_bytes}字节")
+            chunks, size = [], 0
+            async for chunk in response.aiter_bytes():
+                size += len(chunk)
+                if size > config.max_bytes:
+                    raise DownloadError(f"文件大小超出上限{config.max_bytes}字节")
+                chunks.append(chunk)
+            content = b"".join(chunks)
+    if response.status_code == 304:
+        # 条件请求期间本地副本被淘汰, 重新完整下载
+        return await _fetch(url, config, cache, conditional=False)
+
+    content_type = response.headers.get("Content-Type")
+    if cache is not None:
+        cache.misses += 1
+        if _cacheable(response):
+            cached = CachedResponse(
+                url=url,
+                etag=response.headers.get("ETag"),
+                last_modified=response.headers.get("Last-Modified"),
+                content_type=content_type,
+                size=len(content),
+            )
+            await asyncio.to_thread(cache.store, url, content, cached)
+    return Download(url=url, content=content, content_type=content_type, status=response.status_code)
+
+
+async def download(url: str) -> Download:
+    """
+    下载链接内容, 使用磁盘缓存时先发送条件请求
+    :raise DownloadError: 请求失败、超时或超出大小上限
+    """
+    config = settings.download
+    start = time.perf_counter()
+    with span("url.download") as s:
+        try:
+            async with asyncio.timeout(config.timeout):
+                result = await _fetch(url, config, get_url_cache())
+        except TimeoutError as e:
+            raise DownloadError(f"下载超时({config.timeout}秒)") from e
+        except httpx.HTTPStatusError as e:
+            raise DownloadError(f"服务端返回{e.response.status_code}") from e
+        except httpx.HTTPError as e:
+            raise DownloadError(f"请求失败: {e!r}") from e
+        s.set("status", result.status).set("bytes", len(result.content)).set("cached", result.cached)
+    result.elapsed = time.perf_counter() - start
+    return result
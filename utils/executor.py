@@ -0,0 +1,372 @@
+"""
+CPU密集型任务的工作池
+Pillow解码、缩放和编码在进程池中执行, 不与事件循环上的网络I/O争抢GIL;
+哈希、base64解码等输入不便跨进程传递(如memoryview切片)的任务在线程池中执行.
+插件运行时由gevent打补丁, 此时线程池使用gevent的原生线程池, 否则线程池中的任务仍在事件循环所在线程执行;
+原生线程只在任务释放GIL时才不阻塞事件循环: hashlib对大块数据释放GIL, a2b_base64执行期间不释放.
+每个工作池最多接受 max_workers + max_queue 个任务, 超出时调用方等待空位(背压), 而不是无限堆积图片内容
+"""
+
+import asyncio
+import contextlib
+import os
+import pickle
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from collections.abc import Callable
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from typing import Any, Literal, TypeVar
+
+from utils.config import settings
+
+T = TypeVar("T")
+
+
+class PoolBusyError(Exception):
+    """工作池排队已满且等待超时"""
+
+
+class _Slots:
+    """
+    可同时用于事件循环和同步线程的计数信号量, 按先来后到分配空位
+    释放时直接把空位交给最早的等待者, 避免新来的调用方插队
+    """
+
+    def __init__(self, size: int):
+        self.free = size
+        self._waiters: deque[asyncio.Future | threading.Event] = deque()
+        self._lock = threading.Lock()
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self, timeout: float | None) -> bool:
+        with self._lock:
+            if self.free > 0 and not self._waiters:
+                self.free -= 1
+                return True
+            future = asyncio.get_running_loop().create_future()
+            self._waiters.append(future)
+        try:
+            await asyncio.wait_for(future, timeout)
+            return True
+        except BaseException as e:
+            with self._lock:
+                if future in self._waiters:
+                    self._waiters.remove(future)
+            if isinstance(e, asyncio.TimeoutError):
+                # 超时时若已分配到空位, 由 _wake 归还
+                return False
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def acquire_sync(self, timeout: float | None) -> bool:
+        with self._lock:
+            if self.free > 0 and not self._waiters:
+                self.free -= 1
+                return True
+            event = threading.Event()
+            self._waiters.append(event)
+        if event.wait(timeout):
+            return True
+        with self._lock:
+            if event in self._waiters:
+                self._waiters.remove(event)
+                return False
+        # 超时与分配同时发生, 空位已经属于当前调用方
+        return True
+
+    def release(self) -> None:
+        with self._lock:
+            if not self._waiters:
+                self.free += 1
+                return
+            waiter = self._waiters.popleft()
+        if isinstance(waiter, threading.Event):
+            waiter.set()
+        else:
+            waiter.get_loop().call_soon_threadsafe(self._wake, waiter)
+
+    def _wake(self, future: asyncio.Future) -> None:
+        if future.done():
+            self.release()
+        else:
+            future.set_result(True)
+
+
+def _timed(func: Callable[..., T], args: tuple) -> tuple[float, T]:
+    # CLOCK_MONOTONIC在同一台机器的进程间一致, 可用于计算子进程中任务的排队时间
+    return time.monotonic(), func(*args)
+
+
+# gevent环境下进程池的任务经临时文件传递, 管道中只传文件路径.
+# gevent.monkey.patch_all 后进程池向子进程写任务的队列线程也是协程, 任务大于管道缓冲区时写入阻塞整个进程,
+# 读取结果的线程同样无法运行, 子进程写结果时也被阻塞, 父子进程互相等待. 结果方向不受影响, 仍经管道返回;
+# 未打补丁时写入在真正的线程中进行, 不需要中转
+_INLINE_LIMIT = 4096
+
+
+def _gevent_patched() -> bool:
+    monkey = sys.modules.get("gevent.monkey")
+    return monkey is not None and monkey.is_module_patched("threading")
+
+
+def _spool(func: Callable, args: tuple) -> bytes | str:
+    """序列化任务, 超过 _INLINE_LIMIT 时写入临时文件(优先/dev/shm, 只多一次内存复制)并返回路径"""
+    data = pickle.dumps((func, args), protocol=pickle.HIGHEST_PROTOCOL)
+    if len(data) <= _INLINE_LIMIT:
+        return data
+    spool_dir = "/dev/shm" if os.access("/dev/shm", os.W_OK) else None
+    fd, path = tempfile.mkstemp(prefix="pool-", dir=spool_dir)
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    return path
+
+
+def _discard(payload: bytes | str) -> None:
+    # 子进程读取任务后即删除文件, 任务被取消或子进程异常退出时由父进程清理
+    if isinstance(payload, str):
+        with contextlib.suppress(OSError):
+            os.unlink(payload)
+
+
+def _call_spooled(payload: bytes | str) -> tuple[float, Any]:
+    """在子进程中读取 _spool 序列化的任务并执行"""
+    data = payload
+    if isinstance(payload, str):
+        try:
+            with open(payload, "rb") as f:
+                data = f.read()
+        finally:
+            os.unlink(payload)
+    func, args = pickle.loads(data)
+    return _timed(func, args)
+
+
+def _wrap_future(future: Future) -> asyncio.Future:
+    """转为当前事件循环的Future; gevent原生线程池返回的Future不是concurrent.futures.Future, 需手动转发结果"""
+    if isinstance(future, Future):
+        return asyncio.wrap_future(future)
+    loop = asyncio.get_running_loop()
+    waiter = loop.create_future()
+
+    def copy(done: Any) -> None:
+        if waiter.cancelled():
+            return
+        try:
+            waiter.set_result(done.result())
+        except Exception as e:
+            waiter.set_exception(e)
+
+    future.add_done_callback(lambda done: loop.call_soon_threadsafe(copy, done))
+    return waiter
+
+
+class WorkerPool:
+    """
+    有界工作池
+    :param name: 名称, 用于指标
+    :param max_workers: 并发执行的任务数
+    :param max_queue: 执行中的任务之外最多排队的任务数
+    :param max_wait: 排队已满时等待空位的秒数, 为空时一直等待
+    :param processes: 是否使用进程池, 任务函数及参数需可pickle
+    """
+
+    def __init__(
+        self, name: str, max_workers: int, max_queue: int, max_wait: float | None = None, processes: bool = False
+    ):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.processes = processes
+        self.admitted = 0
+        self.submitted = 0
+        self.completed = 0
+        self.rejected = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self._slots = _Slots(max_workers + max_queue)
+        self._executor: Executor | None = None
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+
+    @property
+    def executor(self) -> Executor:
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = self._create_executor()
+        return self._executor
+
+    def _create_executor(self) -> Executor:
+        if self.processes:
+            try:
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+
+                # 不fork插件进程, 子进程中没有事件循环线程和连接池
+                return ProcessPoolExecutor(self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+            except (ImportError, NotImplementedError, OSError):
+                # 不支持多进程的环境(如缺少/dev/shm)退化为线程池
+                self.processes = False
+        if _gevent_patched():
+            # 打补丁后threading.Thread是同一线程上的协程, 任务仍在事件循环所在线程执行; 改用gevent的原生线程池
+            from gevent.threadpool import ThreadPoolExecutor as NativeThreadPoolExecutor
+
+            return NativeThreadPoolExecutor(self.max_workers)
+        return ThreadPoolExecutor(self.max_workers, thread_name_prefix=self.name)
+
+    def _submit(self, func: Callable[..., T], args: tuple) -> Future:
+        with self._stats_lock:
+            self.admitted += 1
+            self.submitted += 1
+        payload = b""
+        try:
+            executor = self.executor
+            if self.processes and _gevent_patched():
+                payload = _spool(func, args)
+                future = executor.submit(_call_spooled, payload)
+                future.add_done_callback(lambda _: _discard(payload))
+            else:
+                future = executor.submit(_timed, func, args)
+        except Exception:
+            _discard(payload)
+            self._done()
+            self._reset()
+            raise
+        # 任务真正结束后才归还空位, 调用方取消等待时子进程中的任务仍占用工作进程
+        future.add_done_callback(lambda _: self._done())
+        return future
+
+    def _done(self) -> None:
+        with self._stats_lock:
+            self.admitted -= 1
+            self.completed += 1
+        self._slots.release()
+
+    def _reset(self) -> None:
+        # 子进程异常退出后进程池不可再用, 下次提交时重建
+        if not self.processes:
+            return
+        from concurrent.futures.process import BrokenProcessPool
+
+        executor = self._executor
+        if executor is not None and getattr(executor, "_broken", False):
+            self._executor = None
+            try:
+                executor.shutdown(wait=False)
+            except BrokenProcessPool:
+                pass
+
+    def _record(self, submitted_at: float, started_at: float) -> None:
+        wait = max(started_at - submitted_at, 0)
+        with self._stats_lock:
+            self.wait_seconds += wait
+            self.max_wait_seconds = max(self.max_wait_seconds, wait)
+
+    def _busy(self) -> PoolBusyError:
+        self.rejected += 1
+        return PoolBusyError(f"{self.name} 工作池排队已满, 等待超过{self.max_wait}秒")
+
+    async def run(self, func: Callable[..., T], *args: Any) -> T:
+        """在工作池中执行任务, 排队已满时异步等待空位"""
+        submitted_at = time.monotonic()
+        if not await self._slots.acquire(self.max_wait):
+            raise self._busy()
+        future = self._submit(func, args)
+        try:
+            started_at, result = await _wrap_future(future)
+        except Exception:
+            self._reset()
+            raise
+        self._record(submitted_at, started_at)
+        return result
+
+    def run_sync(self, func: Callable[..., T], *args: Any) -> T:
+        """在工作池中执行任务并阻塞等待结果"""
+        submitted_at = time.monotonic()
+        if not self._slots.acquire_sync(self.max_wait):
+            raise self._busy()
+        future = self._submit(func, args)
+        try:
+            started_at, result = future.result()
+        except Exception:
+            self._reset()
+            raise
+        self._record(submitted_at, started_at)
+        return result
+
+    def metrics(self) -> dict:
+        """
+        queued为已提交但未开始执行的任务数(按工作数估算), waiting为等待空位的调用方数,
+        两者之和为队列深度; wait_seconds为任务从调用到开始执行的等待时间
+        """
+        finished = max(self.completed, 1)
+        return {
+            "kind": "process" if self.processes else "thread",
+            "max_workers": self.max_workers,
+            "running": min(self.admitted, self.max_workers),
+            "queued": max(self.admitted - self.max_workers, 0),
+            "waiting": self._slots.waiting,
+            "queue_depth": max(self.admitted - self.max_workers, 0) + self._slots.waiting,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "avg_wait_seconds": round(self.wait_seconds / finished, 4),
+            "max_wait_seconds": round(self.max_wait_seconds, 4),
+        }
+
+    def shutdown(self, wait: bool = True) -> None:
+        executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+
+_pools: dict[str, WorkerPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(kind: Literal["process", "thread"] = "process") -> WorkerPool:
+    """
+    进程内共享的工作池
+    :param kind: process: Pillow编解码等纯CPU任务, 按 settings.executor.processes 使用进程池;
+                 thread: 哈希、base64解码等释放GIL或参数不可pickle的任务, gevent环境下为原生线程
+    """
+    pool = _pools.get(kind)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(kind)
+            if pool is None:
+                config = settings.executor
+                if kind == "process":
+                    workers = config.max_workers or os.cpu_count() or 1
+                    pool = WorkerPool("image", workers, config.max_queue, config.max_wait, config.processes)
+                else:
+                    pool = WorkerPool("codec", config.thread_workers, config.max_queue, config.max_wait)
+                _pools[kind] = pool
+    return pool
+
+
+async def run_cpu(func: Callable[..., T], *args: Any) -> T:
+    """在进程池中执行Pillow编解码等CPU密集任务"""
+    return await get_pool("process").run(func, *args)
+
+
+def run_cpu_sync(func: Callable[..., T], *args: Any) -> T:
+    return get_pool("process").run_sync(func, *args)
+
+
+async def run_thread(func: Callable[..., T], *args: Any) -> T:
+    """在有界线程池中执行释放GIL或参数不可pickle的任务, 不释放GIL的任务仍会阻塞事件循环, 见模块说明"""
+    return await get_pool("thread").run(func, *args)
+
+
+def executor_metrics() -> dict[str, dict]:
+    """全部工作池的当前状态"""
+    return {pool.name: pool.metrics() for pool in list(_pools.values())}
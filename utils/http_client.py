@@ -0,0 +1,100 @@
+"""
+插件共享的HTTP客户端
+按上游(火山引擎视觉服务/方舟/OSS)分别维护长连接池, 进程内复用, 避免每次调用重新建立连接
+"""
+
+import asyncio
+import importlib.util
+import os
+import threading
+import weakref
+
+import httpx
+
+from utils.config import HttpPoolConfig, settings
+
+_clients: dict[str, httpx.Client] = {}
+# 异步客户端的连接绑定在创建它的事件循环上, 按事件循环分别缓存
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict[str, httpx.AsyncClient]]" = (
+    weakref.WeakKeyDictionary()
+)
+_lock = threading.Lock()
+
+
+def _pool_config(upstream: str) -> HttpPoolConfig:
+    return getattr(settings.http, upstream)
+
+
+def _hosts(upstream: str) -> list[str]:
+    hosts = list(_pool_config(upstream).hosts)
+    if upstream == "oss" and os.getenv("OSS_DOMAIN"):
+        hosts.append(os.getenv("OSS_DOMAIN"))
+    return hosts
+
+
+def upstream_of(url: str | httpx.URL) -> str:
+    """根据URL域名匹配上游名称, 未匹配时返回 default"""
+    host = httpx.URL(url).host
+    for upstream in ("volcengine", "ark", "oss"):
+        for h in _hosts(upstream):
+            if host == h or host.endswith(f".{h}"):
+                return upstream
+    return "default"
+
+
+def build_client_kwargs(config: HttpPoolConfig) -> dict:
+    return dict(
+        http2=config.http2 and importlib.util.find_spec("h2") is not None,
+        limits=httpx.Limits(
+            max_connections=config.max_connections,
+            max_keepalive_connections=config.max_keepalive_connections,
+            keepalive_expiry=config.keepalive_expiry,
+        ),
+        timeout=httpx.Timeout(
+            connect=config.connect_timeout,
+            read=config.read_timeout,
+            write=config.write_timeout,
+            pool=config.pool_timeout,
+        ),
+    )
+
+
+def get_client(upstream: str = "default") -> httpx.Client:
+    """获取指定上游的共享客户端, 首次调用时创建"""
+    client = _clients.get(upstream)
+    if client is None:
+        with _lock:
+            client = _clients.get(upstream)
+            if client is None:
+                client = httpx.Client(**build_client_kwargs(_pool_config(upstream)))
+                _clients[upstream] = client
+    return client
+
+
+def client_for(url: str | httpx.URL) -> httpx.Client:
+    """根据URL选择对应上游的共享客户端"""
+    return get_client(upstream_of(url))
+
+
+def get_async_client(upstream: str = "default") -> httpx.AsyncClient:
+    """获取当前事件循环上指定上游的共享异步客户端, 须在协程中调用"""
+    loop = asyncio.get_running_loop()
+    with _lock:
+        clients = _async_clients.setdefault(loop, {})
+        client = clients.get(upstream)
+        if client is None:
+            client = httpx.AsyncClient(**build_client_kwargs(_pool_config(upstream)))
+            clients[upstream] = client
+    return client
+
+
+def async_client_for(url: str | httpx.URL) -> httpx.AsyncClient:
+    """根据URL选择对应上游的共享异步客户端"""
+    return get_async_client(upstream_of(url))
+
+
+def close_clients() -> None:
+    with _lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
@@ -1,11 +1,507 @@
+import binascii
+import hashlib
+import mimetypes
 import os
+import struct
+import threading
+import time
 import uuid
+from collections import OrderedDict
+from collections.abc import AsyncIterator, Iterable
+from io import BytesIO
+from itertools import chain
 from pathlib import Path
+from typing import Literal, NamedTuple
 
-import oss2
-from dotenv import find_dotenv, load_dotenv
+from pydantic import BaseModel, ConfigDict, Field
+
+from utils.config import settings
+from utils.credentials import current_tenant
+from utils.executor import run_cpu, run_cpu_sync, run_thread
+from utils.http_client import async_client_for
+from utils.tracing import span
+
+
+class ImageInfo(NamedTuple):
+    format: str
+    mime_type: str
+    width: int | None = None
+    height: int | None = None
+
+
+def _jpeg_size(data: bytes) -> tuple[int, int] | None:
+    # 逐段跳过marker, 直到SOFn帧头, 其中记录了图像高宽
+    i = 2
+    while i + 9 <= len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            i += 1
+            continue
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack(">HH", data[i + 5 : i + 9])
+            return width, height
+        i += 2 + struct.unpack(">H", data[i + 2 : i + 4])[0]
+    return None
+
+
+def _webp_size(data: bytes) -> tuple[int, int] | None:
+    chunk = data[12:16]
+    if chunk == b"VP8 " and len(data) >= 30:
+        width, height = struct.unpack("<HH", data[26:30])
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk == b"VP8L" and len(data) >= 25:
+        bits = int.from_bytes(data[21:25], "little")
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b"VP8X" and len(data) >= 30:
+        return int.from_bytes(data[24:27], "little") + 1, int.from_bytes(data[27:30], "little") + 1
+    return None
+
+
+def _avif_size(data: bytes) -> tuple[int, int] | None:
+    # ispe box: size(4) + "ispe"(4) + version/flags(4) + width(4) + height(4)
+    i = data.find(b"ispe", 0, 4096)
+    if i < 0 or i + 16 > len(data):
+        return None
+    return struct.unpack(">II", data[i + 8 : i + 16])
+
+
+def _bmp_size(data: bytes) -> tuple[int, int] | None:
+    if len(data) < 26:
+        return None
+    if struct.unpack("<I", data[14:18])[0] == 12:
+        return struct.unpack("<HH", data[18:22])
+    width, height = struct.unpack("<ii", data[18:26])
+    return width, abs(height)
+
+
+def _parse_header(data: bytes) -> tuple[str, tuple[int, int] | None] | None:
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png", struct.unpack(">II", data[16:24]) if len(data) >= 24 else None
+    if data.startswith(b"\xff\xd8\xff"):
+        return "jpeg", _jpeg_size(data)
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp", _webp_size(data)
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif", struct.unpack("<HH", data[6:10]) if len(data) >= 10 else None
+    if data[4:8] == b"ftyp" and data[8:12] in (b"avif", b"avis"):
+        return "avif", _avif_size(data)
+    if data.startswith(b"BM"):
+        return "bmp", _bmp_size(data)
+    return None
+
+
+def detect_image(data: bytes, fallback: bool = True) -> ImageInfo | None:
+    """
+    识别图片格式及宽高, 只读取文件头, 不解码图像
+    PNG/GIF/BMP/WebP只需前几十字节, JPEG需扫描到SOF帧头, AVIF读取ispe属性
+    :param data: 图片内容或其开头部分
+    :param fallback: 文件头无法识别时是否使用PIL识别
+    :return: 无法识别时返回None, 宽高未知时为None
+    """
+    parsed = _parse_header(data)
+    if parsed is not None:
+        img_format, size = parsed
+        width, height = size or (None, None)
+        return ImageInfo(img_format, f"image/{img_format}", width, height)
+    if not fallback:
+        return None
+
+    from PIL import Image, UnidentifiedImageError
+
+    try:
+        pil = Image.open(BytesIO(data))
+    except (UnidentifiedImageError, OSError):
+        return None
+    img_format = pil.format.lower()
+    return ImageInfo(img_format, Image.MIME.get(pil.format, f"image/{img_format}"), pil.width, pil.height)
+
+
+def sniff_format(head: bytes) -> str | None:
+    """根据文件头判断图片格式, 无法识别时返回None"""
+    info = detect_image(head, fallback=False)
+    return info.format if info else None
+
+
+class CompactOptions(BaseModel):
+    """blob消息的压缩选项, 上传到OSS的仍为原图"""
+
+    max_dimension: int | None = Field(None, title="最长边上限", description="为空时不缩放")
+    format: Literal["original", "webp", "jpeg"] = "original"
+    quality: int = Field(85, ge=1, le=100)
+    strip_metadata: bool = True
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.max_dimension) or self.format != "original"
+
+    @classmethod
+    def from_tool_parameters(cls, tool_parameters: dict) -> "CompactOptions":
+        return cls(
+            max_dimension=int(tool_parameters.get("blob_max_dimension") or 0) or None,
+            format=tool_parameters.get("blob_format") or "original",
+            quality=int(tool_parameters.get("blob_quality") or 85),
+        )
+
+
+class CompactImage(BaseModel):
+    blob: bytes
+    format: str
+    original_bytes: int
+    encode_seconds: float = 0
+
+    @property
+    def saved_bytes(self) -> int:
+        return self.original_bytes - len(self.blob)
+
+    def report(self) -> dict:
+        return {
+            "bytes": len(self.blob),
+            "original_bytes": self.original_bytes,
+            "saved_bytes": self.saved_bytes,
+            "encode_ms": round(self.encode_seconds * 1000, 2),
+        }
+
+
+def compact_image(data: bytes, options: CompactOptions) -> CompactImage:
+    """
+    缩放并重新编码图片, 用于减小blob消息体积
+    未启用缩放和转码时直接返回原图; 结果不小于原图时也返回原图
+    """
+    info = detect_image(data)
+    img_format = info.format if info else "png"
+    if not options.enabled:
+        return CompactImage(blob=data, format=img_format, original_bytes=len(data))
+
+    from PIL import Image
+
+    start = time.perf_counter()
+    pil = Image.open(BytesIO(data))
+    if options.max_dimension and max(pil.size) > options.max_dimension:
+        # JPEG可在解码时直接按2的幂降采样
+        pil.draft(pil.mode, (options.max_dimension, options.max_dimension))
+        pil.thumbnail((options.max_dimension, options.max_dimension), Image.Resampling.LANCZOS)
+
+    target = img_format if options.format == "original" else options.format
+    if target not in ("jpeg", "webp", "png"):
+        target = "png"
+    if target == "jpeg" and pil.mode not in ("RGB", "L"):
+        pil = pil.convert("RGB")
+    save_kwargs = {"quality": options.quality} if target in ("jpeg", "webp") else {"optimize": True}
+    if not options.strip_metadata:
+        for key in ("exif", "icc_profile"):
+            if pil.info.get(key):
+                save_kwargs[key] = pil.info[key]
+    buffer = BytesIO()
+    pil.save(buffer, format=target.upper(), **save_kwargs)
+    blob = buffer.getvalue()
+    encode_seconds = time.perf_counter() - start
+
+    if len(blob) >= len(data) and target == img_format and not options.max_dimension:
+        return CompactImage(blob=data, format=img_format, original_bytes=len(data), encode_seconds=encode_seconds)
+    return CompactImage(blob=blob, format=target, original_bytes=len(data), encode_seconds=encode_seconds)
+
+
+async def compact_image_async(data: bytes, options: CompactOptions) -> CompactImage:
+    """在进程池中执行 compact_image, 不阻塞事件循环"""
+    if not options.enabled:
+        return compact_image(data, options)
+    with span("image.compact", bytes=len(data)) as s:
+        compact = await run_cpu(compact_image, data, options)
+        s.set("output_bytes", len(compact.blob))
+    return compact
+
+
+def compact_image_pooled(data: bytes, options: CompactOptions) -> CompactImage:
+    """在进程池中执行 compact_image 并阻塞等待, 供同步工具使用, 排队已满时在此等待"""
+    if not options.enabled:
+        return compact_image(data, options)
+    with span("image.compact", bytes=len(data)) as s:
+        compact = run_cpu_sync(compact_image, data, options)
+        s.set("output_bytes", len(compact.blob))
+    return compact
+
+
+class UploadedImage(BaseModel):
+    """上传结果"""
+
+    model_config = ConfigDict(ser_json_bytes="base64", val_json_bytes="base64")
+
+    url: str | None
+    format: str
+    size: int
+    blob: bytes | None = None  # 图片内容, 超过max_blob_bytes时不保留
+
+
+class RecentKeys:
+    """最近上传过的对象key, 容量和有效期有限, 用于跳过重复的存在性检查"""
+
+    def __init__(self, max_size: int = 4096, ttl: float = 60 * 60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._keys: OrderedDict[str, float] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            expires_at = self._keys.get(key)
+            if expires_at is None:
+                return False
+            if expires_at < time.monotonic():
+                del self._keys[key]
+                return False
+            self._keys.move_to_end(key)
+            return True
+
+    def add(self, key: str) -> None:
+        with self._lock:
+            self._keys[key] = time.monotonic() + self.ttl
+            self._keys.move_to_end(key)
+            while len(self._keys) > self.max_size:
+                self._keys.popitem(last=False)
+
+
+async def _iter_chunks(data: bytes, chunk_size: int = 256 * 1024) -> AsyncIterator[memoryview]:
+    """
+    分块交给httpx发送
+    httpx的请求与响应互相引用, 直接传入bytes时图片内容要等到垃圾回收才释放; 生成器发送完即释放对内容的引用
+    """
+    view = memoryview(data)
+    for start in range(0, len(view), chunk_size):
+        yield view[start : start + chunk_size]
+
+
+class OssUploader:
+    """
+    OSS上传器
+    进程内共享同一个已认证的Bucket, 底层使用带连接池的keep-alive Session, 可在多线程中并发调用
+    """
+
+    def __init__(
+        self,
+        endpoint: str,
+        access_key_id: str,
+        access_key_secret: str,
+        bucket_name: str,
+        domain: str | None = None,
+        pool_size: int = 16,
+        connect_timeout: int | float | None = None,
+    ):
+        self.endpoint = endpoint
+        self.bucket_name = bucket_name
+        self.domain = domain
+        # oss2导入较慢, 首次上传时才加载
+        import oss2
+
+        self.session = oss2.Session(pool_size=pool_size)
+        self.bucket = oss2.Bucket(
+            oss2.Auth(access_key_id, access_key_secret),
+            endpoint,
+            bucket_name,
+            session=self.session,
+            connect_timeout=connect_timeout,
+        )
+        self.recent_keys = RecentKeys()
+
+    @classmethod
+    def from_env(cls) -> "OssUploader":
+        """从环境变量创建上传器"""
+        return cls(
+            endpoint=os.getenv("OSS_ENDPOINT"),
+            access_key_id=os.getenv("OSS_ACCESS_KEY_ID"),
+            access_key_secret=os.getenv("OSS_ACCESS_KEY_SECRET"),
+            bucket_name=os.getenv("OSS_BUCKET_NAME"),
+            domain=os.getenv("OSS_DOMAIN"),
+            pool_size=settings.http.oss.max_keepalive_connections,
+            connect_timeout=settings.http.oss.connect_timeout,
+        )
+
+    def object_key(self, filename: str, prefix: str = "tmp", rename: bool = True) -> str:
+        if rename:
+            uid = uuid.uuid4()
+            upload_file_name = f"{prefix}/{uid}.{filename.split('.')[-1]}"
+        else:
+            upload_file_name = f"{prefix}/{filename}"
+        if prefix is None:
+            # 临时文件, 使用OSS生命周期自动删除
+            upload_file_name = f"tmp/{upload_file_name}"
+        return upload_file_name
+
+    def digest_key(self, filename: str, data: str | bytes, prefix: str = "tmp") -> str:
+        """按内容的SHA-256命名对象, 相同内容得到相同的key"""
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        digest = hashlib.sha256(data).hexdigest()
+        return self.object_key(f"{digest}.{filename.split('.')[-1]}", prefix=prefix, rename=False)
+
+    def object_url(self, key: str, domain: str = None) -> str:
+        domain = domain or self.domain
+        if domain:
+            return f"https://{domain}/{key}"
+        return f"https://{self.bucket_name}.{self.endpoint}/{key}"
+
+    def upload(
+        self,
+        filename: str,
+        data: str | bytes,
+        prefix: str = "tmp",
+        rename: bool = True,
+        domain: str = None,
+        dedupe: bool = False,
+    ) -> str | None:
+        """参数同 upload_image"""
+        if dedupe:
+            upload_file_name = self.digest_key(filename, data, prefix=prefix)
+            if upload_file_name in self.recent_keys or self.bucket.object_exists(upload_file_name):
+                self.recent_keys.add(upload_file_name)
+                return self.object_url(upload_file_name, domain=domain)
+        else:
+            upload_file_name = self.object_key(filename, prefix=prefix, rename=rename)
+        with span("oss.upload", bytes=len(data)) as s:
+            result = self.bucket.put_object(upload_file_name, data)
+            s.set("status", result.status)
+        if result.status == 200:
+            if dedupe:
+                self.recent_keys.add(upload_file_name)
+            return self.object_url(upload_file_name, domain=domain)
+        else:
+            return None
+
+    async def upload_async(
+        self,
+        filename: str,
+        data: bytes,
+        prefix: str = "tmp",
+        rename: bool = True,
+        domain: str = None,
+        dedupe: bool = False,
+    ) -> str | None:
+        """
+        异步上传, 参数同 upload_image
+        本地生成PUT预签名URL, 通过共享的httpx.AsyncClient上传, 不占用线程
+        """
+        if dedupe:
+            upload_file_name = self.digest_key(filename, data, prefix=prefix)
+            if upload_file_name in self.recent_keys or await self.exists_async(upload_file_name):
+                self.recent_keys.add(upload_file_name)
+                return self.object_url(upload_file_name, domain=domain)
+        else:
+            upload_file_name = self.object_key(filename, prefix=prefix, rename=rename)
+        headers = {"Content-Type": mimetypes.guess_type(upload_file_name)[0] or "application/octet-stream"}
+        signed_url = self.bucket.sign_url("PUT", upload_file_name, 60 * 10, headers=headers, slash_safe=True)
+        with span("oss.upload", bytes=len(data)) as s:
+            response = await async_client_for(signed_url).put(
+                signed_url, content=_iter_chunks(data), headers={**headers, "Content-Length": str(len(data))}
+            )
+            s.set("status", response.status_code)
+        if response.status_code == 200:
+            if dedupe:
+                self.recent_keys.add(upload_file_name)
+            return self.object_url(upload_file_name, domain=domain)
+        else:
+            return None
+
+    async def head_async(self, key: str) -> int:
+        """HEAD请求对象, 返回状态码; 凭证无效时为403"""
+        signed_url = self.bucket.sign_url("HEAD", key, 60 * 10, slash_safe=True)
+        with span("oss.head") as s:
+            response = await async_client_for(signed_url).head(signed_url)
+            s.set("status", response.status_code)
+        return response.status_code
+
+    async def exists_async(self, key: str) -> bool:
+        """HEAD请求检查对象是否存在"""
+        return await self.head_async(key) == 200
+
+    def upload_stream(
+        self,
+        chunks: Iterable[bytes],
+        prefix: str = "tmp",
+        domain: str = None,
+        part_size: int = 1024 * 1024,
+        max_blob_bytes: int = 0,
+    ) -> UploadedImage:
+        """
+        流式上传图片, 边读边传, 上传缓冲以part_size为上限
+        根据首个分块的文件头确定格式, 内容超过part_size时使用分片上传
+        :param chunks: 图片内容分块, 如 httpx.Response.iter_bytes()
+        :param part_size: 分片大小, 不能小于100KB
+        :param max_blob_bytes: 同时保留图片内容的上限, 用于blob消息, 为0或超出时不保留
+        """
+        from oss2.models import PartInfo
+
+        chunks = iter(chunks)
+        head = b""
+        for chunk in chunks:
+            head += chunk
+            if len(head) >= 32:
+                break
+        img_format = sniff_format(head) or "png"
+        key = self.object_key(f"image.{img_format}", prefix=prefix)
+
+        size = 0
+        # BytesIO.getvalue()可直接交出内部缓冲, 避免bytearray转bytes时的整块复制
+        blob = BytesIO() if max_blob_bytes else None
+        buffer = bytearray()
+        upload_id = None
+        parts = []
+        # 耗时包括读取分块(通常是下载)的时间
+        with span("oss.upload_stream") as s:
+            try:
+                for chunk in chain((head,), chunks):
+                    size += len(chunk)
+                    if blob is not None:
+                        if size <= max_blob_bytes:
+                            blob.write(chunk)
+                        else:
+                            blob = None
+                    buffer += chunk
+                    if len(buffer) >= part_size:
+                        if upload_id is None:
+                            upload_id = self.bucket.init_multipart_upload(key).upload_id
+                        part_number = len(parts) + 1
+                        result = self.bucket.upload_part(key, upload_id, part_number, bytes(buffer))
+                        parts.append(PartInfo(part_number, result.etag))
+                        buffer.clear()
+                if upload_id is None:
+                    result = self.bucket.put_object(key, bytes(buffer))
+                else:
+                    if buffer:
+                        part_number = len(parts) + 1
+                        part = self.bucket.upload_part(key, upload_id, part_number, bytes(buffer))
+                        parts.append(PartInfo(part_number, part.etag))
+                    result = self.bucket.complete_multipart_upload(key, upload_id, parts)
+            except Exception:
+                if upload_id is not None:
+                    self.bucket.abort_multipart_upload(key, upload_id)
+                raise
+            s.set("bytes", size).set("status", result.status).set("parts", len(parts))
+
+        return UploadedImage(
+            url=self.object_url(key, domain=domain) if result.status == 200 else None,
+            format=img_format,
+            size=size,
+            blob=blob.getvalue() if blob is not None else None,
+        )
+
+
+_uploader: OssUploader | None = None
+_uploader_lock = threading.Lock()
+
+
+def get_uploader() -> OssUploader:
+    """获取当前租户的OSS上传器; 不在租户上下文中时使用环境变量配置的进程级上传器, 首次调用时创建"""
+    tenant = current_tenant()
+    if tenant is not None:
+        return tenant.uploader
+    global _uploader
+    if _uploader is None:
+        with _uploader_lock:
+            if _uploader is None:
+                _uploader = OssUploader.from_env()
+    return _uploader
 
-load_dotenv(find_dotenv())
 
 def upload_image(
     filename: str,
@@ -13,6 +509,7 @@ def upload_image(
     prefix: str = "tmp",
     rename: bool = True,
     domain: str = None,
+    dedupe: bool = False,
 ) -> str | None:
     """
     上传图片到OSS
@@ -21,32 +518,66 @@ def upload_image(
     :param prefix: OSS路径前缀 上传到OSS的路径
     :param rename: 是否重命名, 默认为True
     :param domain: OSS域名, 默认为None时使用bucket_name+endpoint
+    :param dedupe: 是否按内容哈希命名并去重, 对象已存在时跳过上传, 此时忽略rename
     """
-    endpoint = os.getenv("OSS_ENDPOINT")
-
-    auth = oss2.Auth(os.getenv("OSS_ACCESS_KEY_ID"), os.getenv("OSS_ACCESS_KEY_SECRET"))
-    bucket_name = os.getenv("OSS_BUCKET_NAME")
-    bucket = oss2.Bucket(auth, endpoint, bucket_name)
-
-    if rename:
-        uid = uuid.uuid4()
-        upload_file_name = f"{prefix}/{uid}.{filename.split('.')[-1]}"
-    else:
-        upload_file_name = f"{prefix}/{filename}"
-    if prefix is None:
-        # 临时文件, 使用OSS生命周期自动删除
-        upload_file_name = f"tmp/{upload_file_name}"
-
-    result = bucket.put_object(upload_file_name, data)
-    domain = domain or os.getenv("OSS_DOMAIN")
-    if domain:
-        image_link = f"https://{domain}/{upload_file_name}"
-    else:
-        image_link = f"https://{bucket_name}.{endpoint}/{upload_file_name}"
-    if result.status == 200:
-        return image_link
-    else:
-        return None
+    return get_uploader().upload(filename, data, prefix=prefix, rename=rename, domain=domain, dedupe=dedupe)
+
+
+def upload_image_stream(
+    chunks: Iterable[bytes],
+    prefix: str = "tmp",
+    domain: str = None,
+    max_blob_bytes: int = 0,
+) -> UploadedImage:
+    """
+    流式上传图片到OSS, 参数见 OssUploader.upload_stream
+    """
+    return get_uploader().upload_stream(chunks, prefix=prefix, domain=domain, max_blob_bytes=max_blob_bytes)
+
+
+async def upload_image_async(
+    filename: str,
+    data: bytes,
+    prefix: str = "tmp",
+    rename: bool = True,
+    domain: str = None,
+    dedupe: bool = False,
+) -> str | None:
+    """
+    异步上传图片到OSS, 参数同 upload_image
+    """
+    return await get_uploader().upload_async(
+        filename, data, prefix=prefix, rename=rename, domain=domain, dedupe=dedupe
+    )
+
+
+async def upload_base64_image(
+    image_base64: str | bytes | memoryview, prefix: str = "tmp", domain: str = None
+) -> UploadedImage:
+    """
+    解码base64图片并异步上传到OSS
+    可直接传入响应体的memoryview切片, 一次解码得到唯一的一份图片内容, 检测格式、上传和blob消息都使用这一份;
+    a2b_base64执行期间不释放GIL, 即使在原生线程中执行, 事件循环也会被阻塞解码所需的时间(每MB约数毫秒)
+    """
+    # a2b_base64可直接读取ASCII字符串或memoryview, 省去b64decode先编码为bytes的整块复制
+    with span("image.decode", bytes=len(image_base64)):
+        image_bytes = await run_thread(binascii.a2b_base64, image_base64)
+    return await upload_image_data(image_bytes, prefix=prefix, domain=domain)
+
+
+async def upload_image_data(
+    image_bytes: bytes, prefix: str = "tmp", domain: str = None, keep_blob: bool = True
+) -> UploadedImage:
+    """
+    识别格式后异步上传图片内容
+    :param keep_blob: 是否在结果中保留图片内容, 不需要blob消息时可及早释放
+    """
+    info = detect_image(image_bytes)
+    img_format = info.format if info else "png"
+    url = await upload_image_async(f"image.{img_format}", image_bytes, prefix=prefix, domain=domain)
+    return UploadedImage(
+        url=url, format=img_format, size=len(image_bytes), blob=image_bytes if keep_blob else None
+    )
 
 
 if __name__ == "__main__":
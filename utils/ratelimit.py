@@ -0,0 +1,278 @@
+"""
+限流与重试
+TokenBucket 为单次调用内的简单令牌桶; AdaptiveRateLimiter 按上游(及算法/模型)在进程内共享,
+收到限流响应时自动降速并遵循 Retry-After, 配合 send_with_retry 做带抖动的指数退避重试
+"""
+
+import asyncio
+import random
+import threading
+import time
+from collections.abc import Awaitable, Callable
+from email.utils import parsedate_to_datetime
+
+import httpx
+
+from utils.config import UpstreamRateLimit, settings
+from utils.coordination import throttle
+from utils.tracing import span
+
+
+class TokenBucket:
+    """
+    令牌桶, 以rate个/秒的速度补充令牌, 最多累积capacity个
+    acquire在令牌不足时异步等待, 不阻塞事件循环
+    """
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self, tokens: float = 1) -> None:
+        async with self._lock:
+            self._refill()
+            while self.tokens < tokens:
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= tokens
+
+
+class AdaptiveRateLimiter:
+    """
+    自适应令牌桶, 线程安全, 可同时用于事件循环和同步线程
+    取令牌时先预约再等待(令牌可为负数, 表示已预约的排队请求), 等待期间不持有锁;
+    收到限流响应时速率减半, 暂停到 Retry-After 之后并作废已有预约; 此后每秒有成功请求时恢复配置速率的1/20
+    :param name: 名称, 用于指标
+    :param config: 速率与重试配置
+    """
+
+    def __init__(self, name: str, config: UpstreamRateLimit):
+        self.name = name
+        self.config = config
+        self.max_rate = config.rate_limit
+        self.rate = config.rate_limit
+        self.capacity = config.burst or max(config.rate_limit, 1)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.waiting = 0
+        self.requests = 0
+        self.throttled = 0
+        self.retries = 0
+        self.epoch = 0
+        self._increased_at = 0.0
+        self._decreased_at = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        # updated_at 可能在未来(暂停中), 此时不补充令牌
+        if now > self.updated_at:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+
+    def reserve(self, tokens: float = 1, deadline: float | None = None) -> tuple[float, int]:
+        """
+        预约令牌, 返回需要等待的秒数及当前限流轮次
+        :param deadline: time.monotonic() 时间点, 等待会超过该时间时不预约并抛出TimeoutError
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            delay = max(self.updated_at - now, 0) + max(tokens - self.tokens, 0) / self.rate
+            if deadline is not None and now + delay > deadline:
+                raise TimeoutError(f"{self.name} 限流等待超过时限")
+            self.tokens -= tokens
+            return delay, self.epoch
+
+    async def acquire(self, tokens: float = 1, deadline: float | None = None) -> None:
+        self.waiting += 1
+        try:
+            while True:
+                delay, epoch = self.reserve(tokens, deadline)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                # 等待期间收到限流响应时, 之前的预约作废, 按新速率重新预约
+                if delay <= 0 or epoch == self.epoch:
+                    break
+        finally:
+            self.waiting -= 1
+        self.requests += 1
+
+    def acquire_sync(self, tokens: float = 1, deadline: float | None = None) -> None:
+        self.waiting += 1
+        try:
+            while True:
+                delay, epoch = self.reserve(tokens, deadline)
+                if delay > 0:
+                    time.sleep(delay)
+                if delay <= 0 or epoch == self.epoch:
+                    break
+        finally:
+            self.waiting -= 1
+        self.requests += 1
+
+    def on_success(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            if self.rate < self.max_rate and now - max(self._increased_at, self._decreased_at) >= 1:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+                self._increased_at = now
+
+    def on_throttle(self, retry_after: float | None = None) -> None:
+        """收到限流响应, 同一秒内的多个限流响应只降速一次"""
+        with self._lock:
+            now = time.monotonic()
+            self.throttled += 1
+            if now - self._decreased_at >= 1:
+                self.rate = max(self.config.min_rate_limit, self.rate / 2)
+                self._decreased_at = now
+            # 作废已有的预约, 从空桶开始按新速率补充
+            self.epoch += 1
+            self.tokens = 0
+            self.updated_at = max(self.updated_at, now + (retry_after or 0))
+
+    def metrics(self) -> dict:
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            return {
+                "rate": round(self.rate, 3),
+                "max_rate": self.max_rate,
+                "tokens": round(self.tokens, 3),
+                "waiting": self.waiting,
+                "paused_seconds": round(max(self.updated_at - now, 0), 3),
+                "requests": self.requests,
+                "throttled": self.throttled,
+                "retries": self.retries,
+            }
+
+
+_limiters: dict[str, AdaptiveRateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(upstream: str, key: str | None = None) -> AdaptiveRateLimiter:
+    """
+    进程内共享的限流器
+    :param upstream: 上游名称, 与 settings.http 一致, 如 volcengine, ark
+    :param key: 算法或模型, 如智能视觉服务的req_key, 方舟的model
+    """
+    name = f"{upstream}:{key}" if key else upstream
+    limiter = _limiters.get(name)
+    if limiter is None:
+        with _limiters_lock:
+            limiter = _limiters.get(name)
+            if limiter is None:
+                limiter = _limiters[name] = AdaptiveRateLimiter(name, settings.ratelimit.for_key(upstream, key))
+    return limiter
+
+
+def limiter_metrics() -> dict[str, dict]:
+    """全部限流器的当前状态"""
+    return {name: limiter.metrics() for name, limiter in list(_limiters.items())}
+
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+# 智能视觉服务错误码: 50429 QPS超限, 50430 并发超限, 50500/50501 服务内部错误
+THROTTLE_CODES = {50429, 50430}
+RETRY_CODES = THROTTLE_CODES | {50500, 50501}
+# 只重试请求未送达上游的网络错误, 读超时等可能已产生计费的请求不重试
+RETRY_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout, httpx.RemoteProtocolError)
+
+
+def parse_retry_after(response: httpx.Response) -> float | None:
+    """Retry-After 头, 支持秒数和HTTP日期"""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def error_code(response: httpx.Response) -> int | None:
+    """错误响应体中的业务错误码"""
+    if response.status_code < 400 or "json" not in response.headers.get("Content-Type", ""):
+        return None
+    try:
+        code = response.json().get("code")
+    except (ValueError, AttributeError):
+        return None
+    return code if isinstance(code, int) else None
+
+
+class _RetryState:
+    def __init__(self, limiter: AdaptiveRateLimiter):
+        self.limiter = limiter
+        self.config = limiter.config
+        self.deadline = time.monotonic() + (self.config.deadline or settings.wait_max_seconds)
+        self.attempt = 0
+
+    def next_delay(self, response: httpx.Response | None, error: Exception | None) -> float | None:
+        """返回重试前的等待秒数, 不需要或不能再重试时返回None"""
+        retry_after = None
+        if response is not None:
+            code = error_code(response)
+            if response.status_code == 429 or code in THROTTLE_CODES:
+                retry_after = parse_retry_after(response)
+                self.limiter.on_throttle(retry_after)
+            elif response.status_code not in RETRY_STATUS and code not in RETRY_CODES:
+                self.limiter.on_success()
+                return None
+        self.attempt += 1
+        if self.attempt >= self.config.max_attempts:
+            return None
+        # 带完全抖动的指数退避, 不短于上游要求的等待时间
+        backoff = min(self.config.backoff_max, self.config.backoff_base * 2 ** (self.attempt - 1))
+        delay = max(random.uniform(0, backoff), retry_after or 0)
+        if time.monotonic() + delay > self.deadline:
+            return None
+        self.limiter.retries += 1
+        return delay
+
+
+async def send_with_retry(
+    send: Callable[[], Awaitable[httpx.Response]], limiter: AdaptiveRateLimiter
+) -> httpx.Response:
+    """
+    限流并重试异步请求, 重试用尽时返回最后一次响应或抛出最后一次网络错误
+    :param send: 发送请求的协程函数, 每次重试重新调用; 可返回流式响应, 重试前会关闭
+    """
+    state = _RetryState(limiter)
+    while True:
+        await limiter.acquire(deadline=state.deadline)
+        # 多副本部署时再按全局滑动窗口限流
+        await throttle(limiter.name, limiter.max_rate, state.deadline)
+        response = error = None
+        with span("http.attempt", upstream=limiter.name, attempt=state.attempt + 1) as s:
+            try:
+                response = await send()
+                s.set("status", response.status_code)
+                if response.status_code >= 400:
+                    # 流式响应需先读取错误响应体, 才能解析其中的错误码
+                    await response.aread()
+                    s.set("code", error_code(response))
+            except RETRY_ERRORS as e:
+                error = e
+                s.set("status", type(e).__name__)
+        delay = state.next_delay(response, error)
+        if delay is None:
+            if error is not None:
+                raise error
+            return response
+        if response is not None:
+            await response.aclose()
+        await asyncio.sleep(delay)
+
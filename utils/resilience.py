@@ -0,0 +1,247 @@
+"""
+尾延迟控制
+对冲请求: 请求超过近期耗时分位数仍未返回时再发一个相同请求, 取先完成的结果并取消另一个
+熔断: 按端点统计近期错误率, 超过阈值时快速失败或切换到备用端点
+"""
+
+import asyncio
+import threading
+import time
+from collections import deque
+from collections.abc import Awaitable, Callable
+from typing import TypeVar
+
+import httpx
+
+from utils.config import BreakerConfig, HedgeConfig, settings
+
+T = TypeVar("T")
+
+
+class CircuitOpenError(Exception):
+    """端点处于熔断状态且没有可用的备用端点"""
+
+
+class LatencyTracker:
+    """最近若干次成功请求的耗时, 用于计算对冲延迟"""
+
+    def __init__(self, config: HedgeConfig):
+        self.config = config
+        self.samples: deque[float] = deque(maxlen=config.window)
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def record(self, seconds: float) -> None:
+        self.samples.append(seconds)
+
+    def hedge_delay(self) -> float:
+        if len(self.samples) < self.config.min_samples:
+            return self.config.initial_delay
+        samples = sorted(self.samples)
+        index = min(int(len(samples) * self.config.percentile), len(samples) - 1)
+        return max(samples[index], self.config.min_delay)
+
+    def metrics(self) -> dict:
+        return {
+            "samples": len(self.samples),
+            "hedge_delay": round(self.hedge_delay(), 3),
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+        }
+
+
+async def hedged(
+    send: Callable[[], Awaitable[T]], tracker: LatencyTracker, lost: Callable[[T], bool] | None = None
+) -> T:
+    """
+    对冲执行: 首个请求超过对冲延迟仍未完成时再发一个, 返回先成功的结果, 取消其余请求
+    先完成但失败的请求不算胜出, 继续等待另一个; 都失败时优先返回失败的结果, 否则抛出后失败的异常
+    :param send: 发送请求的协程函数
+    :param lost: 判断结果是否失败, 如5xx响应
+    """
+    start = time.monotonic()
+    primary = asyncio.ensure_future(send())
+    pending = {primary}
+    try:
+        done, _ = await asyncio.wait(pending, timeout=tracker.hedge_delay())
+        if not done:
+            tracker.hedged += 1
+            pending.add(asyncio.ensure_future(send()))
+        error: BaseException | None = None
+        loser: asyncio.Future | None = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    error = task.exception()
+                elif lost is not None and lost(task.result()):
+                    loser = task
+                else:
+                    if task is not primary:
+                        tracker.hedge_wins += 1
+                    tracker.record(time.monotonic() - start)
+                    return task.result()
+        if loser is not None:
+            return loser.result()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+class CircuitBreaker:
+    """
+    单个端点的熔断器
+    closed: 正常放行; open: 快速失败, 持续open_seconds; half_open: 放行一个探测请求, 成功则关闭, 失败则重新熔断
+    """
+
+    def __init__(self, name: str, config: BreakerConfig):
+        self.name = name
+        self.config = config
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.rejected = 0
+        self._results: deque[tuple[float, bool]] = deque()
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def _trim(self, now: float) -> None:
+        while self._results and self._results[0][0] < now - self.config.window:
+            self._results.popleft()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "open":
+                if time.monotonic() - self.opened_at < self.config.open_seconds:
+                    self.rejected += 1
+                    return False
+                self.state = "half_open"
+            if self.state == "half_open":
+                if self._probing:
+                    self.rejected += 1
+                    return False
+                self._probing = True
+            return True
+
+    def record(self, success: bool) -> None:
+        with self._lock:
+            now = time.monotonic()
+            if self.state == "half_open":
+                self._probing = False
+                if success:
+                    self.state = "closed"
+                    self._results.clear()
+                else:
+                    self.state, self.opened_at = "open", now
+                return
+            self._results.append((now, success))
+            self._trim(now)
+            failures = sum(1 for _, ok in self._results if not ok)
+            if len(self._results) >= self.config.min_requests and failures / len(self._results) >= self.config.error_rate:
+                self.state, self.opened_at = "open", now
+
+    def release(self) -> None:
+        """请求被取消, 未产生结果时释放探测名额"""
+        with self._lock:
+            self._probing = False
+
+    def metrics(self) -> dict:
+        with self._lock:
+            self._trim(time.monotonic())
+            failures = sum(1 for _, ok in self._results if not ok)
+            return {
+                "state": self.state,
+                "requests": len(self._results),
+                "error_rate": round(failures / len(self._results), 3) if self._results else 0,
+                "rejected": self.rejected,
+            }
+
+
+_breakers: dict[str, CircuitBreaker] = {}
+_trackers: dict[str, LatencyTracker] = {}
+_registry_lock = threading.Lock()
+
+
+def get_breaker(endpoint: str) -> CircuitBreaker:
+    """进程内共享的端点熔断器, 端点为不含查询参数的地址"""
+    breaker = _breakers.get(endpoint)
+    if breaker is None:
+        with _registry_lock:
+            breaker = _breakers.setdefault(endpoint, CircuitBreaker(endpoint, settings.breaker))
+    return breaker
+
+
+def get_tracker(endpoint: str) -> LatencyTracker:
+    tracker = _trackers.get(endpoint)
+    if tracker is None:
+        with _registry_lock:
+            tracker = _trackers.setdefault(endpoint, LatencyTracker(settings.hedge))
+    return tracker
+
+
+def resilience_metrics() -> dict[str, dict]:
+    """全部端点的熔断及对冲状态"""
+    endpoints = set(_breakers) | set(_trackers)
+    return {
+        endpoint: {
+            "breaker": _breakers[endpoint].metrics() if endpoint in _breakers else None,
+            "hedge": _trackers[endpoint].metrics() if endpoint in _trackers else None,
+        }
+        for endpoint in sorted(endpoints)
+    }
+
+
+def is_failure(response: httpx.Response) -> bool:
+    """计入熔断错误率的响应, 限流(429)由限流器处理, 不计入"""
+    return response.status_code >= 500
+
+
+async def call_endpoint(
+    upstream: str,
+    endpoint: str,
+    send: Callable[[str], Awaitable[httpx.Response]],
+) -> httpx.Response:
+    """
+    带熔断和对冲的端点调用
+    端点熔断、请求异常或返回服务端错误时改用 settings.breaker.fallback_urls 中配置的备用端点;
+    备用端点也失败时返回最后一个失败的响应(或抛出其异常), 都处于熔断状态时抛出CircuitOpenError
+    :param upstream: 上游名称, 用于判断是否启用对冲
+    :param endpoint: 端点地址
+    :param send: 以端点地址为参数发送请求的协程函数
+    """
+    candidates = [endpoint]
+    fallback = settings.breaker.fallback_urls.get(endpoint)
+    if fallback:
+        candidates.append(fallback)
+    hedge = settings.hedge.enabled and upstream in settings.hedge.upstreams
+
+    failed_response: httpx.Response | None = None
+    error: Exception | None = None
+    for url in candidates:
+        breaker = get_breaker(url)
+        if settings.breaker.enabled and not breaker.allow():
+            continue
+        try:
+            if hedge:
+                # 限流重试耗尽后的429同样不应胜过另一个请求的成功响应
+                response = await hedged(
+                    lambda: send(url), get_tracker(url), lambda r: is_failure(r) or r.status_code == 429
+                )
+            else:
+                response = await send(url)
+        except asyncio.CancelledError:
+            breaker.release()
+            raise
+        except Exception as e:
+            breaker.record(False)
+            error, failed_response = e, None
+            continue
+        breaker.record(not is_failure(response))
+        if not is_failure(response):
+            return response
+        error, failed_response = None, response
+    if failed_response is not None:
+        return failed_response
+    if error is not None:
+        raise error
+    raise CircuitOpenError(f"{endpoint} 已熔断")
@@ -0,0 +1,118 @@
+"""
+相同请求合并(single-flight)
+同时进行的相同生成请求(规范化请求体相同, 且属于同一租户)只调用一次上游, 其余请求等待并共享同一结果;
+未固定随机种子的请求每次结果不同, 只在首个请求开始后的 unseeded_window 秒内合并
+"""
+
+import asyncio
+import hashlib
+import json
+import threading
+import time
+from collections.abc import Awaitable, Callable
+from typing import Any, TypeVar
+
+from utils.config import SingleFlightConfig, settings
+from utils.credentials import tenant_namespace
+from utils.tracing import span
+
+T = TypeVar("T")
+
+
+class _Flight:
+    __slots__ = ("task", "started_at", "followers")
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.started_at = time.monotonic()
+        self.followers = 0
+
+
+class SingleFlight:
+    """
+    按规范化请求体合并同时进行的调用, 只在后台事件循环中使用
+    :param config: 合并配置
+    """
+
+    def __init__(self, config: SingleFlightConfig):
+        self.config = config
+        self.calls = 0
+        self.coalesced = 0
+        self._flights: dict[str, _Flight] = {}
+
+    @staticmethod
+    def key(body: dict) -> str:
+        """请求体的规范化哈希, 字段顺序不影响结果; 结果链接指向租户自己的OSS, 按租户区分"""
+        canonical = json.dumps(body, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+        return f"{tenant_namespace()}:{hashlib.sha256(canonical.encode('utf-8')).hexdigest()}"
+
+    def _joinable(self, flight: _Flight, seeded: bool) -> bool:
+        if flight.task.done():
+            return False
+        return seeded or time.monotonic() - flight.started_at <= self.config.unseeded_window
+
+    async def do(self, body: dict, call: Callable[[], Awaitable[T]], seeded: bool) -> T:
+        """
+        执行或加入相同请求的调用
+        :param body: 用于合并的规范化请求体, 应包含模型、提示词、随机种子、尺寸和输入图片哈希
+        :param call: 实际调用上游的协程函数, 只由首个请求执行
+        :param seeded: 是否固定了随机种子, 否则只在窗口内合并
+        :return: 所有合并的请求得到同一个结果对象, 调用方需要修改时应先复制
+        """
+        if not self.config.enabled or (not seeded and self.config.unseeded_window <= 0):
+            return await call()
+
+        key = self.key(body)
+        flight = self._flights.get(key)
+        if flight is not None and self._joinable(flight, seeded):
+            flight.followers += 1
+            self.coalesced += 1
+            with span("singleflight.wait", followers=flight.followers):
+                # 单个等待方被取消时不影响正在进行的调用
+                return await asyncio.shield(flight.task)
+
+        self.calls += 1
+        task = asyncio.ensure_future(call())
+        flight = self._flights[key] = _Flight(task)
+
+        def done(task: asyncio.Task) -> None:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            # 所有等待方都已取消时避免"异常未被获取"的警告
+            if not task.cancelled():
+                task.exception()
+
+        task.add_done_callback(done)
+        return await asyncio.shield(task)
+
+    def metrics(self) -> dict:
+        total = self.calls + self.coalesced
+        return {
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "saved_rate": self.coalesced / total if total else 0,
+            "in_flight": len(self._flights),
+        }
+
+
+_singleflight: SingleFlight | None = None
+_singleflight_lock = threading.Lock()
+
+
+def get_singleflight() -> SingleFlight:
+    """获取进程级共享的请求合并器"""
+    global _singleflight
+    if _singleflight is None:
+        with _singleflight_lock:
+            if _singleflight is None:
+                _singleflight = SingleFlight(settings.singleflight)
+    return _singleflight
+
+
+async def coalesce(body: dict, call: Callable[[], Awaitable[T]], seeded: bool) -> T:
+    """合并同时进行的相同请求, 见 SingleFlight.do"""
+    return await get_singleflight().do(body, call, seeded)
+
+
+def singleflight_metrics() -> dict[str, Any]:
+    return get_singleflight().metrics()
@@ -0,0 +1,177 @@
+"""
+输入图片暂存
+图生图等工具需要把用户上传的图片转为上游可拉取的URL, 连续编辑同一张图时会反复上传相同内容.
+按原图内容的SHA-256把图片暂存到OSS的固定key, 在OSS生命周期删除对象之前复用同一个链接;
+上传前把尺寸调整到上游接受的范围内, 既满足接口限制也减小上传体积
+"""
+
+import asyncio
+import hashlib
+import threading
+import time
+from io import BytesIO
+
+from pydantic import BaseModel
+
+from utils.cache import CacheBackend, MemoryBackend, RedisBackend
+from utils.config import StagingConfig, settings
+from utils.credentials import tenant_namespace
+from utils.executor import run_cpu, run_thread
+from utils.image import detect_image, upload_image_async
+from utils.tracing import span
+
+# 上游可直接使用的格式, 其它格式统一转为JPEG/PNG
+ACCEPTED_FORMATS = {"jpeg", "png"}
+
+
+def content_digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class StagingError(Exception):
+    pass
+
+
+class StagedInput(BaseModel):
+    url: str
+    digest: str
+    format: str
+    width: int
+    height: int
+    size: int
+    expires_at: float
+
+
+def fit_size(width: int, height: int, min_side: int, max_side: int) -> tuple[int, int] | None:
+    """
+    按比例缩放到最短边不小于min_side, 最长边不大于max_side, 两者冲突时优先满足最长边
+    :return: 已在范围内时返回None
+    """
+    if min(width, height) >= min_side and max(width, height) <= max_side:
+        return None
+    scale = max_side / max(width, height) if max(width, height) > max_side else min_side / min(width, height)
+    scale = min(scale, max_side / max(width, height))
+    return max(round(width * scale), 1), max(round(height * scale), 1)
+
+
+def prepare_input(data: bytes, config: StagingConfig) -> tuple[bytes, str, int, int]:
+    """
+    调整图片尺寸和格式, 已符合要求时原样返回, 不解码图像
+    :return: (图片内容, 格式, 宽, 高)
+    """
+    info = detect_image(data)
+    if info is not None and info.width and info.height and info.format in ACCEPTED_FORMATS:
+        if fit_size(info.width, info.height, config.min_side, config.max_side) is None:
+            return data, info.format, info.width, info.height
+
+    from PIL import Image
+
+    pil = Image.open(BytesIO(data))
+    size = fit_size(pil.width, pil.height, config.min_side, config.max_side)
+    if size is not None:
+        if size[0] < pil.width:
+            # JPEG可在解码时直接按2的幂降采样
+            pil.draft(pil.mode, size)
+        pil = pil.resize(size, Image.Resampling.LANCZOS)
+    # 带透明通道的图片保留为PNG, 其余转为JPEG
+    if pil.mode in ("RGBA", "LA", "P") and (pil.mode != "P" or "transparency" in pil.info):
+        img_format, save_kwargs = "png", {"optimize": True}
+    else:
+        img_format, save_kwargs = "jpeg", {"quality": config.quality}
+        if pil.mode not in ("RGB", "L"):
+            pil = pil.convert("RGB")
+    buffer = BytesIO()
+    pil.save(buffer, format=img_format.upper(), **save_kwargs)
+    return buffer.getvalue(), img_format, pil.width, pil.height
+
+
+class InputStager:
+    """
+    输入图片暂存, 索引记录每个内容哈希对应的链接及其过期时间
+    :param backend: 索引存储后端, 条目在链接失效前过期
+    :param config: 暂存配置
+    """
+
+    def __init__(self, backend: CacheBackend, config: StagingConfig):
+        self.backend = backend
+        self.config = config
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    def key(self, digest: str) -> str:
+        return f"{settings.app_name}:{tenant_namespace()}:staging:{digest}"
+
+    def lookup(self, digest: str) -> StagedInput | None:
+        """未暂存或链接剩余有效期不足时返回None"""
+        value = self.backend.get(self.key(digest))
+        if value is None:
+            return None
+        staged = StagedInput.model_validate_json(value)
+        if staged.expires_at - self.config.margin <= time.time():
+            self.expired += 1
+            self.backend.delete(self.key(digest))
+            return None
+        return staged
+
+    async def stage(self, data: bytes, digest: str | None = None) -> StagedInput:
+        """
+        暂存图片并返回可供上游拉取的链接, 相同内容在有效期内只上传一次
+        :param data: 原始图片内容, 按其哈希索引
+        :param digest: 已计算的 content_digest(data), 为空时在线程池中计算
+        """
+        digest = digest or await run_thread(content_digest, data)
+        staged = await asyncio.to_thread(self.lookup, digest)
+        if staged is not None:
+            self.hits += 1
+            return staged
+        self.misses += 1
+
+        with span("staging.prepare", bytes=len(data)) as s:
+            blob, img_format, width, height = await run_cpu(prepare_input, data, self.config)
+            s.set("output_bytes", len(blob))
+        # 以开始上传的时间计算过期时间, 覆盖同名对象会重新开始生命周期计时
+        expires_at = time.time() + self.config.ttl
+        url = await upload_image_async(f"{digest}.{img_format}", blob, prefix=self.config.prefix, rename=False)
+        if not url:
+            raise StagingError("输入图片上传失败")
+        staged = StagedInput(
+            url=url, digest=digest, format=img_format, width=width, height=height, size=len(blob), expires_at=expires_at
+        )
+        ttl = self.config.ttl - self.config.margin
+        if ttl > 0:
+            await asyncio.to_thread(self.backend.set, self.key(digest), staged.model_dump_json().encode("utf-8"), ttl)
+        return staged
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "hit_rate": self.hits / total if total else 0,
+        }
+
+
+_stager: InputStager | None = None
+_stager_lock = threading.Lock()
+
+
+def get_stager() -> InputStager:
+    """获取进程级共享的输入图片暂存"""
+    global _stager
+    if _stager is None:
+        with _stager_lock:
+            if _stager is None:
+                config = settings.staging
+                if config.backend == "redis":
+                    backend = RedisBackend(ttl=config.ttl)
+                else:
+                    backend = MemoryBackend(max_items=config.max_items, ttl=config.ttl)
+                _stager = InputStager(backend, config)
+    return _stager
+
+
+async def stage_input(data: bytes, digest: str | None = None) -> StagedInput:
+    """暂存输入图片, 参见 InputStager.stage"""
+    return await get_stager().stage(data, digest)
@@ -0,0 +1,359 @@
+"""
+分阶段耗时追踪
+在签名、上游调用、下载、解码、OSS上传和消息返回等阶段打上span, 附带字节数和上游状态码;
+按阶段汇总为Prometheus直方图, 并可把span以OTLP JSON格式写入文件供OpenTelemetry Collector读取.
+未启用时 span() 返回共享的空操作对象, 开销只有一次函数调用
+"""
+
+import atexit
+import json
+import os
+import re
+import sys
+import threading
+import time
+from collections.abc import Generator, Iterable
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any
+
+from utils.config import TracingConfig, settings
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class _NoopSpan:
+    """未启用追踪时使用的空操作span"""
+
+    __slots__ = ()
+
+    def set(self, key: str, value: Any) -> "_NoopSpan":
+        return self
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        return None
+
+
+NOOP_SPAN = _NoopSpan()
+_current: ContextVar["Span | None"] = ContextVar("span", default=None)
+
+
+class Span:
+    """
+    计时区间, 在同步代码和协程中均可使用 with 语句
+    嵌套的span共享trace_id, 父span取自当前上下文
+    """
+
+    __slots__ = ("tracer", "name", "attributes", "trace_id", "span_id", "parent_id", "start_ns", "end_ns", "_start",
+                 "_token", "_parent", "duration", "error")
+
+    def __init__(self, tracer: "Tracer", name: str, attributes: dict):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.error: str | None = None
+
+    def set(self, key: str, value: Any) -> "Span":
+        self.attributes[key] = value
+        return self
+
+    def __enter__(self) -> "Span":
+        parent = self._parent = _current.get()
+        self.trace_id = parent.trace_id if parent is not None else os.urandom(16).hex()
+        self.parent_id = parent.span_id if parent is not None else None
+        self.span_id = os.urandom(8).hex()
+        self._token = _current.set(self)
+        self.start_ns = time.time_ns()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.duration = time.perf_counter() - self._start
+        self.end_ns = self.start_ns + int(self.duration * 1e9)
+        if exc_type is not None:
+            self.error = exc_type.__name__
+        try:
+            _current.reset(self._token)
+        except ValueError:
+            # 在其它上下文中结束(如跨任务的异步生成器), 只恢复父span
+            _current.set(self._parent)
+        self.tracer.record(self)
+
+    @property
+    def status(self) -> str:
+        """指标中的状态标签: 上游状态码, 否则为ok或异常类型"""
+        status = self.attributes.get("status")
+        if status is not None:
+            return str(status)
+        return self.error or "ok"
+
+
+class _Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+
+def _label(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _otlp_value(value: Any) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class Tracer:
+    """
+    span汇总与导出
+    :param config: 追踪配置
+    :param service: 服务名, 同时作为指标名前缀
+    """
+
+    def __init__(self, config: TracingConfig, service: str):
+        self.config = config
+        self.service = service
+        self.prefix = re.sub(r"[^a-zA-Z0-9_]", "_", service)
+        self.histograms: dict[tuple[str, str], _Histogram] = {}
+        self.bytes: dict[str, int] = {}
+        self.errors: dict[tuple[str, str], int] = {}
+        self._spans: list[Span] = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._server = None
+
+    def record(self, span: Span) -> None:
+        size = span.attributes.get("bytes")
+        with self._lock:
+            key = (span.name, span.status)
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = _Histogram()
+            histogram.observe(span.duration)
+            if isinstance(size, int):
+                self.bytes[span.name] = self.bytes.get(span.name, 0) + size
+            if span.error is not None:
+                error_key = (span.name, span.error)
+                self.errors[error_key] = self.errors.get(error_key, 0) + 1
+            if self.config.span_file is not None:
+                self._spans.append(span)
+                full = len(self._spans) >= self.config.max_buffer
+            else:
+                full = False
+        if full:
+            self.flush()
+
+    def prometheus_text(self) -> str:
+        """Prometheus文本格式的指标, 包括各阶段耗时直方图、字节数和异常次数, 以及已加载的工作池和限流器状态"""
+        name = f"{self.prefix}_stage_duration_seconds"
+        lines = [f"# HELP {name} 各阶段耗时", f"# TYPE {name} histogram"]
+        with self._lock:
+            histograms = [(key, list(h.counts), h.sum, h.count) for key, h in sorted(self.histograms.items())]
+            stage_bytes = sorted(self.bytes.items())
+            errors = sorted(self.errors.items())
+        for (stage, status), counts, total, count in histograms:
+            labels = f'stage="{_label(stage)}",status="{_label(status)}"'
+            cumulative = 0
+            for bound, bucket in zip(BUCKETS, counts):
+                cumulative += bucket
+                lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {count}')
+            lines.append(f"{name}_sum{{{labels}}} {total}")
+            lines.append(f"{name}_count{{{labels}}} {count}")
+
+        name = f"{self.prefix}_stage_bytes_total"
+        lines += [f"# HELP {name} 各阶段处理的字节数", f"# TYPE {name} counter"]
+        lines += [f'{name}{{stage="{_label(stage)}"}} {value}' for stage, value in stage_bytes]
+        name = f"{self.prefix}_stage_errors_total"
+        lines += [f"# HELP {name} 各阶段的异常次数", f"# TYPE {name} counter"]
+        lines += [f'{name}{{stage="{_label(stage)}",error="{_label(error)}"}} {value}' for (stage, error), value in errors]
+        lines += self._gauges()
+        return "\n".join(lines) + "\n"
+
+    def _gauges(self) -> list[str]:
+        # 只导出已经加载的模块中的状态, 不为导出指标而导入
+        lines = []
+        executor = sys.modules.get("utils.executor")
+        if executor is not None:
+            name = f"{self.prefix}_worker_queue_depth"
+            lines += [f"# HELP {name} 工作池排队任务数", f"# TYPE {name} gauge"]
+            for pool, metrics in executor.executor_metrics().items():
+                lines.append(f'{name}{{pool="{_label(pool)}"}} {metrics["queue_depth"]}')
+        ratelimit = sys.modules.get("utils.ratelimit")
+        if ratelimit is not None:
+            name = f"{self.prefix}_limiter_rate"
+            lines += [f"# HELP {name} 限流器当前速率(次/秒)", f"# TYPE {name} gauge"]
+            for limiter, metrics in ratelimit.limiter_metrics().items():
+                lines.append(f'{name}{{limiter="{_label(limiter)}"}} {metrics["rate"]}')
+        return lines
+
+    def otlp_batch(self, spans: list[Span]) -> dict:
+        """OTLP/JSON的ExportTraceServiceRequest"""
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": self.service}}]},
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": "utils.tracing"},
+                            "spans": [
+                                {
+                                    "traceId": span.trace_id,
+                                    "spanId": span.span_id,
+                                    "parentSpanId": span.parent_id or "",
+                                    "name": span.name,
+                                    "kind": 1,
+                                    "startTimeUnixNano": str(span.start_ns),
+                                    "endTimeUnixNano": str(span.end_ns),
+                                    "attributes": [
+                                        {"key": key, "value": _otlp_value(value)}
+                                        for key, value in span.attributes.items()
+                                        if value is not None
+                                    ],
+                                    "status": {"code": 2, "message": span.error} if span.error else {"code": 1},
+                                }
+                                for span in spans
+                            ],
+                        }
+                    ],
+                }
+            ]
+        }
+
+    def flush(self) -> None:
+        """写出缓冲的span和指标文件"""
+        with self._flush_lock:
+            with self._lock:
+                spans, self._spans = self._spans, []
+            if spans and self.config.span_file is not None:
+                path = Path(self.config.span_file)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                with path.open("a", encoding="utf-8") as f:
+                    f.write(json.dumps(self.otlp_batch(spans), ensure_ascii=False, separators=(",", ":")) + "\n")
+            if self.config.prometheus_file is not None:
+                path = Path(self.config.prometheus_file)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                tmp = path.with_suffix(f".{os.getpid()}.tmp")
+                tmp.write_text(self.prometheus_text(), encoding="utf-8")
+                os.replace(tmp, path)
+
+    def start(self) -> None:
+        """启动定时导出线程和指标端口"""
+        if self.config.span_file is not None or self.config.prometheus_file is not None:
+            threading.Thread(target=self._flush_forever, name="tracing-flush", daemon=True).start()
+            atexit.register(self.flush)
+        if self.config.prometheus_port:
+            self._serve(self.config.prometheus_port)
+
+    def _flush_forever(self) -> None:
+        while True:
+            time.sleep(self.config.flush_interval)
+            try:
+                self.flush()
+            except OSError:
+                pass
+
+    def _serve(self, port: int) -> None:
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        tracer = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = tracer.prometheus_text().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="tracing-metrics", daemon=True).start()
+
+
+_UNSET: Any = object()
+_tracer: Tracer | None = _UNSET
+_tracer_lock = threading.Lock()
+
+
+def get_tracer() -> Tracer | None:
+    """获取进程级共享的追踪器, 未启用时返回None"""
+    global _tracer
+    if _tracer is _UNSET:
+        with _tracer_lock:
+            if _tracer is _UNSET:
+                config = settings.tracing
+                tracer = None
+                if config.enabled:
+                    tracer = Tracer(config, settings.app_name)
+                    # 工作池的子进程不导出, 避免重复监听端口和写文件
+                    import multiprocessing
+
+                    if multiprocessing.parent_process() is None:
+                        tracer.start()
+                _tracer = tracer
+    return _tracer
+
+
+def span(name: str, **attributes: Any) -> Span | _NoopSpan:
+    """
+    创建span, 用法: with span("oss.upload", bytes=len(data)) as s: ...; s.set("status", 200)
+    :param name: 阶段名称, 作为指标的stage标签
+    :param attributes: 附加属性, bytes计入字节数指标, status作为指标的状态标签
+    """
+    tracer = _tracer
+    if tracer is None:
+        return NOOP_SPAN
+    if tracer is _UNSET:
+        tracer = get_tracer()
+        if tracer is None:
+            return NOOP_SPAN
+    return Span(tracer, name, attributes)
+
+
+def trace_messages(tool: str, messages: Iterable) -> Generator:
+    """
+    为一次工具调用创建根span, 并记录每条消息交给Dify的耗时, blob消息附带字节数
+    :param tool: 工具名称
+    :param messages: 工具产出的 ToolInvokeMessage
+    """
+    tracer = _tracer if _tracer is not _UNSET else get_tracer()
+    if tracer is None:
+        yield from messages
+        return
+    with span(f"tool.{tool}") as root:
+        count = 0
+        for message in messages:
+            count += 1
+            with span("tool.emit", type=message.type.value) as emit:
+                blob = getattr(message.message, "blob", None)
+                if blob is not None:
+                    emit.set("bytes", len(blob))
+                yield message
+        root.set("messages", count)
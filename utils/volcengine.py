@@ -1,22 +1,57 @@
+import asyncio
+import binascii
 import hashlib
 import hmac
 import json
+import os
+import time
+import weakref
+from collections.abc import AsyncIterator
 from datetime import datetime, timezone
 from enum import Enum
-from typing import Literal
-from urllib.parse import urlencode
+from functools import lru_cache
+from io import BytesIO
+from typing import Any, Literal
+from urllib.parse import parse_qsl, urlencode
 
 import httpx
 from pydantic import BaseModel, Field
 
+try:
+    import orjson
+except ImportError:  # pragma: no cover - 可选依赖
+    orjson = None
+
+from utils.config import settings
+from utils.coordination import generation_slot
+from utils.http_client import get_async_client
+from utils.image import UploadedImage, upload_base64_image, upload_image_data
+from utils.ratelimit import AdaptiveRateLimiter, get_limiter, send_with_retry
+from utils.tracing import span
+
+
+class VolcengineError(Exception):
+    """智能视觉服务返回错误"""
+
+
+class CVAction(Enum):
+    Process = "CVProcess"
+    SubmitTask = "CVSync2AsyncSubmitTask"
+    GetResult = "CVSync2AsyncGetResult"
+
+
+def action_query(action: CVAction, version: str = "2022-08-31") -> str:
+    """指定接口动作的查询参数"""
+    return f"Action={action.value}&Version={version}"
+
 
 class Params(BaseModel):
     access_key: str
     secret_key: str
     body: dict
     method: Literal["GET", "POST", "PUT", "DELETE"] = "POST"
-    base_url: str = "https://visual.volcengineapi.com"
-    query_params: dict | str = "Action=CVProcess&Version=2022-08-31"
+    base_url: str = Field(default_factory=lambda: os.getenv("SEEDREAM_BASE_URL", "https://visual.volcengineapi.com"))
+    query_params: dict | str = action_query(CVAction.Process)
     region: str = "cn-north-1"
     service: str = "cv"
     algorithm: str = "HMAC-SHA256"
@@ -66,42 +101,540 @@ def get_authorization_string():
     pass
 
 
+def loads(content: bytes) -> Any:
+    """解析JSON, 安装了orjson时直接解析bytes, 不先解码为str"""
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+IMAGES_KEY = b'"binary_data_base64"'
+
+
+def split_images(content: bytes) -> tuple[bytes, list[memoryview]]:
+    """
+    从响应体中切出图片base64数组
+    返回去掉图片后的JSON(只复制数组前后的少量字节), 以及每张图片base64内容在原响应体上的memoryview
+    数组含转义字符等无法直接切分时原样返回, 交给JSON解析
+    """
+    key = content.find(IMAGES_KEY)
+    if key <= 0 or content[key - 1] == ord("\\"):
+        return content, []
+    start = content.find(b"[", key + len(IMAGES_KEY))
+    end = content.find(b"]", start + 1) if start > 0 else -1
+    if end < 0 or content[key + len(IMAGES_KEY) : start].strip(b" \t\r\n:"):
+        return content, []
+    if content.find(b"\\", start, end) >= 0:
+        return content, []
+    view = memoryview(content)
+    images = []
+    position = start + 1
+    while (opening := content.find(b'"', position, end)) >= 0:
+        closing = content.find(b'"', opening + 1, end)
+        if closing < 0:
+            return content, []
+        images.append(view[opening + 1 : closing])
+        position = closing + 1
+    return content[: start + 1] + content[end:], images
+
+
+def parse_cv_response(content: bytes) -> dict:
+    """
+    解析智能视觉服务响应
+    data.binary_data_base64 中的图片为原响应体上的memoryview, 不为每张图片创建base64字符串
+    """
+    stripped, images = split_images(content)
+    result = loads(stripped)
+    data = result.get("data") if isinstance(result, dict) else None
+    if images and isinstance(data, dict) and "binary_data_base64" in data:
+        data["binary_data_base64"] = images
+    elif images:
+        # 结构不符合预期, 按完整JSON解析
+        result = loads(content)
+    return result
+
+
+class ImageArrayParser:
+    """
+    增量解析响应体, 从binary_data_base64数组中逐个取出图片, 边读取边解码
+    数组以外的内容保存在rest中, 读完后可按普通JSON解析; 内存中只保留当前图片的解码结果
+    """
+
+    def __init__(self):
+        self.rest = bytearray()
+        self.state: Literal["seek", "array", "string", "after"] = "seek"
+        self._searched = 0
+        self._image: BytesIO | None = None
+        self._carry = b""
+
+    def feed(self, chunk: bytes) -> list[bytes]:
+        """输入一段响应体, 返回其中解析完成的图片"""
+        images = []
+        position = 0
+        while position < len(chunk):
+            if self.state == "seek":
+                self.rest += chunk[position:]
+                position = len(chunk)
+                tail = self._seek()
+                if tail:
+                    chunk, position = tail, 0
+            elif self.state == "array":
+                byte = chunk[position]
+                position += 1
+                if byte == 0x22:  # "
+                    self.state, self._image, self._carry = "string", BytesIO(), b""
+                elif byte == 0x5D:  # ]
+                    self.state = "after"
+                    self.rest += b"]"
+            elif self.state == "string":
+                closing = chunk.find(b'"', position)
+                self._decode(chunk[position : closing if closing >= 0 else len(chunk)])
+                if closing < 0:
+                    break
+                position = closing + 1
+                if self._carry:
+                    self._image.write(binascii.a2b_base64(self._carry + b"=" * (-len(self._carry) % 4)))
+                images.append(self._image.getvalue())
+                self.state, self._image, self._carry = "array", None, b""
+            else:
+                self.rest += chunk[position:]
+                break
+        return images
+
+    def _seek(self) -> bytes:
+        """在rest中查找图片数组的开头, 找到后截出已读入的数组内容交给后续状态处理"""
+        key = self.rest.find(IMAGES_KEY, max(self._searched - len(IMAGES_KEY), 0))
+        if key < 0:
+            self._searched = len(self.rest)
+            return b""
+        self._searched = key
+        start = self.rest.find(b"[", key + len(IMAGES_KEY))
+        if start < 0:
+            return b""
+        tail = bytes(self.rest[start + 1 :])
+        del self.rest[start + 1 :]
+        self.state = "array"
+        return tail
+
+    def _decode(self, segment: bytes) -> None:
+        # base64中唯一可能出现的转义是 \/
+        if b"\\" in segment:
+            segment = segment.replace(b"\\", b"")
+        data = self._carry + segment if self._carry else segment
+        aligned = len(data) // 4 * 4
+        if aligned:
+            self._image.write(binascii.a2b_base64(data[:aligned]))
+        self._carry = data[aligned:]
+
+    def result(self) -> dict:
+        """去掉图片后的响应JSON"""
+        return loads(bytes(self.rest)) if self.rest.strip() else {}
+
+
+def dump_body(body: dict) -> bytes:
+    """序列化请求体, 签名和发送使用同一份字节"""
+    return json.dumps(body).encode("utf-8")
+
+
+@lru_cache(maxsize=256)
+def canonical_query(query: str) -> str:
+    """规范化查询字符串, 参数按键排序"""
+    return urlencode(sorted(parse_qsl(query, keep_blank_values=True)))
+
+
+def query_string(params: Params) -> str:
+    if isinstance(params.query_params, dict):
+        return urlencode(sorted(params.query_params.items()))
+    return canonical_query(params.query_params)
+
+
+@lru_cache(maxsize=64)
+def url_host(base_url: str) -> str:
+    return httpx.URL(base_url).host
+
+
+class Signer(httpx.Auth):
+    """
+    火山引擎 HMAC-SHA256 请求签名
+    按日期缓存派生的签名密钥, 同一天内只需一次HMAC计算; 可直接作为httpx的auth参数使用
+    """
+
+    requires_request_body = True
+    signed_headers = "content-type;host;x-content-sha256;x-date"
+
+    def __init__(
+        self,
+        access_key: str,
+        secret_key: str,
+        region: str = "cn-north-1",
+        service: str = "cv",
+        algorithm: str = "HMAC-SHA256",
+    ):
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.service = service
+        self.algorithm = algorithm
+        self._signing_key: tuple[str, bytes] | None = None
+
+    def current_time(self) -> datetime:
+        return datetime.now(timezone.utc)
+
+    def signing_key(self, date: str) -> bytes:
+        """派生签名密钥, 按(日期, 区域, 服务)缓存, 区域和服务在签名器内固定"""
+        cached = self._signing_key
+        if cached is not None and cached[0] == date:
+            return cached[1]
+        key = get_signature_key(self.secret_key, date, self.region, self.service)
+        self._signing_key = (date, key)
+        return key
+
+    def sign(
+        self,
+        method: str,
+        host: str,
+        query: str,
+        body: bytes,
+        content_type: str = "application/json",
+        now: datetime | None = None,
+    ) -> dict:
+        """
+        计算签名Header
+        :param host: 请求域名, 不含端口
+        :param query: 规范化后的查询字符串
+        :param body: 实际发送的请求体
+        """
+        with span("volcengine.sign", bytes=len(body)):
+            return self._sign(method, host, query, body, content_type, now)
+
+    def _sign(
+        self, method: str, host: str, query: str, body: bytes, content_type: str, now: datetime | None
+    ) -> dict:
+        now = now or self.current_time()
+        current_datetime = now.strftime("%Y%m%dT%H%M%SZ")
+        current_date = current_datetime[:8]
+        payload_hash = hashlib.sha256(body).hexdigest()
+        canonical_headers = (
+            f"content-type:{content_type}\nhost:{host}\nx-content-sha256:{payload_hash}\nx-date:{current_datetime}\n"
+        )
+        credential_scope = f"{current_date}/{self.region}/{self.service}/request"
+        canonical_request = f"{method}\n/\n{query}\n{canonical_headers}\n{self.signed_headers}\n{payload_hash}"
+        string_to_sign = f"{self.algorithm}\n{current_datetime}\n{credential_scope}\n{hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()}"
+        signature = hmac.new(self.signing_key(current_date), string_to_sign.encode("utf-8"), hashlib.sha256).hexdigest()
+        authorization_header = f"{self.algorithm} Credential={self.access_key}/{credential_scope}, SignedHeaders={self.signed_headers}, Signature={signature}"
+
+        return {
+            "X-Date": current_datetime,
+            "Authorization": authorization_header,
+            "X-Content-Sha256": payload_hash,
+            "Content-Type": content_type,
+        }
+
+    def auth_flow(self, request: httpx.Request):
+        headers = self.sign(
+            request.method,
+            request.url.host,
+            canonical_query(request.url.query.decode()),
+            request.content,
+            content_type=request.headers.get("Content-Type", "application/json"),
+        )
+        request.headers.update(headers)
+        yield request
+
+
+@lru_cache(maxsize=64)
+def get_signer(
+    access_key: str,
+    secret_key: str,
+    region: str = "cn-north-1",
+    service: str = "cv",
+    algorithm: str = "HMAC-SHA256",
+) -> Signer:
+    """按凭证复用签名器, 以便复用其缓存的签名密钥"""
+    return Signer(access_key, secret_key, region=region, service=service, algorithm=algorithm)
+
+
+def params_signer(params: Params) -> Signer:
+    return get_signer(params.access_key, params.secret_key, params.region, params.service, params.algorithm)
+
+
 def create_header(
     params: Params,
+    body: bytes | None = None,
 ) -> dict:
-    """创建Header"""
-    signed_headers = "content-type;host;x-content-sha256;x-date"
-    content_type = "application/json"
-    payload_hash = hashlib.sha256(json.dumps(params.body).encode("utf-8")).hexdigest()
-    # current_datetime = datetime.now(timezone.utc).isoformat(timespec="seconds")
-    now = datetime.now(timezone.utc)
-    current_datetime = now.strftime("%Y%m%dT%H%M%SZ")
-    # current_date = now.date().isoformat()
-    current_date = now.strftime("%Y%m%d")
-    host = httpx.URL(params.base_url).host
-    canonical_headers = (
-        f"content-type:{content_type}\nhost:{host}\nx-content-sha256:{payload_hash}\nx-date:{current_datetime}\n"
-    )
-    credential_scope = f"{current_date}/{params.region}/{params.service}/request"
-    canonical_uri = "/"
-    # query_string = httpx.URL(params.base_url, params=params.query_params).query.decode()
+    """
+    创建Header
+    :param body: 实际发送的请求体, 为空时按 dump_body(params.body) 序列化
+    """
+    if body is None:
+        body = dump_body(params.body)
+    return params_signer(params).sign(params.method, url_host(params.base_url), query_string(params), body)
 
-    query_string = (
-        urlencode(sorted(params.query_params.items())) if isinstance(params.query_params, dict) else params.query_params
-    )
 
-    canonical_request = (
-        f"{params.method}\n{canonical_uri}\n{query_string}\n{canonical_headers}\n{signed_headers}\n{payload_hash}"
+def action_name(params: Params) -> str:
+    """请求的Action, 用于追踪"""
+    query = params.query_params
+    if isinstance(query, str):
+        query = dict(parse_qsl(query))
+    return query.get("Action", "")
+
+
+def build_url(params: Params) -> str:
+    """请求地址, 包含排序后的查询参数"""
+    return params.base_url + "?" + query_string(params)
+
+
+async def cv_process(params: Params, limiter: AdaptiveRateLimiter | None = None) -> dict:
+    """
+    异步调用智能视觉服务接口, 返回响应JSON
+    按req_key共享限流, 限流及服务端错误自动重试
+    :param limiter: 限流器, 默认按请求体中的req_key取得
+    """
+    client = get_async_client("volcengine")
+    url = build_url(params)
+    content = dump_body(params.body)
+    limiter = limiter or get_limiter("volcengine", params.body.get("req_key"))
+    with span("volcengine.request", action=action_name(params), req_key=params.body.get("req_key", "")) as s:
+        response = await send_with_retry(
+            lambda: client.post(
+                url, content=content, headers={"Content-Type": "application/json"}, auth=params_signer(params)
+            ),
+            limiter,
+        )
+        s.set("status", response.status_code).set("bytes", len(response.content))
+        data = parse_cv_response(response.content)
+        s.set("code", data.get("code"))
+    return data
+
+
+class CVImageStream:
+    """
+    流式调用智能视觉服务, 异步迭代得到逐张解码后的图片
+    调用方处理完当前图片后才继续读取响应, 迭代结束后 result 为去掉图片后的响应JSON
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, params: Params):
+        self.params = params
+        self.result: dict | None = None
+
+    def __aiter__(self) -> AsyncIterator[bytes]:
+        return self._iterate()
+
+    async def _iterate(self) -> AsyncIterator[bytes]:
+        params = self.params
+        client = get_async_client("volcengine")
+        url = build_url(params)
+        content = dump_body(params.body)
+        limiter = get_limiter("volcengine", params.body.get("req_key"))
+
+        def send():
+            request = client.build_request(
+                "POST", url, content=content, headers={"Content-Type": "application/json"}
+            )
+            return client.send(request, auth=params_signer(params), stream=True)
+
+        with span("volcengine.stream", action=action_name(params), req_key=params.body.get("req_key", "")) as s:
+            response = await send_with_retry(send, limiter)
+            s.set("status", response.status_code)
+            try:
+                if response.status_code >= 400:
+                    self.result = parse_cv_response(response.content)
+                    return
+                parser = ImageArrayParser()
+                async for chunk in response.aiter_bytes(self.chunk_size):
+                    images = parser.feed(chunk)
+                    # 逐个取出, 不在局部变量中保留已交出的图片
+                    while images:
+                        yield images.pop(0)
+                self.result = parser.result()
+            finally:
+                s.set("bytes", response.num_bytes_downloaded).set("code", (self.result or {}).get("code"))
+                await response.aclose()
+
+
+async def cv_submit_task(params: Params) -> str:
+    """提交异步生成任务, 返回task_id"""
+    submit = params.model_copy(update={"query_params": action_query(CVAction.SubmitTask)})
+    data = await cv_process(submit)
+    task_id = (data.get("data") or {}).get("task_id")
+    if not task_id:
+        raise VolcengineError(f"提交任务失败: {data.get('code')} {data.get('message')}")
+    return task_id
+
+
+async def cv_get_result(params: Params, task_id: str) -> dict:
+    """查询异步任务结果"""
+    query = params.model_copy(
+        update={
+            "query_params": action_query(CVAction.GetResult),
+            "body": {"req_key": params.body.get("req_key"), "task_id": task_id},
+        }
     )
-    string_to_sign = f"{params.algorithm}\n{current_datetime}\n{credential_scope}\n{hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()}"
-    signing_key = get_signature_key(params.secret_key, current_date, params.region, params.service)
-    signature = hmac.new(signing_key, string_to_sign.encode("utf-8"), hashlib.sha256).hexdigest()
-    authorization_header = f"{params.algorithm} Credential={params.access_key}/{credential_scope}, SignedHeaders={signed_headers}, Signature={signature}"
-
-    headers = {
-        "X-Date": current_datetime,
-        "Authorization": authorization_header,
-        "X-Content-Sha256": payload_hash,
-        "Content-Type": content_type,
-    }
-    return headers
+    # 查询结果与提交任务分开限流, 避免轮询挤占提交配额
+    return await cv_process(query, limiter=get_limiter("volcengine_result", params.body.get("req_key")))
+
+
+class _PendingTask:
+    def __init__(self, params: Params, task_id: str, future: asyncio.Future, deadline: float, interval: float):
+        self.params = params
+        self.task_id = task_id
+        self.future = future
+        self.deadline = deadline
+        self.interval = interval
+        self.next_poll = time.monotonic() + interval
+        self.status: str | None = None
+
+
+class TaskPoller:
+    """
+    异步任务轮询器
+    在同一个事件循环里用一个协程轮询所有进行中的任务, 每个任务的轮询间隔按倍数增长到上限,
+    任务从排队进入生成状态时间隔重置; 超过等待上限时任务以TimeoutError结束
+    """
+
+    def __init__(
+        self,
+        interval: float | None = None,
+        max_interval: float | None = None,
+        backoff: float | None = None,
+    ):
+        self.interval = interval or settings.volcengine.poll_interval
+        self.max_interval = max_interval or settings.volcengine.poll_max_interval
+        self.backoff = backoff or settings.volcengine.poll_backoff
+        self.polls = 0
+        self._pending: dict[str, _PendingTask] = {}
+        self._wakeup: asyncio.Event | None = None
+        self._runner: asyncio.Task | None = None
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._pending)
+
+    async def wait(self, params: Params, task_id: str, timeout: float | None = None) -> dict:
+        """等待任务完成, 返回与CVProcess相同结构的响应"""
+        loop = asyncio.get_running_loop()
+        timeout = timeout or settings.wait_max_seconds
+        task = _PendingTask(params, task_id, loop.create_future(), time.monotonic() + timeout, self.interval)
+        self._pending[task_id] = task
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        if self._runner is None or self._runner.done():
+            self._runner = loop.create_task(self._run())
+        self._wakeup.set()
+        try:
+            return await task.future
+        finally:
+            self._pending.pop(task_id, None)
+
+    async def _run(self) -> None:
+        while self._pending:
+            now = time.monotonic()
+            due = [task for task in self._pending.values() if task.next_poll <= now and not task.future.done()]
+            if due:
+                await asyncio.gather(*(self._poll(task) for task in due))
+            next_poll = min((task.next_poll for task in self._pending.values()), default=None)
+            if next_poll is None:
+                break
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), max(next_poll - time.monotonic(), 0))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _poll(self, task: _PendingTask) -> None:
+        self.polls += 1
+        try:
+            data = await cv_get_result(task.params, task.task_id)
+        except Exception as e:
+            if not task.future.done():
+                task.future.set_exception(e)
+            return
+        status = (data.get("data") or {}).get("status")
+        if status == "done":
+            task.future.set_result(data)
+            return
+        if status in ("not_found", "expired") or data.get("code") not in (None, 10000):
+            task.future.set_exception(VolcengineError(f"任务{task.task_id}失败: {status} {data.get('message')}"))
+            return
+        now = time.monotonic()
+        if now >= task.deadline:
+            task.future.set_exception(TimeoutError(f"任务{task.task_id}等待超时"))
+            return
+        # 进入生成阶段后重新从最小间隔开始轮询
+        if task.status == "in_queue" and status == "generating":
+            task.interval = self.interval
+        else:
+            task.interval = min(task.interval * self.backoff, self.max_interval)
+        task.status = status
+        task.next_poll = min(now + task.interval, task.deadline)
+
+
+_pollers: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, TaskPoller]" = weakref.WeakKeyDictionary()
+
+
+def get_poller() -> TaskPoller:
+    """当前事件循环共享的轮询器"""
+    loop = asyncio.get_running_loop()
+    poller = _pollers.get(loop)
+    if poller is None:
+        poller = _pollers[loop] = TaskPoller()
+    return poller
+
+
+async def cv_process_task(params: Params, timeout: float | None = None) -> dict:
+    """以提交任务+轮询的方式调用, 返回与CVProcess相同结构的响应"""
+    task_id = await cv_submit_task(params)
+    return await get_poller().wait(params, task_id, timeout=timeout)
+
+
+async def cv_generate(params: Params) -> dict:
+    """按 settings.volcengine.mode 选择同步调用或异步任务"""
+    if settings.volcengine.mode == "async_task":
+        return await cv_process_task(params)
+    return await cv_process(params)
+
+
+async def cv_iter_images(
+    params: Params, prefix: str = "seedream", keep_blobs: bool = False
+) -> AsyncIterator[UploadedImage]:
+    """
+    调用智能视觉服务, 每张图片上传完成后立即产出, 顺序为完成顺序
+    开启 settings.volcengine.stream_response 且为同步调用时逐张读取、解码、上传, 默认只有第一张保留图片内容;
+    否则读取完整响应后并发解码上传
+    :param keep_blobs: 逐张读取时是否保留每张图片的内容, 调用方需要全部图片的blob时使用
+    """
+    async with generation_slot("volcengine") as generation:
+        count = 0
+        if settings.volcengine.stream_response and settings.volcengine.mode == "sync":
+            async for image_bytes in CVImageStream(params):
+                image = await upload_image_data(image_bytes, prefix=prefix, keep_blob=keep_blobs or not count)
+                del image_bytes
+                count += 1
+                generation.uploaded = count
+                yield image
+        else:
+            data = await cv_generate(params)
+            images_base64 = (data.get("data") or {}).get("binary_data_base64") or []
+            # 多张图片并发解码上传, 先完成的先产出
+            tasks = [
+                asyncio.ensure_future(upload_base64_image(image_base64, prefix=prefix))
+                for image_base64 in images_base64
+                if image_base64
+            ]
+            try:
+                for future in asyncio.as_completed(tasks):
+                    image = await future
+                    count += 1
+                    generation.uploaded = count
+                    yield image
+            finally:
+                for task in tasks:
+                    task.cancel()
+        generation.images = count
+
+
+async def cv_generate_images(params: Params, prefix: str = "seedream") -> list[UploadedImage]:
+    """调用智能视觉服务并上传返回的全部图片, 见 cv_iter_images; 调用方持有全部图片, 每张都保留图片内容"""
+    return [image async for image in cv_iter_images(params, prefix=prefix, keep_blobs=True)]